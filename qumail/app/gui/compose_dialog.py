@@ -1,5 +1,6 @@
 from PyQt5 import QtWidgets, QtCore
-from typing import List, Tuple, Optional
+from contextlib import ExitStack
+from typing import BinaryIO, List, Tuple, Optional
 import os
 import base64
 
@@ -26,7 +27,7 @@ class ComposeDialog(QtWidgets.QDialog):
         self.cmb_level = QtWidgets.QComboBox()
         self.cmb_level.addItems([
             "4 - No Quantum Security",
-            "3 - Placeholder (AES-GCM)",
+            "3 - Fastest AEAD (AES-GCM / ChaCha20)",
             "2 - Quantum-aided AES-GCM",
             "1 - Quantum Secure OTP",
         ])
@@ -65,17 +66,17 @@ class ComposeDialog(QtWidgets.QDialog):
         btns.accepted.connect(self.on_send)
         btns.rejected.connect(self.reject)
 
-        self._attachments: List[Tuple[str, bytes]] = []
+        # (name, path); files are opened at send time and streamed, not read into memory
+        self._attachments: List[Tuple[str, str]] = []
 
     def add_attachment(self):
         paths, _ = QtWidgets.QFileDialog.getOpenFileNames(self, "Select files")
         for p in paths:
             try:
-                with open(p, 'rb') as f:
-                    data = f.read()
+                size = os.path.getsize(p)
                 fname = os.path.basename(p)
-                self._attachments.append((fname, data))
-                self.lst_attachments.addItem(f"{fname} ({len(data)} bytes)")
+                self._attachments.append((fname, p))
+                self.lst_attachments.addItem(f"{fname} ({size} bytes)")
             except Exception as e:
                 QtWidgets.QMessageBox.warning(self, "Attachment Error", str(e))
 
@@ -92,6 +93,15 @@ class ComposeDialog(QtWidgets.QDialog):
         return mapping.get(idx, 4)
 
     def on_send(self):
+        with ExitStack() as files:
+            try:
+                attachments = [(name, files.enter_context(open(path, 'rb'))) for name, path in self._attachments]
+            except OSError as e:
+                QtWidgets.QMessageBox.warning(self, "Attachment Error", str(e))
+                return
+            self._send(attachments)
+
+    def _send(self, attachments: List[Tuple[str, BinaryIO]]):
         sender = self.txt_from.text().strip()
         recipients = [x.strip() for x in self.txt_to.text().split(',') if x.strip()]
         subject = self.txt_subject.text().strip()
@@ -102,19 +112,27 @@ class ComposeDialog(QtWidgets.QDialog):
             QtWidgets.QMessageBox.warning(self, "Validation", "Sender and at least one recipient required")
             return
 
+        # Compress up front so a Level 1 key only has to cover the compressed bytes
+        body = body_text.encode('utf-8')
+        prepared = self.email_service.prepare_parts(body, attachments)
+
         qkd_bytes: Optional[bytes] = None
         key_id: Optional[str] = None
         tampered: Optional[bool] = None
         key_offset: Optional[int] = 0
         key_bytes: Optional[int] = None
+        part_key_offsets: Optional[List[int]] = None
         try:
             # Determine required key length
             if level == 1:
-                total_len = len(body_text.encode('utf-8')) + sum(len(d) for _, d in self._attachments)
-                key_id, qkd_bytes, tampered = self.km.request_key_with_verify(length=max(total_len, self.app.config.km.default_key_length))
-                key_bytes = total_len
+                # Carve a disjoint range per part out of this pair's OTP slab
+                alloc = self.app.otp_slabs.allocate(sender, recipients, [len(p.data) for p in prepared])
+                key_id, qkd_bytes, tampered = alloc.key_id, alloc.material, alloc.tampered
+                key_offset = alloc.offset
+                key_bytes = len(alloc.material)
+                part_key_offsets = alloc.part_offsets
             elif level in (2, 3):
-                key_id, qkd_bytes, tampered = self.km.request_key_with_verify(length=64)
+                key_id, qkd_bytes, tampered = self.km.acquire_key(64)
                 key_bytes = 64
         except Exception as e:
             if level != 4:
@@ -143,14 +161,16 @@ class ComposeDialog(QtWidgets.QDialog):
                 sender=sender,
                 recipients=recipients,
                 subject=subject,
-                body=body_text.encode('utf-8'),
-                attachments=self._attachments,
+                body=body,
+                attachments=attachments,
                 level=level,
                 qkd_key_material=qkd_bytes,
                 key_id=key_id,
                 key_offset=key_offset,
                 key_bytes=key_bytes,
                 tampered=tampered,
+                prepared=prepared,
+                part_key_offsets=part_key_offsets,
             )
             # Audit: encrypt message
             try:
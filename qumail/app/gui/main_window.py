@@ -1,8 +1,9 @@
 from PyQt5 import QtWidgets, QtCore
 from typing import List, Tuple
 import base64
+import tempfile
 
-from ..services.email_service import EmailService
+from ..services.email_service import EmailService, read_headers
 from ..services.km_client import KMClient
 from ..services import crypto_service
 from .compose_dialog import ComposeDialog
@@ -76,9 +77,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def open_message(self, item: QtWidgets.QListWidgetItem):
         uid = item.data(QtCore.Qt.UserRole)
-        msg = self.email_service.fetch_message(uid)
-        if not msg:
+        # Opened part by part from a temporary file, so big attachments stay out of memory
+        fp = self.email_service.fetch_message_file(uid)
+        if not fp:
             return
+        msg = read_headers(fp)
 
         # Attempt decryption: request some key material based on policy
         level_str = msg.get('X-QuMail-Level', '4')
@@ -99,8 +102,13 @@ class MainWindow(QtWidgets.QMainWindow):
 
         try:
             if level == 1:
+                if key_id and key_bytes_hdr and key_offset_hdr:
+                    # Read the message's slab range without consuming it, so it can be reopened
+                    offset, slice_b, t = self.km.material_with_verify(key_id, int(key_bytes_hdr), offset=int(key_offset_hdr))
+                    qkd_bytes = slice_b
+                    tampered_detected = tampered_detected or t
                 # Try to consume exact slice if key_id and bytes are present
-                if key_id and key_bytes_hdr:
+                elif key_id and key_bytes_hdr:
                     need = int(key_bytes_hdr)
                     offset, slice_b, t = self.km.consume_with_verify(key_id, need)
                     qkd_bytes = slice_b
@@ -121,7 +129,8 @@ class MainWindow(QtWidgets.QMainWindow):
             return
 
         try:
-            body, attachments = self.email_service.decrypt_message(msg, qkd_bytes)
+            with fp, tempfile.TemporaryDirectory() as out_dir:
+                body, attachments = self.email_service.decrypt_message_file(fp, qkd_bytes, out_dir)
             text = (
                 f"Subject: {msg.get('Subject','')}\n"
                 f"From: {msg.get('From','')}\n"
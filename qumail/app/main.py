@@ -7,7 +7,9 @@ from PyQt5 import QtWidgets
 from .services.config import load_config
 from .services.logger import setup_logger
 from .services.km_client import KMClient
+from .services.key_slab import OTPSlabRegistry
 from .services.email_service import EmailService
+from .services import crypto_service
 from .services.db import Database, DBConfig
 from .gui.main_window import MainWindow
 from .gui.settings_dialog import SettingsDialog
@@ -20,15 +22,22 @@ class QuMailApp(QtWidgets.QApplication):
         self.config = load_config()
         self.logger = setup_logger(self.config.log_level)
         self.km_client = KMClient(self.config.km)
+        self.otp_slabs = OTPSlabRegistry(self.km_client)
+        self.km_client.start_health_monitor()
+        # Keep verified 64-byte AES seeds ready so compose does not wait on the KM
+        if self.config.km.pool_depth > 0:
+            self.km_client.start_pool()
         self.email_service = EmailService(self.config.smtp, self.config.imap)
         self.db = Database(DBConfig(self.config.db_path))
+        # Pick the fastest AEAD for Level 3 on this host
+        self.logger.info("Level 3 cipher: %s", crypto_service.select_level3_cipher())
 
 
 def run():
     app = QuMailApp(sys.argv)
 
     # Simple startup checks
-    if app.km_client.status():
+    if app.km_client.health.snapshot().ok:
         app.logger.info("KM Simulator reachable.")
     else:
         app.logger.warning("KM Simulator not reachable. Start it via run_km_simulator.py")
@@ -0,0 +1,83 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional, Sequence, Tuple, TypeVar
+
+from .config import KMConfig
+from .km_client import KMClient
+from .km_health import BreakerAdapter
+
+T = TypeVar("T")
+
+
+class AsyncKMClient:
+    """asyncio front end for the KM REST API.
+
+    Mirrors the verifying calls of :class:`KMClient`. Requests run on a
+    private thread pool backed by an HTTP connection pool of the same size,
+    so at most ``max_concurrency`` calls are in flight and each one reuses a
+    kept-alive connection. Every call is bounded by ``deadline`` seconds,
+    including time spent waiting for a free slot; the underlying request
+    uses the same value as its socket timeout so abandoned calls wind down.
+
+    Example::
+
+        async with AsyncKMClient(cfg, max_concurrency=4) as km:
+            keys = await asyncio.gather(*(km.request_key_with_verify(64) for _ in rcpts))
+    """
+
+    def __init__(self, cfg: KMConfig, max_concurrency: int = 8, deadline: float = 10.0):
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency must be positive")
+        self.cfg = cfg
+        self.deadline = float(deadline)
+        self.max_concurrency = int(max_concurrency)
+        self._km = KMClient(cfg)
+        self._km.timeout = self.deadline
+        # One pooled connection per worker; keep KMClient's retry policy and breaker
+        retry = self._km.session.get_adapter(cfg.base_url).max_retries
+        adapter = BreakerAdapter(self._km.breaker, cfg.retry_after_attempts, cfg.retry_after_max,
+                                 pool_connections=1, pool_maxsize=self.max_concurrency, max_retries=retry)
+        self._km.session.mount('http://', adapter)
+        self._km.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="km-async")
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+
+    async def __aenter__(self) -> "AsyncKMClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._km.session.close()
+
+    async def _call(self, fn: Callable[..., T], *args, deadline: Optional[float] = None) -> T:
+        async def run() -> T:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, partial(fn, *args))
+        return await asyncio.wait_for(run(), timeout=deadline or self.deadline)
+
+    async def status(self, deadline: Optional[float] = None) -> bool:
+        try:
+            return await self._call(self._km.status, deadline=deadline)
+        except asyncio.TimeoutError:
+            return False
+
+    async def request_key_with_verify(self, length: Optional[int] = None, deadline: Optional[float] = None) -> Tuple[str, bytes, bool]:
+        return await self._call(self._km.request_key_with_verify, length, deadline=deadline)
+
+    async def request_keys(self, n: int, length: Optional[int] = None, deadline: Optional[float] = None) -> List[Tuple[str, bytes, bool]]:
+        return await self._call(self._km.request_keys, n, length, deadline=deadline)
+
+    async def consume_with_verify(self, key_id: str, nbytes: int, deadline: Optional[float] = None) -> Tuple[int, bytes, bool]:
+        return await self._call(self._km.consume_with_verify, key_id, nbytes, deadline=deadline)
+
+    async def material_with_verify(self, key_id: str, nbytes: int, offset: int = 0, deadline: Optional[float] = None) -> Tuple[int, bytes, bool]:
+        return await self._call(self._km.material_with_verify, key_id, nbytes, offset, deadline=deadline)
+
+    async def consume_many(self, requests: Sequence[Tuple[str, int]], deadline: Optional[float] = None) -> List[Tuple[int, bytes, bool]]:
+        """Consume several ``(key_id, nbytes)`` slices concurrently, in request order."""
+        return list(await asyncio.gather(*(self.consume_with_verify(k, n, deadline=deadline) for k, n in requests)))
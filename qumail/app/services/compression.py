@@ -0,0 +1,249 @@
+import io
+import lzma
+import tempfile
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, Optional, Union
+
+# Parts smaller than this are never worth compressing
+COMPRESS_MIN_BYTES = 512
+# A prefix of this size is test-compressed to skip data that will not shrink
+SAMPLE_BYTES = 64 << 10
+# Skip compression unless the sample shrinks to at most this fraction
+MAX_SAMPLE_RATIO = 0.9
+# Highly compressible parts between these sizes also try lzma for the extra
+# saving. Smaller parts (message bodies) stay on zlib, where lzma's fixed
+# cost dominates and its output is often larger; larger ones stay on zlib,
+# which is several times faster
+LZMA_MIN_BYTES = 64 << 10
+LZMA_MAX_BYTES = 2 << 20
+LZMA_MAX_SAMPLE_RATIO = 0.5
+# Hard ceiling on decompressed output. The compression metadata is not
+# authenticated at every security level, so a declared size is not trusted past this
+MAX_DECOMPRESSED_BYTES = 256 << 20
+# Files are read, compressed and decompressed this many bytes at a time
+STREAM_CHUNK = 1 << 20
+
+
+class SpooledData:
+    """A part's bytes kept in an anonymous temporary file rather than in memory.
+
+    ``len()`` is the number of bytes written, so callers can size a key for it
+    like they would for ``bytes``.
+    """
+
+    def __init__(self) -> None:
+        self.file = tempfile.TemporaryFile()
+        self._size = 0
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+        self._size += len(data)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def reader(self) -> BinaryIO:
+        """The underlying file, rewound to the start."""
+        self.file.seek(0)
+        return self.file
+
+    def read(self) -> bytes:
+        return self.reader().read()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+@dataclass
+class CompressedPart:
+    data: Union[bytes, SpooledData]  # SpooledData for parts of spool_bytes or more
+    method: Optional[str]  # None when stored uncompressed
+    original_size: int
+
+
+def _sample_ratio(sample: bytes) -> float:
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def choose_method(data: bytes) -> Optional[str]:
+    """Pick a compression method for ``data`` from a cheap sample, or None to store it raw."""
+    if len(data) < COMPRESS_MIN_BYTES:
+        return None
+    ratio = _sample_ratio(bytes(data[:SAMPLE_BYTES]))
+    if ratio > MAX_SAMPLE_RATIO:
+        return None
+    if LZMA_MIN_BYTES <= len(data) <= LZMA_MAX_BYTES and ratio <= LZMA_MAX_SAMPLE_RATIO:
+        return "lzma"
+    return "zlib"
+
+
+def compress(data: bytes, method: Optional[str] = None) -> CompressedPart:
+    """Compress ``data`` if it pays off; falls back to the raw bytes otherwise.
+
+    When the method is picked automatically and lzma is a candidate, zlib is
+    tried too and the smaller output wins.
+    """
+    auto = method is None
+    method = method or choose_method(data)
+    if method is None:
+        return CompressedPart(data=data, method=None, original_size=len(data))
+    if method == "zlib":
+        out = zlib.compress(data, 6)
+    elif method == "lzma":
+        out = lzma.compress(data, preset=6)
+        if auto:
+            alt = zlib.compress(data, 6)
+            if len(alt) <= len(out):
+                method, out = "zlib", alt
+    else:
+        raise ValueError(f"Unsupported compression method: {method}")
+    if len(out) >= len(data):
+        return CompressedPart(data=data, method=None, original_size=len(data))
+    return CompressedPart(data=out, method=method, original_size=len(data))
+
+
+def compress_file(src: BinaryIO, spool_bytes: int, enabled: bool = True) -> CompressedPart:
+    """Compress the rest of the seekable file ``src`` with flat memory.
+
+    Output of ``spool_bytes`` or more stays in a :class:`SpooledData`; smaller
+    output is returned as bytes. Files smaller than ``spool_bytes`` go through
+    :func:`compress` in one piece. Large files only use zlib, streamed
+    ``STREAM_CHUNK`` bytes at a time, and are stored raw when it does not pay off.
+    """
+    start = src.tell()
+    size = src.seek(0, io.SEEK_END) - start
+    src.seek(start)
+    if size < spool_bytes:
+        data = src.read()
+        return compress(data) if enabled else CompressedPart(data=data, method=None, original_size=size)
+    method = None
+    if enabled:
+        sample = src.read(SAMPLE_BYTES)
+        src.seek(start)
+        if _sample_ratio(sample) <= MAX_SAMPLE_RATIO:
+            method = "zlib"
+    out = SpooledData()
+    c = zlib.compressobj(6) if method else None
+    while True:
+        chunk = src.read(STREAM_CHUNK)
+        if not chunk:
+            break
+        out.write(c.compress(chunk) if c else chunk)
+    if c:
+        out.write(c.flush())
+        if len(out) >= size:
+            out.close()
+            src.seek(start)
+            return compress_file(src, spool_bytes, enabled=False)
+    if len(out) < spool_bytes:
+        data = out.read()
+        out.close()
+        return CompressedPart(data=data, method=method, original_size=size)
+    return CompressedPart(data=out, method=method, original_size=size)
+
+
+def compress_many(
+    parts: List[Union[bytes, BinaryIO]],
+    enabled: bool = True,
+    spool_bytes: Optional[int] = None,
+) -> List[CompressedPart]:
+    """Compress every part. Parts may be bytes or seekable binary files.
+
+    With ``spool_bytes`` set, files and parts of at least that many bytes go
+    through :func:`compress_file`. Without it, files are read whole.
+    """
+    out = []
+    for p in parts:
+        if spool_bytes is not None and (not isinstance(p, (bytes, bytearray)) or len(p) >= spool_bytes):
+            out.append(compress_file(io.BytesIO(p) if isinstance(p, (bytes, bytearray)) else p, spool_bytes, enabled))
+            continue
+        if not isinstance(p, (bytes, bytearray)):
+            p = p.read()
+        out.append(compress(p) if enabled else CompressedPart(data=p, method=None, original_size=len(p)))
+    return out
+
+
+def decompress(data: bytes, method: Optional[str], original_size: Optional[int] = None) -> bytes:
+    """Inverse of :func:`compress`, with bounded output.
+
+    Decompression stops after ``original_size`` bytes (the size recorded by
+    the sender) or ``MAX_DECOMPRESSED_BYTES`` when none was recorded, and
+    anything that does not come out at exactly the recorded size is rejected,
+    so a crafted message cannot expand into a decompression bomb.
+    """
+    if not method:
+        return data
+    limit = MAX_DECOMPRESSED_BYTES if original_size is None else int(original_size)
+    if not 0 <= limit <= MAX_DECOMPRESSED_BYTES:
+        raise ValueError(f"Declared decompressed size {limit} exceeds the {MAX_DECOMPRESSED_BYTES} byte limit")
+    d = _decompressor(method)
+    # One byte over the limit is enough to tell an oversized stream apart
+    out = d.decompress(data, limit + 1)
+    if len(out) > limit:
+        raise ValueError(f"Decompressed part exceeds {limit} bytes")
+    if not d.eof:
+        raise ValueError("Truncated compressed part")
+    if original_size is not None and len(out) != original_size:
+        raise ValueError(f"Decompressed part is {len(out)} bytes, expected {original_size}")
+    return out
+
+
+def decompress_stream(src: BinaryIO, dst: BinaryIO, method: Optional[str], original_size: Optional[int] = None) -> int:
+    """Streaming :func:`decompress` from ``src`` into ``dst``; returns bytes written.
+
+    At most ``STREAM_CHUNK`` bytes of input or output are held at a time, and
+    the same size limits apply: output past the limit is rejected as soon as
+    it appears.
+    """
+    if not method:
+        written = 0
+        while True:
+            chunk = src.read(STREAM_CHUNK)
+            if not chunk:
+                return written
+            dst.write(chunk)
+            written += len(chunk)
+    limit = MAX_DECOMPRESSED_BYTES if original_size is None else int(original_size)
+    if not 0 <= limit <= MAX_DECOMPRESSED_BYTES:
+        raise ValueError(f"Declared decompressed size {limit} exceeds the {MAX_DECOMPRESSED_BYTES} byte limit")
+    d = _decompressor(method)
+    written = 0
+    while not d.eof:
+        data = src.read(STREAM_CHUNK)
+        if not data:
+            break
+        for out in _drain(d, data):
+            written += len(out)
+            if written > limit:
+                raise ValueError(f"Decompressed part exceeds {limit} bytes")
+            dst.write(out)
+    if not d.eof:
+        raise ValueError("Truncated compressed part")
+    if original_size is not None and written != original_size:
+        raise ValueError(f"Decompressed part is {written} bytes, expected {original_size}")
+    return written
+
+
+def _decompressor(method: str):
+    if method == "zlib":
+        return zlib.decompressobj()
+    if method == "lzma":
+        return lzma.LZMADecompressor()
+    raise ValueError(f"Unsupported compression method: {method}")
+
+
+def _drain(d, data: bytes) -> Iterator[bytes]:
+    """Feed ``data`` to ``d`` and yield its output ``STREAM_CHUNK`` bytes at a time."""
+    if isinstance(d, lzma.LZMADecompressor):
+        yield d.decompress(data, STREAM_CHUNK)
+        while not d.eof and not d.needs_input:
+            yield d.decompress(b"", STREAM_CHUNK)
+        return
+    while not d.eof:
+        out = d.decompress(data, STREAM_CHUNK)
+        yield out
+        data = d.unconsumed_tail
+        # A full chunk may leave output pending inside zlib even with no input left
+        if not data and len(out) < STREAM_CHUNK:
+            return
@@ -10,6 +10,16 @@ class KMConfig:
     peer_id: str
     default_key_length: int
     integrity_secret: str
+    otp_slab_length: int = 1 << 20
+    otp_slab_ttl: float = 7 * 86400.0
+    pool_depth: int = 8
+    pool_open_margin: float = 86400.0
+    binary_transport: bool = True
+    health_ttl: float = 5.0
+    breaker_failures: int = 3
+    breaker_reset: float = 10.0
+    retry_after_attempts: int = 3
+    retry_after_max: float = 10.0
 
 
 @dataclass
@@ -50,6 +60,16 @@ def load_config() -> AppConfig:
         peer_id=os.getenv("KM_PEER_ID", "Bob"),
         default_key_length=int(os.getenv("KM_DEFAULT_KEY_LENGTH", "4096")),
         integrity_secret=os.getenv("KM_INTEGRITY_SECRET", "change_this_demo_secret"),
+        otp_slab_length=int(os.getenv("KM_OTP_SLAB_LENGTH", str(1 << 20))),
+        otp_slab_ttl=float(os.getenv("KM_OTP_SLAB_TTL", str(7 * 86400))),
+        pool_depth=int(os.getenv("KM_POOL_DEPTH", "8")),
+        pool_open_margin=float(os.getenv("KM_POOL_OPEN_MARGIN", "86400")),
+        binary_transport=os.getenv("KM_BINARY_TRANSPORT", "true").lower() == "true",
+        health_ttl=float(os.getenv("KM_HEALTH_TTL", "5")),
+        breaker_failures=int(os.getenv("KM_BREAKER_FAILURES", "3")),
+        breaker_reset=float(os.getenv("KM_BREAKER_RESET", "10")),
+        retry_after_attempts=int(os.getenv("KM_RETRY_AFTER_ATTEMPTS", "3")),
+        retry_after_max=float(os.getenv("KM_RETRY_AFTER_MAX", "10")),
     )
     smtp = SMTPConfig(
         host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
@@ -1,13 +1,53 @@
+import io
 import os
 import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Literal, Tuple
+import time
+from typing import BinaryIO, Callable, Dict, List, Literal, Sequence, Tuple
 
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 
 SecurityLevel = Literal[1, 2, 3, 4]
+BytesLike = bytes | bytearray | memoryview
+
+# OTP XOR works on big-int blocks of this size; bounds temporaries for huge parts
+OTP_XOR_BLOCK = 1 << 20
+
+# Segmented AES-GCM: each chunk is sealed on its own with a nonce built from
+# a random 7-byte prefix, a 4-byte big-endian counter and a final-segment flag.
+STREAM_FORMAT = "gcm-stream-v1"
+STREAM_CHUNK_SIZE = 1 << 20
+STREAM_THRESHOLD = 4 << 20  # parts at least this large use the streaming format
+_STREAM_PREFIX_LEN = 7
+_GCM_TAG_LEN = 16
+
+# Number of derived Level 2/3 contexts kept for repeat decrypts (LRU, by key_id)
+CONTEXT_CACHE_SIZE = 64
+
+# Batch API: Level 2/3 parts are spread over a bounded thread pool (AEAD calls
+# release the GIL). Level 1 stays inline: big-int XOR holds the GIL, so threads
+# only add overhead. Batches smaller than PARALLEL_MIN_BYTES run inline, where
+# the pool costs more than it saves.
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+PARALLEL_MIN_BYTES = 256 << 10
+
+# AEAD backends by the name written to X-QuMail-Algo. Every backend takes a
+# 32-byte key and uses 12-byte nonces and 16-byte tags, so the one-shot and
+# streaming formats are shared. Level 2 is always AES-256-GCM; Level 3 uses
+# whichever registered cipher benchmarks fastest on this host.
+AEAD_CIPHERS: Dict[str, Callable[[bytes], object]] = {
+    "AES-256-GCM": AESGCM,
+    "ChaCha20-Poly1305": ChaCha20Poly1305,
+}
+LEVEL2_ALGO = "AES-256-GCM"
+_level3_algo: str | None = None
+_select_lock = threading.Lock()
 
 
 @dataclass
@@ -27,30 +67,119 @@ def _hkdf_derive(key_material: bytes, length: int = 32, salt: bytes | None = Non
     return hkdf.derive(key_material)
 
 
-def encrypt(level: SecurityLevel, plaintext: bytes, qkd_key_material: bytes | None = None) -> CryptoResult:
-    if level == 4:
-        return CryptoResult(algo="PLAINTEXT", ciphertext=plaintext, metadata={})
+def otp_xor(data: BytesLike, key: BytesLike) -> bytes:
+    """XOR ``data`` with the leading ``len(data)`` bytes of ``key``.
+
+    Each block is turned into a Python int so the XOR runs word-wide in C
+    rather than once per byte in the interpreter.
+    """
+    d = memoryview(data).cast("B")
+    k = memoryview(key).cast("B")
+    n = len(d)
+    if len(k) < n:
+        raise ValueError("OTP requires key length >= data length")
+    out = []
+    for start in range(0, n, OTP_XOR_BLOCK):
+        end = min(start + OTP_XOR_BLOCK, n)
+        x = int.from_bytes(d[start:end], "little") ^ int.from_bytes(k[start:end], "little")
+        out.append(x.to_bytes(end - start, "little"))
+    return out[0] if len(out) == 1 else b"".join(out)
+
+
+def register_cipher(name: str, factory: Callable[[bytes], object]) -> None:
+    """Add an AEAD backend; ``factory(key)`` must return an object with encrypt/decrypt(nonce, data, aad)."""
+    global _level3_algo
+    AEAD_CIPHERS[name] = factory
+    _level3_algo = None  # re-run selection with the new candidate
+
+
+def _bench_cipher(factory: Callable[[bytes], object], sample: bytes, rounds: int) -> float:
+    aead = factory(os.urandom(32))
+    nonce = os.urandom(12)
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        aead.encrypt(nonce, sample, b"qumail-bench")
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def select_level3_cipher(sample_size: int = 256 << 10, rounds: int = 5) -> str:
+    """Benchmark every registered AEAD and remember the fastest for Level 3.
+
+    Meant to run once at startup; on hosts without AES instructions this
+    usually picks ChaCha20-Poly1305.
+    """
+    global _level3_algo
+    sample = os.urandom(sample_size)
+    timings = {}
+    for name, factory in list(AEAD_CIPHERS.items()):
+        try:
+            timings[name] = _bench_cipher(factory, sample, rounds)
+        except Exception:
+            # backend unavailable in this build (e.g. FIPS mode)
+            continue
+    with _select_lock:
+        _level3_algo = min(timings, key=timings.get) if timings else LEVEL2_ALGO
+        return _level3_algo
+
+
+def level3_algo() -> str:
+    algo = _level3_algo
+    return algo if algo is not None else select_level3_cipher()
+
+
+def _level_aad(level: SecurityLevel) -> bytes:
+    return b"qumail-level" + (b"2" if level == 2 else b"3")
 
-    if level == 1:
-        if qkd_key_material is None:
-            raise ValueError("Level 1 (OTP) requires QKD key material")
-        if len(qkd_key_material) < len(plaintext):
-            raise ValueError("OTP requires key length >= plaintext length")
-        ct = bytes([p ^ k for p, k in zip(plaintext, qkd_key_material[: len(plaintext)])])
-        return CryptoResult(algo="OTP", ciphertext=ct, metadata={"otp_bytes": len(plaintext)})
 
-    if level in (2, 3):
-        if qkd_key_material is None:
+def _stream_nonce(prefix: bytes, counter: int, final: bool) -> bytes:
+    if counter >= 1 << 32:
+        raise ValueError("Too many segments for streaming AES-GCM")
+    return prefix + counter.to_bytes(4, "big") + (b"\x01" if final else b"\x00")
+
+
+class CryptoContext:
+    """Message-scoped cipher state.
+
+    The AEAD key is derived from the QKD material once and a single AEAD object
+    is reused for the body and every attachment of a message. ``algo`` picks
+    the backend for Level 2/3 (decrypt passes the X-QuMail-Algo value).
+    """
+
+    def __init__(self, level: SecurityLevel, qkd_key_material: BytesLike | None = None, algo: str | None = None):
+        if level not in (1, 2, 3, 4):
+            raise ValueError("Unsupported security level")
+        if level == 1 and qkd_key_material is None:
+            raise ValueError("Level 1 (OTP) requires QKD key material")
+        if level in (2, 3) and qkd_key_material is None:
             raise ValueError("Level 2/3 requires QKD key material")
-        # Level 2: AES-256-GCM with HKDF from QKD material
-        # Level 3: same mechanism for now (placeholder for PQC/hybrid)
-        aes_key = _hkdf_derive(qkd_key_material, 32)
-        aesgcm = AESGCM(aes_key)
+        self.level = level
+        self.qkd_key_material = qkd_key_material
+        self._aead = None
+        self.algo = {1: "OTP", 4: "PLAINTEXT"}.get(level)
+        if level in (2, 3):
+            # Level 2: AES-256-GCM with HKDF from QKD material
+            # Level 3: fastest registered AEAD on this host, same derivation
+            self.algo = algo or (LEVEL2_ALGO if level == 2 else level3_algo())
+            factory = AEAD_CIPHERS.get(self.algo)
+            if factory is None:
+                raise ValueError(f"Unsupported cipher: {self.algo}")
+            self._aead = factory(_hkdf_derive(qkd_key_material, 32))
+
+    def encrypt(self, plaintext: BytesLike) -> CryptoResult:
+        if self.level == 4:
+            return CryptoResult(algo="PLAINTEXT", ciphertext=bytes(plaintext), metadata={})
+        if self.level == 1:
+            if len(self.qkd_key_material) < len(plaintext):
+                raise ValueError("OTP requires key length >= plaintext length")
+            ct = otp_xor(plaintext, self.qkd_key_material)
+            return CryptoResult(algo="OTP", ciphertext=ct, metadata={"otp_bytes": len(plaintext)})
         nonce = os.urandom(12)
-        aad = b"qumail-level" + (b"2" if level == 2 else b"3")
-        ct = aesgcm.encrypt(nonce, plaintext, aad)
+        aad = _level_aad(self.level)
+        ct = self._aead.encrypt(nonce, plaintext, aad)
         return CryptoResult(
-            algo="AES-256-GCM",
+            algo=self.algo,
             ciphertext=ct,
             metadata={
                 "nonce_b64": base64.b64encode(nonce).decode(),
@@ -58,33 +187,304 @@ def encrypt(level: SecurityLevel, plaintext: bytes, qkd_key_material: bytes | No
             },
         )
 
-    raise ValueError("Unsupported security level")
-
-
-def decrypt(level: SecurityLevel, ciphertext: bytes, qkd_key_material: bytes | None = None, metadata: dict | None = None) -> bytes:
-    metadata = metadata or {}
-    if level == 4:
-        return ciphertext
-
-    if level == 1:
-        if qkd_key_material is None:
-            raise ValueError("Level 1 (OTP) requires QKD key material")
-        if len(qkd_key_material) < len(ciphertext):
-            raise ValueError("OTP requires key length >= ciphertext length")
-        pt = bytes([c ^ k for c, k in zip(ciphertext, qkd_key_material[: len(ciphertext)])])
-        return pt
-
-    if level in (2, 3):
-        if qkd_key_material is None:
-            raise ValueError("Level 2/3 requires QKD key material")
-        aes_key = _hkdf_derive(qkd_key_material, 32)
-        aesgcm = AESGCM(aes_key)
+    def decrypt(self, ciphertext: BytesLike, metadata: dict | None = None) -> bytes:
+        metadata = metadata or {}
+        if self.level == 4:
+            return bytes(ciphertext)
+        if self.level == 1:
+            if len(self.qkd_key_material) < len(ciphertext):
+                raise ValueError("OTP requires key length >= ciphertext length")
+            return otp_xor(ciphertext, self.qkd_key_material)
+        if metadata.get("format") == STREAM_FORMAT:
+            out = io.BytesIO()
+            self.decrypt_stream(io.BytesIO(ciphertext), out, metadata)
+            return out.getvalue()
         nonce_b64 = metadata.get("nonce_b64")
         if not nonce_b64:
             raise ValueError("Missing nonce for AES-GCM decryption")
         nonce = base64.b64decode(nonce_b64)
         aad = metadata.get("aad", "").encode()
-        pt = aesgcm.decrypt(nonce, ciphertext, aad)
-        return pt
+        return self._aead.decrypt(nonce, ciphertext, aad)
+
+    def stream_metadata(self, chunk_size: int = STREAM_CHUNK_SIZE) -> dict:
+        """Fresh metadata (random nonce prefix) for one :meth:`encrypt_stream` call."""
+        if self._aead is None:
+            raise ValueError("Streaming encryption is only available for Level 2/3")
+        return {
+            "format": STREAM_FORMAT,
+            "nonce_b64": base64.b64encode(os.urandom(_STREAM_PREFIX_LEN)).decode(),
+            "chunk_size": chunk_size,
+            "aad": _level_aad(self.level).decode(),
+        }
+
+    def encrypt_stream(
+        self,
+        src: BinaryIO,
+        dst: BinaryIO,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+        metadata: dict | None = None,
+    ) -> dict:
+        """Encrypt ``src`` into ``dst`` chunk by chunk (Level 2/3 only).
+
+        Only one chunk of plaintext and ciphertext is held at a time. Returns
+        the metadata needed by :meth:`decrypt_stream`. Writers that must emit
+        the metadata before the ciphertext pass it in from
+        :meth:`stream_metadata`; it must not be reused for another stream.
+        """
+        if self._aead is None:
+            raise ValueError("Streaming encryption is only available for Level 2/3")
+        if metadata is None:
+            metadata = self.stream_metadata(chunk_size)
+        aad = metadata["aad"].encode()
+        prefix = base64.b64decode(metadata["nonce_b64"])
+        chunk_size = int(metadata["chunk_size"])
+        counter = 0
+        chunk = src.read(chunk_size)
+        while True:
+            nxt = src.read(chunk_size)
+            final = not nxt
+            dst.write(self._aead.encrypt(_stream_nonce(prefix, counter, final), chunk, aad))
+            if final:
+                break
+            chunk = nxt
+            counter += 1
+        return metadata
+
+    def decrypt_stream(self, src: BinaryIO, dst: BinaryIO, metadata: dict) -> int:
+        """Decrypt a stream produced by :meth:`encrypt_stream`; returns bytes written.
+
+        A missing or reordered final segment fails authentication, so truncated
+        ciphertext is rejected rather than silently shortened.
+        """
+        if self._aead is None:
+            raise ValueError("Streaming decryption is only available for Level 2/3")
+        if metadata.get("format") != STREAM_FORMAT:
+            raise ValueError("Metadata does not describe a streamed ciphertext")
+        prefix = base64.b64decode(metadata["nonce_b64"])
+        seg_size = int(metadata["chunk_size"]) + _GCM_TAG_LEN
+        aad = metadata.get("aad", "").encode()
+        written = 0
+        counter = 0
+        seg = src.read(seg_size)
+        while True:
+            nxt = src.read(seg_size)
+            final = not nxt
+            pt = self._aead.decrypt(_stream_nonce(prefix, counter, final), seg, aad)
+            dst.write(pt)
+            written += len(pt)
+            if final:
+                return written
+            seg = nxt
+            counter += 1
+
+    def file_metadata(self, size: int) -> dict:
+        """Metadata for encrypting a ``size``-byte part with :meth:`encrypt_file`."""
+        if self.level == 1:
+            return {"otp_bytes": size}
+        if self._aead is not None:
+            return self.stream_metadata()
+        return {}
+
+    def encrypt_file(self, src: BinaryIO, dst: BinaryIO, metadata: dict, key_offset: int = 0) -> None:
+        """Encrypt a whole part from ``src`` into ``dst`` at any level, with flat memory.
+
+        ``metadata`` comes from :meth:`file_metadata`. Level 2/3 use the
+        segmented format; Level 1 XORs each block against the pad starting at
+        ``key_offset`` in the key material.
+        """
+        if self.level == 1:
+            self._otp_xor_file(src, dst, key_offset)
+        elif self._aead is not None:
+            self.encrypt_stream(src, dst, metadata=metadata)
+        else:
+            _copy_file(src, dst)
+
+    def decrypt_file(self, src: BinaryIO, dst: BinaryIO, metadata: dict | None = None, key_offset: int = 0) -> None:
+        """Inverse of :meth:`encrypt_file`; single-shot Level 2/3 parts are decrypted in memory."""
+        metadata = metadata or {}
+        if self.level == 1:
+            self._otp_xor_file(src, dst, key_offset)
+        elif self._aead is not None and metadata.get("format") == STREAM_FORMAT:
+            self.decrypt_stream(src, dst, metadata)
+        elif self._aead is not None:
+            dst.write(self.decrypt(src.read(), metadata))
+        else:
+            _copy_file(src, dst)
+
+    def _otp_xor_file(self, src: BinaryIO, dst: BinaryIO, key_offset: int) -> None:
+        key = memoryview(self.qkd_key_material).cast("B")
+        off = key_offset
+        while True:
+            block = src.read(OTP_XOR_BLOCK)
+            if not block:
+                return
+            end = off + len(block)
+            if off < 0 or end > len(key):
+                raise ValueError("OTP requires key length >= data length")
+            dst.write(otp_xor(block, key[off:end]))
+            off = end
+
+    def encrypt_part(self, data: BytesLike) -> CryptoResult:
+        """Encrypt one in-memory MIME part, sealing large Level 2/3 parts in fixed-size segments."""
+        if self._aead is not None and len(data) >= STREAM_THRESHOLD:
+            out = io.BytesIO()
+            meta = self.encrypt_stream(io.BytesIO(data), out)
+            return CryptoResult(algo=self.algo, ciphertext=out.getvalue(), metadata=meta)
+        return self.encrypt(data)
+
+    def encrypt_many(self, parts: Sequence[BytesLike], key_offsets: Sequence[int] | None = None) -> List[CryptoResult]:
+        """Encrypt several parts (Level 2/3 concurrently); results keep the input order.
+
+        For Level 1, ``key_offsets`` gives where each part's pad starts within
+        the context's key material (default: every part starts at 0).
+        """
+        if self.level == 1:
+            pads = self._otp_pads([len(p) for p in parts], key_offsets)
+            return [
+                CryptoResult(algo="OTP", ciphertext=ct, metadata={"otp_bytes": len(p)})
+                for p, ct in zip(parts, _otp_xor_many(parts, pads))
+            ]
+        if not _use_pool(parts):
+            return [self.encrypt_part(p) for p in parts]
+        return list(_pool().map(self.encrypt_part, parts))
+
+    def decrypt_many(
+        self,
+        items: Sequence[Tuple[BytesLike, dict | None]],
+        key_offsets: Sequence[int] | None = None,
+    ) -> List[bytes]:
+        """Decrypt ``(ciphertext, metadata)`` pairs (Level 2/3 concurrently), in input order."""
+        if self.level == 1:
+            cts = [ct for ct, _ in items]
+            return _otp_xor_many(cts, self._otp_pads([len(ct) for ct in cts], key_offsets))
+        if not _use_pool([ct for ct, _ in items]):
+            return [self.decrypt(ct, meta) for ct, meta in items]
+        return list(_pool().map(lambda item: self.decrypt(*item), items))
+
+    def _otp_pads(self, lengths: Sequence[int], key_offsets: Sequence[int] | None) -> List[memoryview]:
+        key = memoryview(self.qkd_key_material).cast("B")
+        offsets = key_offsets if key_offsets is not None else [0] * len(lengths)
+        pads = []
+        for n, off in zip(lengths, offsets):
+            if off < 0 or off + n > len(key):
+                raise ValueError("OTP requires key length >= data length")
+            pads.append(key[off:off + n])
+        return pads
+
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="qumail-crypto")
+        return _executor
+
+
+def _copy_file(src: BinaryIO, dst: BinaryIO) -> None:
+    while True:
+        chunk = src.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        dst.write(chunk)
+
+
+def _use_pool(parts: Sequence[BytesLike]) -> bool:
+    return MAX_WORKERS > 1 and sum(len(p) for p in parts) >= PARALLEL_MIN_BYTES
+
+
+def _otp_xor_many(parts: Sequence[BytesLike], pads: Sequence[BytesLike]) -> List[bytes]:
+    # Inline on purpose: int.from_bytes/^/to_bytes never drop the GIL
+    return [otp_xor(p, k) for p, k in zip(parts, pads)]
+
+
+_context_cache: "OrderedDict[tuple, CryptoContext]" = OrderedDict()
+_context_lock = threading.Lock()
+
+
+def get_context(
+    level: SecurityLevel,
+    qkd_key_material: BytesLike | None,
+    key_id: str | None = None,
+    algo: str | None = None,
+) -> CryptoContext:
+    """Return a :class:`CryptoContext`, reusing a cached one for repeat decrypts of ``key_id``.
+
+    Only Level 2/3 contexts are cached; the cache key includes a digest of the
+    material so a different (e.g. tampered) slice never hits a stale entry.
+    """
+    if key_id is None or level not in (2, 3) or qkd_key_material is None:
+        return CryptoContext(level, qkd_key_material, algo)
+    if algo is None:
+        algo = LEVEL2_ALGO if level == 2 else level3_algo()
+    cache_key = (key_id, level, algo, hashlib.sha256(qkd_key_material).digest())
+    with _context_lock:
+        ctx = _context_cache.get(cache_key)
+        if ctx is not None:
+            _context_cache.move_to_end(cache_key)
+            return ctx
+    ctx = CryptoContext(level, qkd_key_material, algo)
+    with _context_lock:
+        _context_cache[cache_key] = ctx
+        while len(_context_cache) > CONTEXT_CACHE_SIZE:
+            _context_cache.popitem(last=False)
+    return ctx
+
+
+def encrypt_stream(
+    level: SecurityLevel,
+    src: BinaryIO,
+    dst: BinaryIO,
+    qkd_key_material: BytesLike | None,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> dict:
+    return CryptoContext(level, qkd_key_material).encrypt_stream(src, dst, chunk_size)
+
+
+def decrypt_stream(
+    level: SecurityLevel,
+    src: BinaryIO,
+    dst: BinaryIO,
+    qkd_key_material: BytesLike | None,
+    metadata: dict,
+    algo: str | None = None,
+) -> int:
+    return CryptoContext(level, qkd_key_material, algo).decrypt_stream(src, dst, metadata)
+
+
+def encrypt_many(
+    level: SecurityLevel,
+    parts: Sequence[BytesLike],
+    qkd_key_material: BytesLike | None = None,
+    key_id: str | None = None,
+    key_offsets: Sequence[int] | None = None,
+) -> List[CryptoResult]:
+    return get_context(level, qkd_key_material, key_id).encrypt_many(parts, key_offsets)
+
+
+def decrypt_many(
+    level: SecurityLevel,
+    items: Sequence[Tuple[BytesLike, dict | None]],
+    qkd_key_material: BytesLike | None = None,
+    key_id: str | None = None,
+    algo: str | None = None,
+    key_offsets: Sequence[int] | None = None,
+) -> List[bytes]:
+    return get_context(level, qkd_key_material, key_id, algo).decrypt_many(items, key_offsets)
+
+
+def encrypt(level: SecurityLevel, plaintext: BytesLike, qkd_key_material: BytesLike | None = None) -> CryptoResult:
+    return CryptoContext(level, qkd_key_material).encrypt(plaintext)
+
 
-    raise ValueError("Unsupported security level")
+def decrypt(
+    level: SecurityLevel,
+    ciphertext: BytesLike,
+    qkd_key_material: BytesLike | None = None,
+    metadata: dict | None = None,
+    algo: str | None = None,
+) -> bytes:
+    return CryptoContext(level, qkd_key_material, algo).decrypt(ciphertext, metadata)
@@ -1,16 +1,31 @@
 import base64
 import ast
+import binascii
+import io
 import mimetypes
+import os
+import re
 import smtplib
 import ssl
 import imaplib
 import email
+import tempfile
 from email.message import EmailMessage
+from email.parser import BytesParser
 from email import policy
-from typing import List, Tuple, Optional
+from typing import BinaryIO, Callable, Iterator, List, Tuple, Optional
 
 from .config import SMTPConfig, IMAPConfig
 from . import crypto_service
+from . import compression
+from .compression import CompressedPart, SpooledData
+
+# Whole-message IMAP downloads fetch this many bytes per request
+FETCH_CHUNK = 1 << 20
+# Streamed SMTP DATA goes out in writes of about this size
+SMTP_SEND_BYTES = 64 << 10
+# Base64 text decoded per step when reading a message file
+B64_DECODE_BYTES = 1 << 20
 
 
 class EmailService:
@@ -18,31 +33,172 @@ class EmailService:
         self.smtp_cfg = smtp_cfg
         self.imap_cfg = imap_cfg
 
-    def send_email(
+    def prepare_parts(
+        self,
+        body: bytes,
+        attachments: List[Tuple[str, bytes | BinaryIO]] | None,
+        compress: bool = True,
+    ) -> List[CompressedPart]:
+        """Compress the body and attachments (body first) ahead of encryption.
+
+        The summed ``len(part.data)`` is how much OTP key material a Level 1
+        send needs, so callers size their KM request from it.
+
+        Attachments may be seekable binary files instead of bytes. Parts of
+        ``STREAM_THRESHOLD`` bytes or more are compressed chunk by chunk into
+        temporary files (:class:`~.compression.SpooledData`) and later
+        encrypted straight into the outgoing message.
+        """
+        return compression.compress_many(
+            [body] + [data for _, data in attachments or []],
+            enabled=compress,
+            spool_bytes=crypto_service.STREAM_THRESHOLD,
+        )
+
+    def build_message(
+        self,
+        sender: str,
+        recipients: List[str],
+        subject: str,
+        body: bytes,
+        attachments: List[Tuple[str, bytes | BinaryIO]] | None,
+        level: crypto_service.SecurityLevel,
+        qkd_key_material: Optional[bytes],
+        key_id: Optional[str] = None,
+        key_offset: Optional[int] = None,
+        key_bytes: Optional[int] = None,
+        tampered: Optional[bool] = None,
+        prepared: Optional[List[CompressedPart]] = None,
+        compress: bool = True,
+        part_key_offsets: Optional[List[int]] = None,
+    ) -> EmailMessage:
+        """Encrypt the body and attachments and return the MIME message, without sending it.
+
+        ``prepared`` is the output of :meth:`prepare_parts` when the caller
+        already compressed the parts to size its key request.
+        ``part_key_offsets`` (Level 1) are absolute key offsets, body first, from
+        an :class:`~.key_slab.OTPAllocation`; ``qkd_key_material`` then starts
+        at ``key_offset``. Each part records its own offset and length.
+
+        The returned message holds every part in memory; :meth:`write_message`
+        and :meth:`send_email` stream spooled parts instead.
+        """
+        msg, _ = self._assemble(
+            sender, recipients, subject, body, attachments, level, qkd_key_material,
+            key_id, key_offset, key_bytes, tampered, prepared, compress, part_key_offsets, stream=False,
+        )
+        return msg
+
+    def write_message(
         self,
+        out: BinaryIO,
         sender: str,
         recipients: List[str],
         subject: str,
         body: bytes,
-        attachments: List[Tuple[str, bytes]] | None,
+        attachments: List[Tuple[str, bytes | BinaryIO]] | None,
         level: crypto_service.SecurityLevel,
         qkd_key_material: Optional[bytes],
         key_id: Optional[str] = None,
         key_offset: Optional[int] = None,
         key_bytes: Optional[int] = None,
         tampered: Optional[bool] = None,
+        prepared: Optional[List[CompressedPart]] = None,
+        compress: bool = True,
+        part_key_offsets: Optional[List[int]] = None,
     ) -> None:
-        # Encrypt application payload (body) and each attachment
-        enc = crypto_service.encrypt(level, body, qkd_key_material)
+        """Write the message :meth:`build_message` would build to ``out``, with CRLF line endings.
+
+        Spooled parts (see :meth:`prepare_parts`) are encrypted, base64-encoded
+        and written one segment at a time, so memory stays flat however large
+        they are.
+        """
+        msg, streams = self._assemble(
+            sender, recipients, subject, body, attachments, level, qkd_key_material,
+            key_id, key_offset, key_bytes, tampered, prepared, compress, part_key_offsets, stream=True,
+        )
+        raw = msg.as_bytes(policy=policy.SMTP)
+        for placeholder, encrypt in streams:
+            head, raw = raw.split(placeholder, 1)
+            out.write(head)
+            lines = _Base64Lines(out)
+            encrypt(lines)
+            lines.flush()
+        out.write(raw)
+
+    def _assemble(
+        self,
+        sender: str,
+        recipients: List[str],
+        subject: str,
+        body: bytes,
+        attachments: List[Tuple[str, bytes | BinaryIO]] | None,
+        level: crypto_service.SecurityLevel,
+        qkd_key_material: Optional[bytes],
+        key_id: Optional[str],
+        key_offset: Optional[int],
+        key_bytes: Optional[int],
+        tampered: Optional[bool],
+        prepared: Optional[List[CompressedPart]],
+        compress: bool,
+        part_key_offsets: Optional[List[int]],
+        stream: bool,
+    ) -> Tuple[EmailMessage, List[Tuple[bytes, Callable[[BinaryIO], None]]]]:
+        """Build the message; with ``stream`` spooled parts get a placeholder payload.
+
+        Returns the message and, per placeholder, its serialized base64 line
+        and a function that encrypts the part into a file-like sink.
+        """
+        attachments = attachments or []
+        if prepared is None:
+            prepared = self.prepare_parts(body, attachments, compress)
+        # Encrypt application payload (body) and each attachment with one derived
+        # context; in-memory parts run concurrently on the crypto thread pool
+        ctx = crypto_service.get_context(level, qkd_key_material)
+        rel_offsets = [0] * len(prepared)
+        if part_key_offsets is not None:
+            rel_offsets = [off - int(key_offset or 0) for off in part_key_offsets]
+        inline = [i for i, p in enumerate(prepared) if not isinstance(p.data, SpooledData)]
+        payloads: List[Optional[bytes]] = [None] * len(prepared)
+        metas: List[dict] = [{} for _ in prepared]
+        encs = ctx.encrypt_many(
+            [prepared[i].data for i in inline],
+            key_offsets=[rel_offsets[i] for i in inline] if part_key_offsets is not None else None,
+        )
+        for i, e in zip(inline, encs):
+            payloads[i], metas[i] = e.ciphertext, e.metadata
+        # Spooled parts are encrypted file to file, while the message is written
+        streams: List[Tuple[bytes, Callable[[BinaryIO], None]]] = []
+        for i, p in enumerate(prepared):
+            if payloads[i] is not None:
+                continue
+            metas[i] = ctx.file_metadata(len(p.data))
+
+            def encrypt(dst: BinaryIO, src: SpooledData = p.data, meta: dict = metas[i], off: int = rel_offsets[i]) -> None:
+                ctx.encrypt_file(src.reader(), dst, meta, off)
+
+            if stream:
+                token = os.urandom(45)
+                payloads[i] = token
+                streams.append((base64.b64encode(token) + b"\r\n", encrypt))
+            else:
+                buf = io.BytesIO()
+                encrypt(buf)
+                payloads[i] = buf.getvalue()
+        for p, meta in zip(prepared, metas):
+            if p.method:
+                meta["compression"] = p.method
+                meta["original_size"] = p.original_size
+        meta_body, *att_metas = metas
 
         msg = EmailMessage()
         msg["From"] = sender
         msg["To"] = ", ".join(recipients)
         msg["Subject"] = subject
         msg["X-QuMail-Level"] = str(level)
-        msg["X-QuMail-Algo"] = enc.algo
-        if enc.metadata:
-            msg["X-QuMail-Meta"] = base64.b64encode(str(enc.metadata).encode()).decode()
+        msg["X-QuMail-Algo"] = ctx.algo
+        if meta_body:
+            msg["X-QuMail-Meta"] = base64.b64encode(str(meta_body).encode()).decode()
         if key_id is not None:
             msg["X-QuMail-KeyId"] = key_id
         if key_offset is not None:
@@ -52,53 +208,101 @@ class EmailService:
         if tampered is not None:
             msg["X-QuMail-KMTampered"] = "true" if tampered else "false"
 
+        def key_range_headers(i: int) -> List[str]:
+            if part_key_offsets is None:
+                return []
+            return [
+                f"X-QuMail-KeyOffset: {int(part_key_offsets[i])}",
+                f"X-QuMail-KeyBytes: {len(prepared[i].data)}",
+            ]
+
         # Add encrypted body as base64 payload
         msg.set_content("QuMail encrypted content. Use QuMail to decrypt.")
         msg.add_attachment(
-            enc.ciphertext,
+            payloads[0],
             maintype="application",
             subtype="octet-stream",
             filename="body.enc",
+            headers=key_range_headers(0) or None,
         )
 
-        # Attach files (encrypt each)
-        attachments = attachments or []
-        for fname, data in attachments:
-            aenc = crypto_service.encrypt(level, data, qkd_key_material)
+        # Attach encrypted files
+        for i, ((fname, _), ameta) in enumerate(zip(attachments, att_metas), start=1):
             maintype, subtype = (mimetypes.guess_type(fname)[0] or "application/octet-stream").split("/")
             # Store encrypted attachment with per-part metadata header
-            part_headers = []
-            if aenc.metadata:
-                part_headers.append(("X-QuMail-Meta", base64.b64encode(str(aenc.metadata).encode()).decode()))
+            part_headers = key_range_headers(i)
+            # Always set it when the body has metadata, otherwise the part would inherit it
+            if ameta or meta_body:
+                part_headers.append("X-QuMail-Meta: " + base64.b64encode(str(ameta).encode()).decode())
             msg.add_attachment(
-                aenc.ciphertext,
+                payloads[i],
                 maintype=maintype,
                 subtype=subtype,
                 filename=fname + ".enc",
                 headers=part_headers or None,
             )
 
-        # Send via SMTP
-        if self.smtp_cfg.use_starttls:
-            context = ssl.create_default_context()
-            with smtplib.SMTP(self.smtp_cfg.host, self.smtp_cfg.port) as server:
+        return msg, streams
+
+    def send_email(
+        self,
+        sender: str,
+        recipients: List[str],
+        subject: str,
+        body: bytes,
+        attachments: List[Tuple[str, bytes | BinaryIO]] | None,
+        level: crypto_service.SecurityLevel,
+        qkd_key_material: Optional[bytes],
+        key_id: Optional[str] = None,
+        key_offset: Optional[int] = None,
+        key_bytes: Optional[int] = None,
+        tampered: Optional[bool] = None,
+        prepared: Optional[List[CompressedPart]] = None,
+        compress: bool = True,
+        part_key_offsets: Optional[List[int]] = None,
+    ) -> None:
+        """Encrypt and send the message.
+
+        Messages with spooled parts are written to a temporary file and sent
+        from it in segments; the rest go through ``send_message`` as before.
+        """
+        if prepared is None:
+            prepared = self.prepare_parts(body, attachments, compress)
+        spooled = any(isinstance(p.data, SpooledData) for p in prepared)
+        args = (sender, recipients, subject, body, attachments, level, qkd_key_material)
+        kwargs = dict(
+            key_id=key_id, key_offset=key_offset, key_bytes=key_bytes, tampered=tampered,
+            prepared=prepared, compress=compress, part_key_offsets=part_key_offsets,
+        )
+        if spooled:
+            with tempfile.TemporaryFile() as wire:
+                self.write_message(wire, *args, **kwargs)
+                with self._smtp() as server:
+                    _send_data(server, sender, recipients, wire)
+            return
+        msg = self.build_message(*args, **kwargs)
+        with self._smtp() as server:
+            server.send_message(msg)
+
+    def _smtp(self) -> smtplib.SMTP:
+        """A logged-in SMTP connection (use it as a context manager)."""
+        server = smtplib.SMTP(self.smtp_cfg.host, self.smtp_cfg.port)
+        try:
+            if self.smtp_cfg.use_starttls:
+                context = ssl.create_default_context()
                 server.ehlo()
                 server.starttls(context=context)
                 server.ehlo()
-                server.login(self.smtp_cfg.username, self.smtp_cfg.password)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(self.smtp_cfg.host, self.smtp_cfg.port) as server:
-                server.login(self.smtp_cfg.username, self.smtp_cfg.password)
-                server.send_message(msg)
+            server.login(self.smtp_cfg.username, self.smtp_cfg.password)
+        except Exception:
+            server.close()
+            raise
+        return server
 
     def list_inbox(self, mailbox: str = "INBOX", limit: int = 20) -> List[Tuple[str, str]]:
         """Return list of (uid, subject)."""
         items: List[Tuple[str, str]] = []
-        if self.imap_cfg.use_ssl:
-            M = imaplib.IMAP4_SSL(self.imap_cfg.host, self.imap_cfg.port)
-        else:
-            M = imaplib.IMAP4(self.imap_cfg.host, self.imap_cfg.port)
+        M = self._imap()
         try:
             M.login(self.imap_cfg.username, self.imap_cfg.password)
             M.select(mailbox)
@@ -120,10 +324,7 @@ class EmailService:
         return items
 
     def fetch_message(self, uid: str, mailbox: str = "INBOX") -> EmailMessage | None:
-        if self.imap_cfg.use_ssl:
-            M = imaplib.IMAP4_SSL(self.imap_cfg.host, self.imap_cfg.port)
-        else:
-            M = imaplib.IMAP4(self.imap_cfg.host, self.imap_cfg.port)
+        M = self._imap()
         try:
             M.login(self.imap_cfg.username, self.imap_cfg.password)
             M.select(mailbox)
@@ -138,52 +339,346 @@ class EmailService:
             except Exception:
                 pass
 
+    def fetch_message_file(self, uid: str, mailbox: str = "INBOX") -> BinaryIO | None:
+        """Download a message into an anonymous temporary file, ``FETCH_CHUNK`` bytes per FETCH.
+
+        Unlike :meth:`fetch_message` the message is never held whole in memory.
+        Read its headers with :func:`read_headers` and open it with
+        :meth:`decrypt_message_file`.
+        """
+        M = self._imap()
+        try:
+            M.login(self.imap_cfg.username, self.imap_cfg.password)
+            M.select(mailbox)
+            typ, data = M.fetch(uid, '(RFC822.SIZE)')
+            m = re.search(rb'RFC822\.SIZE (\d+)', _fetch_line(data)) if typ == 'OK' else None
+            if not m:
+                return None
+            size = int(m.group(1))
+            out = tempfile.TemporaryFile()
+            while out.tell() < size:
+                typ, data = M.fetch(uid, f'(BODY[]<{out.tell()}.{FETCH_CHUNK}>)')
+                chunk = next((d[1] for d in data if isinstance(d, tuple)), b"") if typ == 'OK' else b""
+                if not chunk:
+                    break
+                out.write(chunk)
+            out.seek(0)
+            return out
+        finally:
+            try:
+                M.logout()
+            except Exception:
+                pass
+
+    def _imap(self) -> imaplib.IMAP4:
+        if self.imap_cfg.use_ssl:
+            return imaplib.IMAP4_SSL(self.imap_cfg.host, self.imap_cfg.port)
+        return imaplib.IMAP4(self.imap_cfg.host, self.imap_cfg.port)
+
     def decrypt_message(
         self,
         msg: EmailMessage,
         qkd_key_material: Optional[bytes],
     ) -> Tuple[str, List[Tuple[str, bytes]]]:
-        """Return (decrypted_body_text, attachments list)."""
-        level_str = msg.get('X-QuMail-Level', '4')
-        try:
-            level = int(level_str)
-        except Exception:
-            level = 4
-        algo = msg.get('X-QuMail-Algo', '')
+        """Return (decrypted_body_text, attachments list).
 
-        # Find encrypted body attachment
-        dec_body = ""
-        dec_attachments: List[Tuple[str, bytes]] = []
+        Every part is decoded and decrypted in memory; use
+        :meth:`decrypt_message_file` on :meth:`fetch_message_file` output to
+        keep memory flat for large attachments.
+        """
+        level, ctx = self._context_for(msg, qkd_key_material)
+
+        # Collect every encrypted part first so they can be decrypted as one batch
+        names: List[str] = []
+        items: List[Tuple[bytes, dict]] = []
+        part_offsets: List[Optional[str]] = []
         for part in msg.iter_attachments():
             filename = part.get_filename() or "attachment.bin"
             payload = part.get_payload(decode=True)
+            meta = self._part_meta(msg, part, filename)
+            names.append(filename)
+            items.append((payload, meta))
+            part_offsets.append(part.get('X-QuMail-KeyOffset'))
+
+        # Slab-allocated Level 1 parts each have their own key range; the supplied
+        # material starts at the message-level X-QuMail-KeyOffset
+        key_offsets = None
+        if level == 1 and part_offsets and all(o is not None for o in part_offsets):
+            base = int(msg.get('X-QuMail-KeyOffset', '0'))
+            key_offsets = [int(o) - base for o in part_offsets]
+
+        dec_body = ""
+        dec_attachments: List[Tuple[str, bytes]] = []
+        for filename, (_, meta), pt in zip(names, items, ctx.decrypt_many(items, key_offsets)):
+            pt = compression.decompress(pt, meta.get('compression'), meta.get('original_size'))
             if filename == 'body.enc':
-                # Metadata for AES-GCM
-                meta_b64 = msg.get('X-QuMail-Meta')
-                meta = {}
-                if meta_b64:
-                    try:
-                        meta = ast.literal_eval(base64.b64decode(meta_b64).decode())
-                    except Exception:
-                        meta = {}
-                pt = crypto_service.decrypt(level, payload, qkd_key_material, metadata=meta)
                 try:
                     dec_body = pt.decode('utf-8', errors='replace')
                 except Exception:
                     dec_body = "<binary body>"
             else:
-                # Decrypt attachment assuming same level; prefer per-part metadata
-                meta_b64 = part.get('X-QuMail-Meta') or msg.get('X-QuMail-Meta')
-                meta = {}
-                if meta_b64:
-                    try:
-                        meta = ast.literal_eval(base64.b64decode(meta_b64).decode())
-                    except Exception:
-                        meta = {}
-                pt = crypto_service.decrypt(level, payload, qkd_key_material, metadata=meta)
                 # Remove .enc suffix if present
                 if filename.endswith('.enc'):
                     filename = filename[:-4]
                 dec_attachments.append((filename, pt))
 
         return dec_body, dec_attachments
+
+    def decrypt_message_file(
+        self,
+        fp: BinaryIO,
+        qkd_key_material: Optional[bytes],
+        out_dir: str,
+    ) -> Tuple[str, List[Tuple[str, str]]]:
+        """Open the message in ``fp`` part by part; returns (body_text, [(filename, path)]).
+
+        Each attachment is base64-decoded into a temporary file, then
+        decrypted (and decompressed) segment by segment into ``out_dir``, so
+        memory stays flat however large it is. A part that fails to decrypt
+        leaves no file behind.
+        """
+        msg = read_headers(fp)
+        level, ctx = self._context_for(msg, qkd_key_material)
+        base = int(msg.get('X-QuMail-KeyOffset', '0'))
+        dec_body = ""
+        dec_attachments: List[Tuple[str, str]] = []
+        boundary = msg.get_boundary()
+        if boundary is None:
+            return dec_body, dec_attachments
+        for part, payload in _iter_parts(fp, boundary.encode()):
+            with payload:
+                if part.get_content_disposition() != 'attachment':
+                    continue
+                filename = part.get_filename() or "attachment.bin"
+                meta = self._part_meta(msg, part, filename)
+                part_offset = part.get('X-QuMail-KeyOffset')
+                key_offset = int(part_offset) - base if level == 1 and part_offset is not None else 0
+                if filename == 'body.enc':
+                    out = io.BytesIO()
+                    _open_part(ctx, payload, meta, key_offset, out)
+                    dec_body = out.getvalue().decode('utf-8', errors='replace')
+                    continue
+                # Remove .enc suffix if present
+                if filename.endswith('.enc'):
+                    filename = filename[:-4]
+                path = _unique_path(out_dir, filename)
+                try:
+                    with open(path, 'wb') as out:
+                        _open_part(ctx, payload, meta, key_offset, out)
+                except Exception:
+                    os.remove(path)
+                    raise
+                dec_attachments.append((filename, path))
+        return dec_body, dec_attachments
+
+    def _context_for(self, msg: EmailMessage, qkd_key_material: Optional[bytes]) -> Tuple[int, crypto_service.CryptoContext]:
+        level_str = msg.get('X-QuMail-Level', '4')
+        try:
+            level = int(level_str)
+        except Exception:
+            level = 4
+        algo = msg.get('X-QuMail-Algo', '')
+        # One derived context for every part; repeat opens of the same key hit the cache.
+        # The algo header selects the AEAD backend the sender used.
+        return level, crypto_service.get_context(level, qkd_key_material, msg.get('X-QuMail-KeyId'), algo=algo or None)
+
+    @staticmethod
+    def _part_meta(msg: EmailMessage, part: EmailMessage, filename: str) -> dict:
+        if filename == 'body.enc':
+            # Metadata for AES-GCM
+            meta_b64 = msg.get('X-QuMail-Meta')
+        else:
+            # Decrypt attachment assuming same level; prefer per-part metadata
+            meta_b64 = part.get('X-QuMail-Meta') or msg.get('X-QuMail-Meta')
+        meta = {}
+        if meta_b64:
+            try:
+                meta = ast.literal_eval(base64.b64decode(meta_b64).decode())
+            except Exception:
+                meta = {}
+        return meta
+
+
+def read_headers(fp: BinaryIO) -> EmailMessage:
+    """Parse only the top-level header block of the message in ``fp``.
+
+    ``fp`` is rewound first and left at the start of the body.
+    """
+    fp.seek(0)
+    lines = []
+    while True:
+        line = fp.readline()
+        if not line or line in (b"\r\n", b"\n"):
+            break
+        lines.append(line)
+    return BytesParser(policy=policy.default).parsebytes(b"".join(lines) + b"\r\n", headersonly=True)
+
+
+def _iter_parts(fp: BinaryIO, boundary: bytes) -> Iterator[Tuple[EmailMessage, BinaryIO]]:
+    """Yield (headers, decoded payload file) for each top-level part of a multipart body.
+
+    Base64 payloads are decoded ``B64_DECODE_BYTES`` at a time into a
+    temporary file; other transfer encodings are rare here and are decoded in
+    memory. ``fp`` must be seekable.
+    """
+    delim = b"--" + boundary
+    close = delim + b"--"
+    while True:
+        line = fp.readline()
+        if not line or line.rstrip() == close:
+            return
+        if line.rstrip() == delim:
+            break
+    while True:
+        head = []
+        while True:
+            line = fp.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+            head.append(line)
+        header_bytes = b"".join(head)
+        part = BytesParser(policy=policy.default).parsebytes(header_bytes + b"\r\n", headersonly=True)
+        if part.get('Content-Transfer-Encoding', '').strip().lower() == 'base64':
+            payload = tempfile.TemporaryFile()
+            _decode_base64_until(fp, b"\n" + delim, payload)
+            line = fp.readline()
+        else:
+            raw = []
+            while True:
+                line = fp.readline()
+                if not line or line.rstrip() in (delim, close):
+                    break
+                raw.append(line)
+            # The line break before a delimiter belongs to the delimiter
+            body = b"".join(raw)
+            body = body[:-2] if body.endswith(b"\r\n") else body[:-1] if body.endswith(b"\n") else body
+            payload = io.BytesIO(BytesParser(policy=policy.default).parsebytes(header_bytes + b"\r\n" + body).get_payload(decode=True) or b"")
+        payload.seek(0)
+        yield part, payload
+        if not line or line.rstrip() == close:
+            return
+
+
+def _decode_base64_until(fp: BinaryIO, marker: bytes, out: BinaryIO) -> None:
+    """Decode base64 text from ``fp`` into ``out`` up to the line that ``marker`` starts.
+
+    ``marker`` is a newline plus the part delimiter, which cannot occur inside
+    base64 text. ``fp`` is left at the start of the delimiter line.
+    """
+    carry = b"\n"  # the body starts on a new line
+    pending = b""
+    while True:
+        block = fp.read(B64_DECODE_BYTES)
+        buf = carry + block
+        idx = buf.find(marker)
+        if idx >= 0:
+            fp.seek(fp.tell() - len(buf) + idx + 1)
+            text, carry = buf[:idx], b""
+        elif block:
+            keep = len(marker) - 1
+            text, carry = buf[:-keep], buf[-keep:]
+        else:
+            text, carry = buf, b""
+        data = pending + text.translate(None, b" \t\r\n")
+        cut = len(data) - len(data) % 4
+        out.write(binascii.a2b_base64(data[:cut]))
+        pending = data[cut:]
+        if not carry:
+            if pending:
+                out.write(binascii.a2b_base64(pending))
+            return
+
+
+def _open_part(ctx: crypto_service.CryptoContext, src: BinaryIO, meta: dict, key_offset: int, dst: BinaryIO) -> None:
+    """Decrypt one part from ``src`` into ``dst``, decompressing through a temporary file."""
+    if not meta.get('compression'):
+        ctx.decrypt_file(src, dst, meta, key_offset)
+        return
+    with tempfile.TemporaryFile() as plain:
+        ctx.decrypt_file(src, plain, meta, key_offset)
+        plain.seek(0)
+        compression.decompress_stream(plain, dst, meta['compression'], meta.get('original_size'))
+
+
+def _unique_path(out_dir: str, filename: str) -> str:
+    """A new file path in ``out_dir`` for an attachment name from a message."""
+    name = os.path.basename(filename.replace('\\', '/')) or "attachment.bin"
+    stem, ext = os.path.splitext(name)
+    path = os.path.join(out_dir, name)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(out_dir, f"{stem} ({n}){ext}")
+        n += 1
+    return path
+
+
+def _fetch_line(data) -> bytes:
+    """The response line of an imaplib FETCH result."""
+    first = data[0] if data else b""
+    if isinstance(first, tuple):
+        first = first[0]
+    return first or b""
+
+
+class _Base64Lines:
+    """Write-only file that base64-encodes into ``out`` as 76-character CRLF lines."""
+
+    def __init__(self, out: BinaryIO) -> None:
+        self.out = out
+        self._pending = b""
+
+    def write(self, data: bytes) -> None:
+        data = self._pending + bytes(data)
+        # 57 input bytes make one full line
+        cut = len(data) - len(data) % 57
+        if cut:
+            self.out.write(base64.encodebytes(data[:cut]).replace(b"\n", b"\r\n"))
+        self._pending = data[cut:]
+
+    def flush(self) -> None:
+        if self._pending:
+            self.out.write(base64.encodebytes(self._pending).replace(b"\n", b"\r\n"))
+            self._pending = b""
+
+
+def _send_data(server: smtplib.SMTP, sender: str, recipients: List[str], fp: BinaryIO) -> None:
+    """Run one SMTP transaction for the CRLF message in ``fp``, sending DATA in segments.
+
+    ``smtplib.SMTP.sendmail`` needs the whole message as one bytes object.
+    """
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(sender)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    refused = {}
+    for rcpt in recipients:
+        code, resp = server.rcpt(rcpt)
+        if code not in (250, 251):
+            refused[rcpt] = (code, resp)
+    if len(refused) == len(recipients):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    server.putcmd("data")
+    code, resp = server.getreply()
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    fp.seek(0)
+    # Dot-stuffing (RFC 5321 section 4.5.2): double a "." that starts a line
+    line_start = True
+    end = b"\r\n"
+    while True:
+        block = fp.read(SMTP_SEND_BYTES)
+        if not block:
+            break
+        if line_start and block.startswith(b"."):
+            block = b"." + block
+        block = block.replace(b"\n.", b"\n..")
+        server.send(block)
+        line_start = block.endswith(b"\n")
+        end = (end + block)[-2:]
+    server.send(b".\r\n" if end == b"\r\n" else b"\r\n.\r\n")
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
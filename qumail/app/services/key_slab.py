@@ -0,0 +1,118 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import requests
+
+from .km_client import KMClient
+
+
+@dataclass
+class OTPAllocation:
+    """A contiguous range of one QKD key reserved for a single message.
+
+    ``part_offsets`` are absolute offsets into the key, one per part, laid out
+    back to back from ``offset``; ``material`` covers the whole range.
+    """
+    key_id: str
+    offset: int
+    material: bytes
+    part_offsets: List[int]
+    tampered: bool
+
+
+class OTPSlabAllocator:
+    """Sub-allocates one large Level 1 key across parts and messages.
+
+    A slab key of ``slab_length`` bytes (or the message size, if larger) is
+    created on the KM with ``retain`` and an expiry of ``ttl`` seconds. Each
+    allocation consumes its range on the KM, so the KM never hands those pad
+    bytes out again, and parts never share pad bytes. Receivers read their
+    range back with ``KMClient.material_with_verify`` until the key expires and
+    the KM reaps it. A slab takes no new messages once half its ``ttl`` has
+    passed, so every message stays readable for at least ``ttl / 2``.
+    """
+
+    def __init__(self, km: KMClient, slab_length: Optional[int] = None, ttl: Optional[float] = None):
+        self.km = km
+        self.slab_length = slab_length
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._key_id: Optional[str] = None
+        self._remaining = 0
+        self._fresh_until = 0.0
+
+    def remaining(self) -> int:
+        with self._lock:
+            return self._remaining
+
+    def _new_slab(self, total: int) -> None:
+        length = max(total, int(self.slab_length or self.km.cfg.otp_slab_length))
+        ttl = float(self.ttl or self.km.cfg.otp_slab_ttl)
+        # Metadata only: the bytes arrive range by range from consume_with_verify
+        data = self.km.request_key(length=length, expires_in=ttl, retain=True, material=False)
+        self._key_id = data["key_id"]
+        self._remaining = length
+        self._fresh_until = time.monotonic() + ttl / 2
+
+    def _unreserve(self, key_id: str, total: int, error: Exception) -> None:
+        """Give back a reservation whose consume failed."""
+        with self._lock:
+            if self._key_id != key_id:
+                return
+            status = getattr(getattr(error, "response", None), "status_code", None)
+            if isinstance(error, requests.HTTPError) and status in (400, 404):
+                # The KM refused the key (expired, reaped or out of bytes); start a new slab
+                self._key_id = None
+            else:
+                self._remaining += total
+
+    def allocate(self, sizes: Sequence[int]) -> OTPAllocation:
+        total = sum(int(n) for n in sizes)
+        with self._lock:
+            if self._key_id is None or self._remaining < total or time.monotonic() > self._fresh_until:
+                self._new_slab(total)
+            # Reserve locally; the KM's consume offset decides the actual range
+            self._remaining -= total
+            key_id = self._key_id
+        if total:
+            try:
+                start, material, tampered = self.km.consume_with_verify(key_id, total)
+            except Exception as e:
+                self._unreserve(key_id, total, e)
+                raise
+        else:
+            start, material, tampered = 0, b"", False
+        part_offsets = []
+        off = start
+        for n in sizes:
+            part_offsets.append(off)
+            off += int(n)
+        return OTPAllocation(key_id=key_id, offset=start, material=material, part_offsets=part_offsets, tampered=tampered)
+
+
+class OTPSlabRegistry:
+    """One :class:`OTPSlabAllocator` per sender and recipient set.
+
+    Pads for different correspondents never come from the same KM key, so a
+    receiver's range reads only ever touch keys shared with that sender.
+    """
+
+    def __init__(self, km: KMClient, slab_length: Optional[int] = None, ttl: Optional[float] = None):
+        self.km = km
+        self.slab_length = slab_length
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._slabs: Dict[Tuple[str, Tuple[str, ...]], OTPSlabAllocator] = {}
+
+    def for_pair(self, sender: str, recipients: Sequence[str]) -> OTPSlabAllocator:
+        pair = (sender.strip().lower(), tuple(sorted({r.strip().lower() for r in recipients})))
+        with self._lock:
+            slab = self._slabs.get(pair)
+            if slab is None:
+                slab = self._slabs[pair] = OTPSlabAllocator(self.km, self.slab_length, self.ttl)
+            return slab
+
+    def allocate(self, sender: str, recipients: Sequence[str], sizes: Sequence[int]) -> OTPAllocation:
+        return self.for_pair(sender, recipients).allocate(sizes)
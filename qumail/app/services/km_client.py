@@ -1,22 +1,51 @@
 import base64
+import threading
 import time
-from typing import Optional, Tuple
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
 from dataclasses import dataclass
 
 import requests
-from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 from .config import KMConfig
+from .km_health import BreakerAdapter, CircuitBreaker, KMHealthMonitor
 import hmac
 import hashlib
 
+OCTET_STREAM = "application/octet-stream"
+# Pooled keys outlive the pool's max_age on the KM by this long, so a key
+# handed to a message can still be consumed by the recipient
+POOL_OPEN_MARGIN = 86400.0
+_READ_CHUNK = 64 << 10
+
+
+def _read_body(r: requests.Response) -> bytes | bytearray:
+    """Read a streamed response body into one preallocated buffer.
+
+    The buffer itself is returned (not copied into ``bytes``); callers treat
+    key material as any bytes-like object.
+    """
+    length = r.headers.get("Content-Length")
+    if length is None:
+        return r.content
+    buf = bytearray(int(length))
+    view = memoryview(buf)
+    pos = 0
+    for chunk in r.iter_content(chunk_size=_READ_CHUNK):
+        view[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+    if pos != len(buf):
+        raise IOError(f"Truncated key material: got {pos} of {len(buf)} bytes")
+    return buf
+
 
 class KMClient:
     """Client for ETSI GS QKD 014-like REST key delivery APIs.
 
     Endpoints expected (KM Simulator):
       - POST /api/v1/keys {client_id, peer_id, length}
+      - POST /api/v1/keys/batch {client_id, peer_id, number, size}
       - GET  /api/v1/keys/{key_id}
       - POST /api/v1/consume/{key_id} {bytes}
       - GET  /api/v1/status
@@ -27,14 +56,20 @@ class KMClient:
         self.session = requests.Session()
         # Do not use system proxy vars for localhost
         self.session.trust_env = False
-        # Robust retries for transient connection issues
+        # Robust retries for transient connection issues and gateway errors;
+        # 429/503 are retried by the adapter when the KM says when (Retry-After),
+        # so urllib3 must not also sleep on the header (it has no upper bound)
         retry = Retry(total=3, connect=3, read=3, backoff_factor=0.3,
-                      status_forcelist=(502, 503, 504))
-        adapter = HTTPAdapter(max_retries=retry)
+                      status_forcelist=(502, 504), respect_retry_after_header=False)
+        # Fail fast instead of waiting out timeouts while the KM is known to be down
+        self.breaker = CircuitBreaker(cfg.breaker_failures, cfg.breaker_reset)
+        adapter = BreakerAdapter(self.breaker, cfg.retry_after_attempts, cfg.retry_after_max, max_retries=retry)
         self.session.mount('http://', adapter)
         self.session.mount('https://', adapter)
         # Increase timeout to accommodate slower hosts
         self.timeout = 30.0
+        self.pool: Optional["KeyPool"] = None
+        self.health: Optional[KMHealthMonitor] = None
 
     def _hmac_hex(self, data: bytes) -> str:
         return hmac.new(self.cfg.integrity_secret.encode(), data, hashlib.sha256).hexdigest()
@@ -47,43 +82,133 @@ class KMClient:
         except Exception:
             return False
 
-    def request_key(self, length: Optional[int] = None) -> dict:
+    def request_key(self, length: Optional[int] = None, expires_in: Optional[float] = None,
+                    retain: bool = False, material: bool = True) -> dict:
+        """Create a key and return the KM's JSON description of it.
+
+        ``retain`` keys keep consumed ranges readable via ``material_with_verify``
+        until they expire (``expires_in`` is then required). With
+        ``material=False`` the KM answers with metadata only (no ``key_b64``).
+        """
         payload = {
             "client_id": self.cfg.client_id,
             "peer_id": self.cfg.peer_id,
             "length": int(length or self.cfg.default_key_length),
         }
+        if expires_in:
+            payload["expires_in"] = float(expires_in)
+        if retain:
+            payload["retain"] = True
+        if not material:
+            payload["material"] = False
         r = self.session.post(f"{self.cfg.base_url}/api/v1/keys", json=payload, timeout=self.timeout)
         r.raise_for_status()
         return r.json()
 
+    def _accept(self) -> dict:
+        # Ask for raw key bytes; servers without the binary variant still answer JSON
+        return {"Accept": OCTET_STREAM} if self.cfg.binary_transport else {}
+
+    def _read_key_response(self, r: requests.Response, field: str) -> Tuple[dict, bytes]:
+        """Return ({key_id, offset, hmac}, material) from a binary or JSON KM response.
+
+        ``field`` is the JSON prefix ("key" or "slice"). Binary bodies are
+        streamed straight into a buffer sized from Content-Length.
+        """
+        r.raise_for_status()
+        if r.headers.get("Content-Type", "").startswith(OCTET_STREAM):
+            info = {
+                "key_id": r.headers.get("X-Key-Id"),
+                "offset": int(r.headers.get("X-Key-Offset", "0")),
+                "hmac": r.headers.get("X-Key-HMAC", ""),
+            }
+            return info, _read_body(r)
+        data = r.json()
+        info = {
+            "key_id": data.get("key_id"),
+            "offset": int(data.get("offset", 0)),
+            "hmac": data.get(f"{field}_hmac", ""),
+        }
+        return info, base64.b64decode(data.get(f"{field}_b64", ""))
+
     def request_key_with_verify(self, length: Optional[int] = None) -> Tuple[str, bytes, bool]:
         """Request a new key and verify with HMAC.
         Try GET first to avoid environments where POST stalls; fallback to POST.
+        A 429/503 (rate limited or key buffer empty, after the adapter's
+        Retry-After attempts) is raised rather than retried as a POST.
         """
         params = {
             "length": int(length or self.cfg.default_key_length),
             "client_id": self.cfg.client_id,
             "peer_id": self.cfg.peer_id,
         }
-        data = None
         # Fast attempt via GET with short timeout
         try:
-            r = self.session.get(f"{self.cfg.base_url}/api/v1/keys/new", params=params, timeout=5.0)
-            r.raise_for_status()
-            data = r.json()
-        except Exception:
-            # Fallback to POST with normal timeout
-            try:
-                data = self.request_key(length)
-            except Exception:
-                # Re-raise last error for caller
+            r = self.session.get(f"{self.cfg.base_url}/api/v1/keys/new", params=params,
+                                 headers=self._accept(), stream=True, timeout=5.0)
+            info, key_b = self._read_key_response(r, "key")
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in BreakerAdapter.RETRY_AFTER_STATUSES:
                 raise
-        key_id = data["key_id"]
-        key_b = base64.b64decode(data.get("key_b64", ""))
-        h = data.get("key_hmac", "")
-        tampered = (self._hmac_hex(key_b) != h)
-        return key_id, key_b, tampered
+            r = self.session.post(f"{self.cfg.base_url}/api/v1/keys", json=params,
+                                  headers=self._accept(), stream=True, timeout=self.timeout)
+            info, key_b = self._read_key_response(r, "key")
+        except Exception:
+            # Fallback to POST with normal timeout; errors propagate to the caller
+            r = self.session.post(f"{self.cfg.base_url}/api/v1/keys", json=params,
+                                  headers=self._accept(), stream=True, timeout=self.timeout)
+            info, key_b = self._read_key_response(r, "key")
+        tampered = (self._hmac_hex(key_b) != info["hmac"])
+        return info["key_id"], key_b, tampered
+
+    def _request_keys_data(self, number: int, length: Optional[int] = None, expires_in: Optional[float] = None) -> List[dict]:
+        payload = {
+            "client_id": self.cfg.client_id,
+            "peer_id": self.cfg.peer_id,
+            "number": int(number),
+            "size": int(length or self.cfg.default_key_length),
+        }
+        if expires_in:
+            payload["expires_in"] = float(expires_in)
+        r = self.session.post(f"{self.cfg.base_url}/api/v1/keys/batch", json=payload, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()["keys"]
+
+    def request_keys(self, n: int, length: Optional[int] = None) -> List[Tuple[str, bytes, bool]]:
+        """Request ``n`` keys in one round trip; each entry is (key_id, key_bytes, tampered)."""
+        out = []
+        for data in self._request_keys_data(n, length):
+            key_b = base64.b64decode(data.get("key_b64", ""))
+            out.append((data["key_id"], key_b, self._hmac_hex(key_b) != data.get("key_hmac", "")))
+        return out
+
+    def start_pool(self, targets: Optional[Dict[int, int]] = None, **kwargs) -> "KeyPool":
+        """Start a background :class:`KeyPool`; ``targets`` maps key length -> depth."""
+        if self.pool is None:
+            kwargs.setdefault("open_margin", self.cfg.pool_open_margin)
+            self.pool = KeyPool(self, targets or {64: self.cfg.pool_depth}, **kwargs)
+            self.pool.start()
+        return self.pool
+
+    def stop_pool(self) -> None:
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def start_health_monitor(self) -> KMHealthMonitor:
+        """Start background KM status checks; read them via ``self.health.snapshot()``."""
+        if self.health is None:
+            self.health = KMHealthMonitor(self, ttl=self.cfg.health_ttl)
+            self.health.start()
+        return self.health
+
+    def acquire_key(self, length: int) -> Tuple[str, bytes, bool]:
+        """Like :meth:`request_key_with_verify`, but served from the pool when possible."""
+        if self.pool is not None:
+            item = self.pool.take(length)
+            if item is not None:
+                return item.key_id, item.key_bytes, False
+        return self.request_key_with_verify(length=length)
 
     def get_key(self, key_id: str) -> dict:
         r = self.session.get(f"{self.cfg.base_url}/api/v1/keys/{key_id}", timeout=self.timeout)
@@ -91,35 +216,170 @@ class KMClient:
         return r.json()
 
     def consume(self, key_id: str, nbytes: int) -> Tuple[int, bytes]:
-        r = self.session.post(
-            f"{self.cfg.base_url}/api/v1/consume/{key_id}", json={"bytes": int(nbytes)}, timeout=self.timeout
-        )
-        r.raise_for_status()
-        data = r.json()
-        slice_b64 = data["slice_b64"]
-        offset = int(data["offset"])
-        return offset, base64.b64decode(slice_b64)
+        offset, slice_b, _ = self.consume_with_verify(key_id, nbytes)
+        return offset, slice_b
 
     def consume_with_verify(self, key_id: str, nbytes: int) -> Tuple[int, bytes, bool]:
         r = self.session.post(
-            f"{self.cfg.base_url}/api/v1/consume/{key_id}", json={"bytes": int(nbytes)}, timeout=self.timeout
+            f"{self.cfg.base_url}/api/v1/consume/{key_id}", json={"bytes": int(nbytes)},
+            headers=self._accept(), stream=True, timeout=self.timeout,
         )
-        r.raise_for_status()
-        data = r.json()
-        slice_b = base64.b64decode(data["slice_b64"])
-        h = data.get("slice_hmac", "")
-        tampered = (self._hmac_hex(slice_b) != h)
-        return int(data["offset"]), slice_b, tampered
+        info, slice_b = self._read_key_response(r, "slice")
+        tampered = (self._hmac_hex(slice_b) != info["hmac"])
+        return info["offset"], slice_b, tampered
 
     def material_with_verify(self, key_id: str, nbytes: int, offset: int = 0) -> Tuple[int, bytes, bool]:
         """Fetch a non-consuming slice of key material and verify integrity.
         Requires KM simulator >= current version supporting /api/v1/material.
         """
         params = {"bytes": int(nbytes), "offset": int(offset)}
-        r = self.session.get(f"{self.cfg.base_url}/api/v1/material/{key_id}", params=params, timeout=self.timeout)
-        r.raise_for_status()
-        data = r.json()
-        slice_b = base64.b64decode(data["slice_b64"])
-        h = data.get("slice_hmac", "")
-        tampered = (self._hmac_hex(slice_b) != h)
-        return int(data.get("offset", 0)), slice_b, tampered
+        r = self.session.get(f"{self.cfg.base_url}/api/v1/material/{key_id}", params=params,
+                             headers=self._accept(), stream=True, timeout=self.timeout)
+        info, slice_b = self._read_key_response(r, "slice")
+        tampered = (self._hmac_hex(slice_b) != info["hmac"])
+        return info["offset"], slice_b, tampered
+
+
+@dataclass
+class PooledKey:
+    key_id: str
+    key_bytes: bytes
+    fetched_at: float
+    expires_at: Optional[float] = None
+
+
+class KeyPool:
+    """Keeps verified keys of common sizes ready so sends skip the KM round trip.
+
+    A daemon worker tops each size up to its target depth. Keys are checked
+    against their HMAC before they are pooled; on a mismatch the pool is
+    drained and refilling pauses, so callers fall back to a direct request and
+    see the tamper flag themselves. Keys past ``max_age`` or within
+    ``expiry_margin`` seconds of their KM expiry are discarded on take.
+
+    Keys are created to expire on the KM ``max_age + open_margin`` seconds
+    out (unless ``expires_in`` is given), so keys the pool drops, or loses on
+    restart, are reaped by the KM. A message sealed with a pooled key has to
+    be opened within ``open_margin`` seconds.
+    """
+
+    def __init__(
+        self,
+        client: KMClient,
+        targets: Dict[int, int],
+        refill_interval: float = 5.0,
+        expires_in: Optional[float] = None,
+        expiry_margin: float = 5.0,
+        max_age: Optional[float] = 600.0,
+        tamper_backoff: float = 30.0,
+        open_margin: float = POOL_OPEN_MARGIN,
+    ):
+        self.client = client
+        self.targets = dict(targets)
+        self.refill_interval = refill_interval
+        if expires_in is None and max_age is not None:
+            expires_in = max_age + open_margin
+        self.expires_in = expires_in
+        self.expiry_margin = expiry_margin
+        self.max_age = max_age
+        self.tamper_backoff = tamper_backoff
+        self._keys: Dict[int, Deque[PooledKey]] = {n: deque() for n in self.targets}
+        self._cond = threading.Condition()
+        self._stop = False
+        self._paused_until = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, name="qumail-key-pool", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=self.client.timeout)
+            self._thread = None
+
+    def depth(self, length: int) -> int:
+        with self._cond:
+            return len(self._keys.get(length, ()))
+
+    def take(self, length: int) -> Optional[PooledKey]:
+        """Pop a fresh key of exactly ``length`` bytes, or None if the pool has none."""
+        with self._cond:
+            q = self._keys.get(length)
+            item = None
+            while q:
+                cand = q.popleft()
+                if self._fresh(cand, time.time()):
+                    item = cand
+                    break
+            self._cond.notify_all()  # wake the worker to refill
+            return item
+
+    def _fresh(self, item: PooledKey, now: float) -> bool:
+        if item.expires_at is not None and now >= item.expires_at - self.expiry_margin:
+            return False
+        if self.max_age is not None and now - item.fetched_at > self.max_age:
+            return False
+        return True
+
+    def _missing(self) -> Dict[int, int]:
+        now = time.time()
+        missing = {}
+        for n, target in self.targets.items():
+            q = self._keys[n]
+            fresh = [k for k in q if self._fresh(k, now)]
+            if len(fresh) != len(q):
+                self._keys[n] = q = deque(fresh)
+            if len(q) < target:
+                missing[n] = target - len(q)
+        return missing
+
+    def _fetch(self, length: int, count: int) -> Optional[List[PooledKey]]:
+        """Fetch ``count`` keys in one batch call; None if any fails verification."""
+        now = time.time()
+        items = []
+        for data in self.client._request_keys_data(count, length, self.expires_in):
+            key_b = base64.b64decode(data.get("key_b64", ""))
+            if self.client._hmac_hex(key_b) != data.get("key_hmac", ""):
+                return None
+            items.append(PooledKey(key_id=data["key_id"], key_bytes=key_b, fetched_at=now, expires_at=data.get("expires_at")))
+        return items
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+                wait = self._paused_until - time.time()
+                missing = {} if wait > 0 else self._missing()
+                if not missing:
+                    self._cond.wait(timeout=wait if wait > 0 else self.refill_interval)
+                    continue
+            self._fill(missing)
+
+    def _fill(self, missing: Dict[int, int]) -> None:
+        for length, count in missing.items():
+            try:
+                items = self._fetch(length, count)
+            except Exception:
+                # KM unreachable; retry on the next interval
+                with self._cond:
+                    self._paused_until = time.time() + self.refill_interval
+                return
+            with self._cond:
+                if self._stop:
+                    return
+                if items is None:
+                    # Integrity mismatch: stop serving pooled keys for a while
+                    for q in self._keys.values():
+                        q.clear()
+                    self._paused_until = time.time() + self.tamper_backoff
+                    return
+                self._keys[length].extend(items)
@@ -0,0 +1,248 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from dataclasses import dataclass, asdict, replace
+from typing import TYPE_CHECKING, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+if TYPE_CHECKING:
+    from .km_client import KMClient
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class KMUnavailable(requests.exceptions.ConnectionError):
+    """Raised instead of contacting the KM while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Classic closed / open / half-open breaker for KM calls.
+
+    ``failure_threshold`` consecutive failures open the circuit and calls fail
+    immediately. After ``reset_timeout`` seconds a single trial call is let
+    through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 10.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            # Half-open: one trial call at a time
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def trip(self) -> None:
+        """Open the circuit now, e.g. after a failed health probe."""
+        with self._lock:
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delta seconds or HTTP date); None if absent or invalid."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class BreakerAdapter(HTTPAdapter):
+    """HTTPAdapter that consults a :class:`CircuitBreaker` before each request.
+
+    Any exception (connection errors, timeouts, ``RetryError`` once urllib3
+    gives up on gateway errors) and gateway error responses count as
+    failures; any other response counts as a success.
+
+    ``429`` and ``503`` answers that carry a Retry-After header (the KM's rate
+    limiter and empty link buffers) are retried after the advertised delay, up
+    to ``retry_after_attempts`` times, as long as the delay is at most
+    ``retry_after_max`` seconds; otherwise the response is returned as is.
+    """
+
+    FAILURE_STATUSES = (502, 504)
+    RETRY_AFTER_STATUSES = (429, 503)
+
+    def __init__(self, breaker: CircuitBreaker, retry_after_attempts: int = 3,
+                 retry_after_max: float = 10.0, **kwargs):
+        self.breaker = breaker
+        self.retry_after_attempts = int(retry_after_attempts)
+        self.retry_after_max = float(retry_after_max)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        attempts = 0
+        while True:
+            resp = self._send_once(request, **kwargs)
+            if resp.status_code not in self.RETRY_AFTER_STATUSES or attempts >= self.retry_after_attempts:
+                return resp
+            wait = retry_after_seconds(resp.headers.get("Retry-After"))
+            if wait is None or wait > self.retry_after_max:
+                return resp
+            resp.close()
+            attempts += 1
+            time.sleep(wait)
+
+    def _send_once(self, request, **kwargs):
+        if not self.breaker.allow():
+            raise KMUnavailable(f"KM circuit open; not contacting {request.url}", request=request)
+        ok = False
+        try:
+            resp = super().send(request, **kwargs)
+            ok = resp.status_code not in self.FAILURE_STATUSES
+            return resp
+        finally:
+            # Always settle the call, so a half-open trial can never stay in flight
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+
+@dataclass
+class KMHealth:
+    ok: bool
+    breaker: str
+    checked_at: float
+    latency_ms: Optional[float] = None
+    error: Optional[str] = None
+    intrusion: Optional[bool] = None
+    keys_ok: Optional[bool] = None
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+class KMHealthMonitor:
+    """Polls the KM status endpoint in the background and caches the result.
+
+    Callers read :meth:`snapshot` instead of making their own round trip.
+    Probes use a separate session with a short timeout and no retries; a
+    failed probe counts as a failure toward the client's breaker threshold, and
+    a successful probe closes it again (the half-open recovery check).
+    """
+
+    def __init__(self, km: "KMClient", ttl: float = 5.0, probe_timeout: float = 2.0):
+        self.km = km
+        self.ttl = float(ttl)
+        self.probe_timeout = float(probe_timeout)
+        self._session = requests.Session()
+        self._session.trust_env = False
+        self._lock = threading.Lock()
+        self._last: Optional[KMHealth] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="qumail-km-health", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.probe_timeout * 2)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.ttl)
+
+    def check(self, probe_keys: bool = False) -> KMHealth:
+        """Probe the KM now and update the cache.
+
+        ``probe_keys`` also issues a tiny ``keys/new`` request (this creates a
+        key, so the background loop leaves it off).
+        """
+        base = self.km.cfg.base_url
+        t0 = time.perf_counter()
+        ok, error, intrusion, keys_ok = False, None, None, None
+        try:
+            r = self._session.get(f"{base}/api/v1/status", timeout=self.probe_timeout)
+            r.raise_for_status()
+            data = r.json()
+            ok = data.get("status") == "ok"
+            intrusion = data.get("intrusion")
+        except Exception as e:
+            error = str(e)
+        latency = (time.perf_counter() - t0) * 1e3
+        if ok and probe_keys:
+            try:
+                r = self._session.get(f"{base}/api/v1/keys/new", params={"length": 8}, timeout=self.probe_timeout)
+                r.raise_for_status()
+                keys_ok = True
+            except Exception as e:
+                keys_ok = False
+                error = f"keys/new: {e}"
+        breaker = self.km.breaker
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        health = KMHealth(ok=ok, breaker=breaker.state, checked_at=time.time(),
+                          latency_ms=latency, error=error, intrusion=intrusion, keys_ok=keys_ok)
+        with self._lock:
+            self._last = health
+        return health
+
+    def snapshot(self) -> KMHealth:
+        """Return the cached health; probes synchronously only if it is older than ``ttl``."""
+        with self._lock:
+            last = self._last
+        if last is None or time.time() - last.checked_at > self.ttl:
+            return self.check()
+        return replace(last, breaker=self.km.breaker.state)
+
+    def available(self) -> bool:
+        return self.snapshot().ok
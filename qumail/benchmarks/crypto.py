@@ -0,0 +1,163 @@
+"""Offline micro-benchmarks for crypto_service and the EmailService MIME path.
+
+Examples::
+
+    python -m qumail.benchmarks.crypto --sizes 1KB 1MB 16MB --json run.json
+    python -m qumail.benchmarks.crypto --baseline run.json --threshold 10
+
+Covers Level 1-4 encrypt/decrypt, HKDF derivation and a full MIME build +
+parse + decrypt of a message carrying one attachment of each size. No SMTP
+or IMAP server is contacted. With ``--baseline`` the run is compared against
+an earlier JSON report and exits non-zero if any case regressed by more than
+``--threshold`` percent.
+"""
+import argparse
+import email
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from email import policy
+from typing import Callable, Dict, List
+
+from ..app.services import crypto_service
+from ..app.services.config import IMAPConfig, SMTPConfig
+from ..app.services.email_service import EmailService
+from .common import parse_size, percentile, size_label
+
+DEFAULT_SIZES = ["1KB", "64KB", "1MB", "16MB"]
+
+
+def measure(fn: Callable[[], object], nbytes: int, repeat: int, min_time: float) -> Dict[str, float]:
+    """Run ``fn`` at least ``repeat`` times (and ``min_time`` seconds) and summarise latencies."""
+    fn()  # warm-up
+    samples: List[float] = []
+    start = time.perf_counter()
+    while len(samples) < repeat or time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+        if len(samples) >= repeat * 100:
+            break
+    samples.sort()
+    p50 = percentile(samples, 50)
+    out = {
+        "runs": len(samples),
+        "bytes": nbytes,
+        "mean_ms": statistics.fmean(samples) * 1e3,
+        "p50_ms": p50 * 1e3,
+        "p90_ms": percentile(samples, 90) * 1e3,
+        "p99_ms": percentile(samples, 99) * 1e3,
+    }
+    if nbytes:
+        out["mb_s"] = nbytes / p50 / 1e6 if p50 > 0 else float("inf")
+    return out
+
+
+def _offline_email_service() -> EmailService:
+    return EmailService(
+        SMTPConfig(host="localhost", port=0, username="", password="", use_starttls=False),
+        IMAPConfig(host="localhost", port=0, username="", password="", use_ssl=False),
+    )
+
+
+def run_suite(sizes: List[int], levels: List[int], repeat: int, min_time: float) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    aes_material = os.urandom(64)
+    results["hkdf/derive"] = measure(lambda: crypto_service._hkdf_derive(aes_material, 32), 0, repeat, min_time)
+
+    es = _offline_email_service()
+    body = b"QuMail benchmark body\n" * 64
+    for size in sizes:
+        data = os.urandom(size)
+        otp_material = os.urandom(size + len(body))
+        for level in levels:
+            material = otp_material if level == 1 else aes_material
+            ctx = crypto_service.CryptoContext(level, material)
+            enc = ctx.encrypt_part(data)
+            tag = f"L{level}/{size_label(size)}"
+            results[f"encrypt/{tag}"] = measure(lambda: ctx.encrypt_part(data), size, repeat, min_time)
+            results[f"decrypt/{tag}"] = measure(lambda: ctx.decrypt(enc.ciphertext, enc.metadata), size, repeat, min_time)
+
+            def mime_roundtrip():
+                msg = es.build_message(
+                    "bench@example.com", ["peer@example.com"], "bench", body,
+                    [("payload.bin", data)], level, material, key_id="bench",
+                )
+                parsed = email.message_from_bytes(msg.as_bytes(), policy=policy.default)
+                es.decrypt_message(parsed, material)
+
+            results[f"mime/{tag}"] = measure(mime_roundtrip, size + len(body), repeat, min_time)
+    return results
+
+
+def _format_row(name: str, r: Dict[str, float]) -> str:
+    rate = f"{r['mb_s']:10.1f} MB/s" if "mb_s" in r else " " * 15
+    return f"{name:<24} {rate}  p50 {r['p50_ms']:9.3f} ms  p99 {r['p99_ms']:9.3f} ms  (n={r['runs']})"
+
+
+def compare(current: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> List[str]:
+    """Return a description of every case that is more than ``threshold`` percent slower."""
+    regressions = []
+    for name, cur in current.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if "mb_s" in cur and "mb_s" in base:
+            change = (base["mb_s"] - cur["mb_s"]) / base["mb_s"] * 100.0
+            what = f"{base['mb_s']:.1f} -> {cur['mb_s']:.1f} MB/s"
+        else:
+            change = (cur["p50_ms"] - base["p50_ms"]) / base["p50_ms"] * 100.0
+            what = f"p50 {base['p50_ms']:.3f} -> {cur['p50_ms']:.3f} ms"
+        if change > threshold:
+            regressions.append(f"{name}: {what} ({change:.1f}% slower)")
+    return regressions
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="QuMail crypto benchmarks (offline)")
+    ap.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="payload sizes, e.g. 1KB 1MB 100MB")
+    ap.add_argument("--levels", type=int, nargs="+", default=[1, 2, 3, 4], choices=[1, 2, 3, 4])
+    ap.add_argument("--repeat", type=int, default=5, help="minimum timed runs per case")
+    ap.add_argument("--min-time", type=float, default=0.2, help="minimum seconds spent per case")
+    ap.add_argument("--json", dest="json_out", help="write the report to this file ('-' for stdout)")
+    ap.add_argument("--baseline", help="earlier JSON report to compare against")
+    ap.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent")
+    args = ap.parse_args(argv)
+
+    sizes = [parse_size(s) for s in args.sizes]
+    results = run_suite(sizes, args.levels, args.repeat, args.min_time)
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+    if args.json_out == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        for name, r in results.items():
+            print(_format_row(name, r))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:.1f}%", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""Load generator for the KM simulator's REST API.
+
+Examples::
+
+    python -m qumail.benchmarks.km_load --threads 1 4 16 --key-sizes 32 4KB
+    python -m qumail.benchmarks.km_load --persist none snapshot wal --json load.json
+    python -m qumail.benchmarks.km_load --transport http --intrusion off on --binary
+
+Each case starts a fresh simulator (``create_app()``) with its store in a
+temporary directory and drives it with worker threads. It is driven either
+in-process through the Flask test client (no sockets, so it measures the
+app itself) or over localhost HTTP via :func:`serve_in_thread`. ``--url``
+targets an already running simulator instead; its persistence settings are
+then whatever it was started with. The operation mix is set with ``--mix``:
+``create`` issues a new key of the case's size, ``consume`` takes
+``--consume-bytes`` from one of ``--keys`` pre-created keys, and ``material``
+reads a range of one without consuming it. Throughput and p50/p99 per
+operation are reported for every combination of persistence mode, intrusion
+setting, key size and thread count. When several ``--persist`` modes run, the
+throughput of each is also shown relative to the first one.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+import requests
+
+from ..km_simulator import storage
+from ..km_simulator.app import MAX_BATCH_KEYS, create_app, serve_in_thread
+from .common import parse_size, percentile, size_label
+
+OPS = ("create", "consume", "material")
+OCTET_STREAM = "application/octet-stream"
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """``create=0.2,consume=0.7,material=0.1`` -> normalised weights."""
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in OPS:
+            raise ValueError(f"unknown operation {op!r} (expected one of {OPS})")
+        mix[op] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError("mix weights must add up to more than 0")
+    return {op: w / total for op, w in mix.items()}
+
+
+@contextmanager
+def _env(**values: str):
+    saved = {k: os.environ.get(k) for k in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+class _TestClientDriver:
+    """Calls the app through the Flask test client (no sockets)."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path: str, payload: dict, headers: dict) -> tuple[int, bytes]:
+        # Closed so streamed bodies release their hold on the store's key views
+        with self.client.post(path, json=payload, headers=headers) as r:
+            return r.status_code, r.get_data()
+
+    def get(self, path: str, headers: dict) -> tuple[int, bytes]:
+        # Closed so streamed bodies release their hold on the store's key views
+        with self.client.get(path, headers=headers) as r:
+            return r.status_code, r.get_data()
+
+
+class _HttpDriver:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def post(self, path: str, payload: dict, headers: dict) -> tuple[int, bytes]:
+        r = self.session.post(self.base_url + path, json=payload, headers=headers, timeout=30)
+        return r.status_code, r.content
+
+    def get(self, path: str, headers: dict) -> tuple[int, bytes]:
+        r = self.session.get(self.base_url + path, headers=headers, timeout=30)
+        return r.status_code, r.content
+
+
+def _precreate(driver, keys: int, key_length: int) -> List[str]:
+    ids: List[str] = []
+    while len(ids) < keys:
+        n = min(MAX_BATCH_KEYS, keys - len(ids))
+        status, body = driver.post("/api/v1/keys/batch",
+                                   {"client_id": "load", "peer_id": "peer", "number": n, "size": key_length}, {})
+        if status != 200:
+            raise RuntimeError(f"pre-creating keys failed: HTTP {status} {body[:200]!r}")
+        ids.extend(k["key_id"] for k in json.loads(body)["keys"])
+    return ids
+
+
+def run_case(make_driver: Callable[[], object], threads: int, duration: float, mix: Dict[str, float],
+             key_size: int, consume_bytes: int, key_ids: List[str], binary: bool) -> Dict[str, object]:
+    headers = {"Accept": OCTET_STREAM} if binary else {}
+    ops = list(mix)
+    weights = [mix[op] for op in ops]
+    start_evt = threading.Event()
+    stop_at = [0.0]
+    samples: List[Dict[str, List[float]]] = [{op: [] for op in ops} for _ in range(threads)]
+    errors: List[Dict[str, int]] = [{op: 0 for op in ops} for _ in range(threads)]
+    drivers = [make_driver() for _ in range(threads)]
+
+    def worker(idx: int) -> None:
+        rnd = random.Random(idx)
+        d, lat, err = drivers[idx], samples[idx], errors[idx]
+        start_evt.wait()
+        while time.perf_counter() < stop_at[0]:
+            op = rnd.choices(ops, weights)[0]
+            t0 = time.perf_counter()
+            if op == "create":
+                status, _ = d.post("/api/v1/keys", {"client_id": "load", "peer_id": "peer", "length": key_size}, headers)
+            elif op == "consume":
+                status, _ = d.post(f"/api/v1/consume/{rnd.choice(key_ids)}", {"bytes": consume_bytes}, headers)
+            else:
+                status, _ = d.get(f"/api/v1/material/{rnd.choice(key_ids)}?offset=0&bytes={consume_bytes}", headers)
+            lat[op].append(time.perf_counter() - t0)
+            if status >= 400:
+                err[op] += 1
+
+    pool = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    for t in pool:
+        t.start()
+    t_start = time.perf_counter()
+    stop_at[0] = t_start + duration
+    start_evt.set()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+
+    per_op = {}
+    total = 0
+    for op in ops:
+        lat = sorted(x for s in samples for x in s[op])
+        total += len(lat)
+        per_op[op] = {
+            "ops": len(lat),
+            "ops_s": len(lat) / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": percentile(lat, 50) * 1e3 if lat else 0.0,
+            "p99_ms": percentile(lat, 99) * 1e3 if lat else 0.0,
+            "errors": sum(e[op] for e in errors),
+        }
+    return {"threads": threads, "ops": total, "ops_s": total / elapsed if elapsed > 0 else 0.0, "per_op": per_op}
+
+
+@contextmanager
+def _simulator(args, persist: str):
+    """Yield a per-thread driver factory for a fresh simulator (or the ``--url`` one)."""
+    if args.url:
+        yield lambda: _HttpDriver(args.url.rstrip("/"))
+        return
+    workdir = tempfile.mkdtemp(prefix="km-load-")
+    env = {
+        # An empty path keeps the in-memory store entirely unpersisted
+        "KM_STORE_PATH": "" if persist == "none" else os.path.join(workdir, "km_store.json"),
+        "KM_PERSIST": persist if persist != "none" else "snapshot",
+        "KM_STORAGE": args.backend,
+        "KM_KEYGEN": args.keygen,
+        "KM_REAP_INTERVAL": str(args.reap_interval),
+    }
+    server = store = None
+    try:
+        with _env(**env):
+            app = create_app()
+        store = storage.get_store()
+        if args.transport == "http":
+            # Per-request access logging would dominate the measurement
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+            server, base_url = serve_in_thread(app=app)
+            yield lambda: _HttpDriver(base_url)
+        else:
+            yield lambda: _TestClientDriver(app)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if store is not None:
+            store.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_suite(args) -> List[Dict[str, object]]:
+    mix = parse_mix(args.mix)
+    results = []
+    quiet = args.json_out == "-"
+    for persist in args.persist:
+        with _simulator(args, persist) as make_driver:
+            setup = make_driver()
+            key_ids = _precreate(setup, args.keys, parse_size(args.key_length)) if set(mix) - {"create"} else []
+            for intrusion in args.intrusion:
+                setup.post("/api/v1/admin/intrusion", {"enabled": intrusion == "on"}, {})
+                for size in (parse_size(s) for s in args.key_sizes):
+                    for n in args.threads:
+                        r = run_case(make_driver, n, args.duration, mix, size, args.consume_bytes, key_ids, args.binary)
+                        r.update({"persist": persist, "intrusion": intrusion, "key_size": size})
+                        results.append(r)
+                        if not quiet:
+                            print(_format_row(r))
+            setup.post("/api/v1/admin/intrusion", {"enabled": False}, {})
+    if len(args.persist) > 1 and not quiet:
+        print(f"\nthroughput relative to persist={args.persist[0]}:")
+        for line in persistence_overhead(results, args.persist[0]):
+            print("  " + line)
+    return results
+
+
+def _format_row(r: Dict[str, object]) -> str:
+    ops = "  ".join(
+        f"{op} p50 {v['p50_ms']:7.2f} p99 {v['p99_ms']:7.2f} ms" + (f" ({v['errors']} err)" if v["errors"] else "")
+        for op, v in r["per_op"].items() if v["ops"]
+    )
+    return (f"{r['persist']:<8} intrusion {r['intrusion']:<3} {size_label(r['key_size']):>6} "
+            f"threads {r['threads']:>3}  {r['ops_s']:9.0f} ops/s  {ops}")
+
+
+def persistence_overhead(results: List[Dict[str, object]], base_mode: str) -> List[str]:
+    """Throughput of each persistence mode relative to ``base_mode`` for the same case."""
+    base = {(r["intrusion"], r["key_size"], r["threads"]): r["ops_s"] for r in results if r["persist"] == base_mode}
+    lines = []
+    for r in results:
+        ref = base.get((r["intrusion"], r["key_size"], r["threads"]))
+        if r["persist"] == base_mode or not ref:
+            continue
+        lines.append(f"{r['persist']:<8} intrusion {r['intrusion']:<3} {size_label(r['key_size']):>6} "
+                     f"threads {r['threads']:>3}  x{r['ops_s'] / ref:5.2f}  ({(1 - r['ops_s'] / ref) * 100:+.0f}% overhead)")
+    return lines
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="KM simulator load generator")
+    ap.add_argument("--transport", choices=("inprocess", "http"), default="inprocess",
+                    help="Flask test client, or localhost HTTP via serve_in_thread")
+    ap.add_argument("--url", help="drive an already running simulator over HTTP instead")
+    ap.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    ap.add_argument("--duration", type=float, default=2.0, help="seconds per case")
+    ap.add_argument("--key-sizes", nargs="+", default=["32", "4KB"], help="length of created keys, e.g. 32 4KB 1MB")
+    ap.add_argument("--mix", default="create=0.2,consume=0.8", help="operation weights, e.g. create=1,consume=3,material=1")
+    ap.add_argument("--consume-bytes", type=int, default=64, help="bytes per consume / material read")
+    ap.add_argument("--keys", type=int, default=64, help="pre-created keys shared by consume / material")
+    ap.add_argument("--key-length", default="1MB", help="length of the pre-created keys")
+    ap.add_argument("--intrusion", nargs="+", choices=("off", "on"), default=["off"])
+    ap.add_argument("--persist", nargs="+", choices=("none",) + storage.PERSIST_MODES, default=["none", "wal"])
+    ap.add_argument("--backend", choices=storage.STORE_BACKENDS, default="memory")
+    ap.add_argument("--keygen", default="pool", help="KM_KEYGEN for the simulator (os, pool, seeded)")
+    ap.add_argument("--reap-interval", type=float, default=0.0, help="KM_REAP_INTERVAL for the simulator (0 = off)")
+    ap.add_argument("--binary", action="store_true", help="ask for raw key bytes instead of base64 JSON")
+    ap.add_argument("--json", dest="json_out", help="write the report to this file ('-' for stdout)")
+    args = ap.parse_args(argv)
+    if args.url:
+        args.persist = args.persist[:1]
+
+    results = run_suite(args)
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.json_out == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
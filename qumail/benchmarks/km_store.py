@@ -0,0 +1,137 @@
+"""Concurrency benchmark for the KM simulator key store.
+
+Examples::
+
+    python -m qumail.benchmarks.km_store --threads 1 2 4 8 --persist wal
+    python -m qumail.benchmarks.km_store --stripes 1 --json one_lock.json
+
+Each worker thread runs a mix of ``consume`` (on a shared set of pre-created
+keys) and ``create_key`` calls directly against the store, with no HTTP in
+between. Throughput is reported per thread count, so contention shows up as
+flat or falling ops/s. ``--stripes 1`` approximates the old single-lock store
+for comparison. With ``--persist wal`` workers also wait on group fsyncs,
+which is where extra threads pay off most.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from ..km_simulator import keygen, storage
+from .common import percentile
+
+
+def _make_store(backend: str, persist: str, workdir: str, stripes: int, generator: str = "os"):
+    store = storage.configure_store(backend, keygen.create_generator(generator, seed=0))
+    if stripes and hasattr(store, "_stripes"):
+        store._stripes = [threading.Lock() for _ in range(stripes)]
+    if persist != "none":
+        # The sqlite backend ignores the mode and always writes its database file
+        store.set_path(os.path.join(workdir, "km_store.json"), mode=persist)
+    store.load()
+    return store
+
+
+def run_case(threads: int, backend: str, persist: str, duration: float, keys: int,
+             key_length: int, consume_bytes: int, create_ratio: float, stripes: int,
+             generator: str = "os") -> Dict[str, float]:
+    workdir = tempfile.mkdtemp(prefix="km-bench-")
+    try:
+        store = _make_store(backend, persist, workdir, stripes, generator)
+        key_ids = [it.key_id for it in store.create_keys("bench", "peer", keys, key_length)]
+        start_evt = threading.Event()
+        stop_at = [0.0]
+        per_thread: List[List[float]] = [[] for _ in range(threads)]
+        errors = [0]
+
+        def worker(idx: int) -> None:
+            rnd = random.Random(idx)
+            lat = per_thread[idx]
+            start_evt.wait()
+            while time.perf_counter() < stop_at[0]:
+                t0 = time.perf_counter()
+                try:
+                    if rnd.random() < create_ratio:
+                        store.create_key("bench", "peer", consume_bytes)
+                    else:
+                        store.consume(rnd.choice(key_ids), consume_bytes)
+                except ValueError:
+                    errors[0] += 1  # key ran out; keeps the loop honest without stopping it
+                lat.append(time.perf_counter() - t0)
+
+        pool = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+        for t in pool:
+            t.start()
+        t_start = time.perf_counter()
+        stop_at[0] = t_start + duration
+        start_evt.set()
+        for t in pool:
+            t.join()
+        elapsed = time.perf_counter() - t_start
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    samples = sorted(x for lat in per_thread for x in lat)
+    ops = len(samples)
+    return {
+        "threads": threads,
+        "ops": ops,
+        "ops_s": ops / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(samples, 50) * 1e3 if samples else 0.0,
+        "p99_ms": percentile(samples, 99) * 1e3 if samples else 0.0,
+        "errors": errors[0],
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="KM store concurrency benchmark")
+    ap.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--backend", choices=storage.STORE_BACKENDS, default="memory")
+    ap.add_argument("--persist", choices=("none",) + storage.PERSIST_MODES, default="none")
+    ap.add_argument("--duration", type=float, default=2.0, help="seconds per thread count")
+    ap.add_argument("--keys", type=int, default=256, help="pre-created keys shared by the workers")
+    ap.add_argument("--key-length", type=int, default=1 << 20)
+    ap.add_argument("--bytes", dest="consume_bytes", type=int, default=64, help="bytes per consume / created key")
+    ap.add_argument("--create-ratio", type=float, default=0.1, help="fraction of operations that create a key")
+    ap.add_argument("--keygen", choices=keygen.KEYGENS, default="os", help="key material generator")
+    ap.add_argument("--stripes", type=int, default=0, help="override the number of lock stripes (1 = single lock)")
+    ap.add_argument("--json", dest="json_out", help="write the report to this file ('-' for stdout)")
+    args = ap.parse_args(argv)
+
+    results = []
+    for n in args.threads:
+        r = run_case(n, args.backend, args.persist, args.duration, args.keys, args.key_length,
+                     args.consume_bytes, args.create_ratio, args.stripes, args.keygen)
+        results.append(r)
+        if args.json_out != "-":
+            base = results[0]["ops_s"] or 1.0
+            print(f"threads {n:>3}  {r['ops_s']:12.0f} ops/s  x{r['ops_s'] / base:5.2f}  "
+                  f"p50 {r['p50_ms']:8.3f} ms  p99 {r['p99_ms']:8.3f} ms")
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.json_out == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
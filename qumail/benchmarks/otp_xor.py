@@ -0,0 +1,49 @@
+"""Throughput comparison of the Level 1 OTP XOR engine.
+
+Run with ``python -m qumail.benchmarks.otp_xor [--sizes 1024 1048576 ...]``.
+The legacy per-byte list comprehension is only timed up to ``--legacy-max``
+bytes because it becomes impractically slow beyond that.
+"""
+import argparse
+import os
+import time
+
+from ..app.services.crypto_service import otp_xor
+
+
+def legacy_xor(data: bytes, key: bytes) -> bytes:
+    return bytes([p ^ k for p, k in zip(data, key[: len(data)])])
+
+
+def _throughput(fn, data: bytes, key: bytes, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(data, key)
+        best = min(best, time.perf_counter() - t0)
+    return len(data) / best / 1e6 if best > 0 else float("inf")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1024, 64 * 1024, 1 << 20, 16 << 20])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--legacy-max", type=int, default=4 << 20)
+    args = ap.parse_args(argv)
+
+    print(f"{'size':>12} {'legacy MB/s':>12} {'otp_xor MB/s':>13} {'speedup':>8}")
+    for size in args.sizes:
+        data = os.urandom(size)
+        key = os.urandom(size)
+        if size <= args.legacy_max and otp_xor(data, key) != legacy_xor(data, key):
+            raise SystemExit(f"otp_xor mismatch at size {size}")
+        fast = _throughput(otp_xor, data, key, args.repeat)
+        if size <= args.legacy_max:
+            slow = _throughput(legacy_xor, data, key, args.repeat)
+            print(f"{size:>12} {slow:>12.1f} {fast:>13.1f} {fast / slow:>7.1f}x")
+        else:
+            print(f"{size:>12} {'-':>12} {fast:>13.1f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,211 @@
-from flask import Flask, jsonify, request, Response, render_template_string, redirect
-from .storage import store
+from flask import Flask, g, jsonify, request, Response, render_template_string, redirect
+from . import keygen, link, metrics, ratelimit, replication, storage
 import base64
 import os
 import hmac
 import hashlib
+import json
 import random
+import time
+
+# Upper bound on keys issued by a single /api/v1/keys/batch call
+MAX_BATCH_KEYS = 1024
+OCTET_STREAM = "application/octet-stream"
+# mmap-backed key views are written to the socket in chunks of this size
+BODY_CHUNK = 256 << 10
+
+HTTP_REQUESTS = metrics.Counter("km_http_requests_total", "HTTP requests", ("route", "method", "status"))
+HTTP_LATENCY = metrics.Histogram("km_http_request_duration_seconds",
+                                 "Time until the response is built (streamed bodies not included)", ("route", "method"))
+RATE_LIMITED = metrics.Counter("km_rate_limited_total", "Key requests refused with 429", ("reason",))
+
+
+def _chunks(view: memoryview):
+    for i in range(0, len(view), BODY_CHUNK):
+        yield bytes(view[i:i + BODY_CHUNK])
 
 
 def create_app() -> Flask:
     app = Flask(__name__)
     INTEGRITY_SECRET = os.getenv("KM_INTEGRITY_SECRET", "change_this_demo_secret").encode()
     app.config["INTRUSION_ON"] = False
-    # Persist KM store across restarts (prevents 404 on consume after restart)
-    try:
-        from .storage import store
-        store_path = os.getenv("KM_STORE_PATH", ".km_store.json")
-        store.set_path(store_path)
-        store.load()
-    except Exception:
-        pass
+    # Key material in Python memory ("memory"), mmap'd slab files ("mmap") or a
+    # SQLite database shared by all worker processes ("sqlite")
+    # Key material comes from a background-filled entropy pool by default (KM_KEYGEN)
+    store = storage.configure_store(os.getenv("KM_STORAGE", "memory"), keygen.generator_from_env())
+    # Persist KM store across restarts (prevents 404 on consume after restart).
+    # A store that cannot be opened or read fails startup rather than silently
+    # serving an empty store.
+    store_path = os.getenv("KM_STORE_PATH", ".km_store.json")
+    # "wal" appends per-change records; "snapshot" rewrites the whole file each time
+    store.set_path(store_path, mode=os.getenv("KM_PERSIST", "wal"))
+    store.load()
+    # Evict expired / exhausted / fully consumed keys in the background (0 disables)
+    reap_interval = float(os.getenv("KM_REAP_INTERVAL", "5"))
+    if reap_interval > 0:
+        store.start_reaper(reap_interval)
+    # close_app() stops the store's background threads when the app is torn down
+    app.extensions["km_store"] = store
+
+    # Paired-node mode: replicate to KM_PEER_URL and accept the peer's changes
+    inbox = replication.ReplicaInbox(store, INTEGRITY_SECRET) if hasattr(store, "merge_remote") else None
+    replicator = replication.replicator_from_env(INTEGRITY_SECRET)
+    if replicator is not None:
+        if inbox is None:
+            raise ValueError("KM_PEER_URL replication needs the memory or mmap storage backend")
+        store.replicator = replicator
+        replicator.start(store.replica_records())
+
+    # Emulated QKD link rates per client/peer pair (KM_LINK_RATE_BPS=0 means unlimited)
+    links = link.links_from_env()
+
+    def _link_unavailable(wait: float, emu_link) -> Response:
+        """503 telling the client when the pair's key buffer will hold the request."""
+        resp = jsonify({"error": "key buffer empty", "retry_after": round(wait, 3), "link": emu_link.snapshot()})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = link.retry_after_header(wait)
+        return resp
+
+    def _draw_link(client_id: str, peer_id: str, length: int):
+        """Take ``length`` bytes from the pair's link; returns an error response or None."""
+        emu_link = links.link(client_id, peer_id)
+        if emu_link is None:
+            return None
+        try:
+            wait = emu_link.take(length)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return _link_unavailable(wait, emu_link) if wait > 0 else None
+
+    # Per client/peer request and key-byte budgets (KM_RATE_*=0 means unlimited),
+    # and round-robin admission across clients when KM_RATE_SLOTS is set
+    limiter = ratelimit.limiter_from_env()
+    scheduler = ratelimit.scheduler_from_env()
+
+    def _rate_limited(wait: float, reason: str) -> Response:
+        RATE_LIMITED.labels(reason).inc()
+        resp = jsonify({"error": "rate limited", "reason": reason, "retry_after": round(wait, 3)})
+        resp.status_code = 429
+        resp.headers["Retry-After"] = link.retry_after_header(wait)
+        return resp
+
+    def _admit(client_id: str, peer_id: str, size: int, count: int = 1):
+        """Charge the pair's rate limits and wait for a scheduler slot.
+
+        Returns (keys granted, error response or None); the byte budget may
+        grant fewer than ``count`` keys. Keys the link then cannot supply are
+        given back with :func:`_refund`, as is the whole charge when no
+        scheduler slot frees up in time. The slot is released on teardown.
+        """
+        limits = limiter.limits(client_id, peer_id)
+        if limits is not None:
+            try:
+                count, wait, reason = limits.take(size, count)
+            except ValueError as e:
+                return 0, (jsonify({"error": str(e)}), 400)
+            if not count:
+                return 0, _rate_limited(wait, reason)
+            g.km_charge = (limits, size, count)
+        if scheduler is not None:
+            wait = scheduler.acquire(client_id)
+            if wait:
+                # Not served, so the rate budget is not spent either
+                _refund(0)
+                return 0, _rate_limited(wait, "queue")
+            g.km_slot = True
+        return count, None
+
+    def _refund(issued: int) -> None:
+        """Return the rate tokens charged by :func:`_admit` for keys beyond ``issued``."""
+        charge = g.pop("km_charge", None)
+        if charge is not None:
+            limits, size, count = charge
+            if issued < count:
+                limits.refund(size, count - issued, request=not issued)
+
+    def _pin_material() -> None:
+        """Keep views of key material valid until the response is fully sent (see store.pin)."""
+        g.km_pin = store.pin()
+
+    @app.after_request
+    def _unpin_after_send(resp: Response) -> Response:
+        # Streamed bodies are still read from the views after the request
+        # context ends; buffered ones already hold a copy (unpinned on teardown)
+        if resp.is_streamed:
+            pin = g.pop("km_pin", None)
+            if pin is not None:
+                resp.call_on_close(lambda: store.unpin(pin))
+        return resp
+
+    @app.teardown_request
+    def _release_request(exc):
+        if g.pop("km_slot", False):
+            scheduler.release()
+        pin = g.pop("km_pin", None)
+        if pin is not None:
+            store.unpin(pin)
+
+    @app.before_request
+    def _start_timer():
+        g.km_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(resp: Response) -> Response:
+        # Route template, not the path, so key ids do not become label values
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        started = g.pop("km_started", None)
+        if started is not None:
+            HTTP_LATENCY.labels(route, request.method).observe(time.perf_counter() - started)
+        HTTP_REQUESTS.labels(route, request.method, resp.status_code).inc()
+        return resp
+
+    def _scrape_metrics() -> str:
+        """Gauges read from the store, key generator and links at scrape time."""
+        st = store.stats()
+        reaped = st["reaped"]
+        parts = [
+            metrics.render_samples("km_store_keys", "Keys held by the store", "gauge", [({}, st["keys"])]),
+            metrics.render_samples("km_store_reaped_keys_total", "Keys evicted by the reaper", "counter",
+                                   [({"reason": r}, reaped[r]) for r in ("expired", "exhausted", "consumed")]),
+            metrics.render_samples("km_store_reaped_bytes_total", "Key bytes zeroized by the reaper", "counter",
+                                   [({}, reaped["bytes"] + reaped.get("released", 0))]),
+            metrics.render_samples("km_intrusion_enabled", "1 while intrusion simulation is on", "gauge",
+                                   [({}, int(bool(app.config.get("INTRUSION_ON", False))))]),
+        ]
+        kg = store.keygen.stats()
+        if "available" in kg:
+            parts.append(metrics.render_samples("km_entropy_pool_available_bytes", "Bytes ready in the entropy pool",
+                                                "gauge", [({}, kg["available"])]))
+            parts.append(metrics.render_samples("km_entropy_pool_reads_total", "Entropy pool reads", "counter",
+                                                [({"result": "hit"}, kg["hits"]), ({"result": "miss"}, kg["misses"])]))
+        pairs = links.stats()
+        if pairs:
+            for name, help_, kind, field in (
+                ("km_link_available_bytes", "Key bytes buffered on the emulated link", "gauge", "available_bytes"),
+                ("km_link_fill_ratio", "Emulated link buffer fill (0-1)", "gauge", "fill"),
+                ("km_link_issued_bytes_total", "Key bytes drawn from the emulated link", "counter", "issued_bytes"),
+                ("km_link_throttled_total", "Requests refused or trimmed for lack of link key", "counter", "throttled"),
+            ):
+                parts.append(metrics.render_samples(name, help_, kind, [({"pair": p}, v[field]) for p, v in pairs.items()]))
+        if replicator is not None:
+            rs = replicator.stats()
+            parts.append(metrics.render_samples("km_replication_lag_records", "Changes not yet acknowledged by the peer",
+                                                "gauge", [({}, rs["lag_records"])]))
+            parts.append(metrics.render_samples("km_replication_lag_seconds", "Age of the oldest unacknowledged change",
+                                                "gauge", [({}, rs["lag_seconds"])]))
+            parts.append(metrics.render_samples("km_replication_batches_total", "Replication batches sent", "counter",
+                                                [({"result": "ok"}, rs["batches_sent"]),
+                                                 ({"result": "failed"}, rs["batches_failed"])]))
+        if scheduler is not None:
+            ss = scheduler.stats()
+            parts.append(metrics.render_samples("km_rate_active_requests", "Key requests holding a scheduler slot",
+                                                "gauge", [({}, ss["active"])]))
+            parts.append(metrics.render_samples("km_rate_waiting_requests", "Key requests queued for a slot",
+                                                "gauge", [({}, ss["waiting"])]))
+        if inbox is not None:
+            parts.append(metrics.render_samples("km_replication_received_records_total", "Changes merged from the peer",
+                                                "counter", [({}, inbox.stats()["records"])]))
+        return "".join(parts)
 
     def _hmac_hex(data: bytes) -> str:
         return hmac.new(INTEGRITY_SECRET, data, hashlib.sha256).hexdigest()
@@ -35,6 +222,68 @@ def create_app() -> Flask:
             b[i] ^= 0x01
         return bytes(b)
 
+    def _wants_binary() -> bool:
+        # Content negotiation: raw bytes only when preferred over JSON, so */* keeps JSON
+        accept = request.accept_mimetypes
+        return accept[OCTET_STREAM] > accept["application/json"]
+
+    def _binary_response(material: bytes, key_id: str, offset: int, extra: dict | None = None) -> Response:
+        """Key material as the body; key_id, offset and HMAC of the untampered bytes in headers."""
+        headers = {
+            "X-Key-Id": key_id,
+            "X-Key-Offset": str(offset),
+            "X-Key-Length": str(len(material)),
+            "X-Key-HMAC": _hmac_hex(material),
+        }
+        for k, v in (extra or {}).items():
+            if v is not None:
+                headers[k] = str(v)
+        body = _maybe_tamper(material)
+        if not isinstance(body, bytes):
+            # WSGI wants bytes: copy slab views out chunk by chunk rather than all at once
+            headers["Content-Length"] = str(len(body))
+            body = _chunks(body)
+        return Response(body, mimetype=OCTET_STREAM, headers=headers)
+
+    def _key_response(item) -> Response:
+        if _wants_binary():
+            return _binary_response(item.key_bytes, item.key_id, 0, {
+                "X-Key-Created-At": item.created_at,
+                "X-Key-Expires-At": item.expires_at,
+            })
+        return jsonify(_key_json(item))
+
+    def _key_json(item) -> dict:
+        original = item.key_bytes
+        resp_bytes = _maybe_tamper(original)
+        return {
+            "key_id": item.key_id,
+            "client_id": item.client_id,
+            "peer_id": item.peer_id,
+            "length": item.length,
+            "key_b64": base64.b64encode(resp_bytes).decode(),
+            "key_hmac": _hmac_hex(original),
+            "created_at": item.created_at,
+            "consumed": item.consumed,
+            "expires_at": item.expires_at,
+            "max_uses": item.max_uses,
+            "uses": item.uses,
+        }
+
+    def _key_meta(item) -> dict:
+        return {
+            "key_id": item.key_id,
+            "client_id": item.client_id,
+            "peer_id": item.peer_id,
+            "length": item.length,
+            "created_at": item.created_at,
+            "consumed": item.consumed,
+            "expires_at": item.expires_at,
+            "max_uses": item.max_uses,
+            "uses": item.uses,
+            "retain": item.retain,
+        }
+
     @app.get("/")
     def index():
         status = {"status": "ok", "intrusion": app.config.get("INTRUSION_ON", False)}
@@ -49,10 +298,25 @@ def create_app() -> Flask:
 
     @app.get("/api/v1/status")
     def status():
-        return jsonify({"status": "ok", "intrusion": app.config.get("INTRUSION_ON", False)})
+        return jsonify({"status": "ok", "intrusion": app.config.get("INTRUSION_ON", False),
+                        "store": store.stats(), "keygen": store.keygen.stats(), "links": links.stats(),
+                        "ratelimit": {
+                            "limits": limiter.stats(),
+                            "scheduler": scheduler.stats() if scheduler else None,
+                        },
+                        "replication": {
+                            "outbound": replicator.stats() if replicator else None,
+                            "inbound": inbox.stats() if inbox else None,
+                        }})
+
+    @app.get("/metrics")
+    def metrics_endpoint():
+        body = metrics.REGISTRY.render() + _scrape_metrics()
+        return Response(body, content_type=metrics.CONTENT_TYPE)
 
     @app.post("/api/v1/keys")
     def create_key():
+        _pin_material()
         data = request.get_json(force=True, silent=True) or {}
         client_id = data.get("client_id", "client")
         peer_id = data.get("peer_id", "peer")
@@ -63,26 +327,28 @@ def create_app() -> Flask:
         if isinstance(expires_in, (int, float)) and expires_in > 0:
             import time as _t
             expires_at = _t.time() + float(expires_in)
-        item = store.create_key(client_id, peer_id, length, expires_at=expires_at, max_uses=int(max_uses) if max_uses is not None else None)
-        original = item.key_bytes
-        resp_bytes = _maybe_tamper(original)
-        return jsonify({
-            "key_id": item.key_id,
-            "client_id": item.client_id,
-            "peer_id": item.peer_id,
-            "length": len(item.key_bytes),
-            "key_b64": base64.b64encode(resp_bytes).decode(),
-            "key_hmac": _hmac_hex(original),
-            "created_at": item.created_at,
-            "consumed": item.consumed,
-            "expires_at": item.expires_at,
-            "max_uses": item.max_uses,
-            "uses": item.uses,
-        })
+        # Keep consumed bytes readable via /material until expiry (shared OTP slabs)
+        retain = bool(data.get("retain", False))
+        if retain and expires_at is None:
+            return jsonify({"error": "retain requires expires_in"}), 400
+        _, limited = _admit(client_id, peer_id, length)
+        if limited is None:
+            limited = _draw_link(client_id, peer_id, length)
+            if limited is not None:
+                _refund(0)
+        if limited is not None:
+            return limited
+        item = store.create_key(client_id, peer_id, length, expires_at=expires_at,
+                                max_uses=int(max_uses) if max_uses is not None else None, retain=retain)
+        # "material": false creates the key without sending its bytes (OTP slabs consume ranges later)
+        if data.get("material", True) is False:
+            return jsonify(_key_meta(item))
+        return _key_response(item)
 
     @app.get("/api/v1/keys/new")
     def create_key_get():
         # Fallback endpoint for environments blocking POST
+        _pin_material()
         client_id = request.args.get("client_id", "client")
         peer_id = request.args.get("peer_id", "peer")
         try:
@@ -100,39 +366,61 @@ def create_app() -> Flask:
                     expires_at = _t.time() + val
             except Exception:
                 expires_at = None
+        _, limited = _admit(client_id, peer_id, length)
+        if limited is None:
+            limited = _draw_link(client_id, peer_id, length)
+            if limited is not None:
+                _refund(0)
+        if limited is not None:
+            return limited
         item = store.create_key(client_id, peer_id, length, expires_at=expires_at, max_uses=int(max_uses) if max_uses else None)
-        original = item.key_bytes
-        resp_bytes = _maybe_tamper(original)
-        return jsonify({
-            "key_id": item.key_id,
-            "client_id": item.client_id,
-            "peer_id": item.peer_id,
-            "length": len(item.key_bytes),
-            "key_b64": base64.b64encode(resp_bytes).decode(),
-            "key_hmac": _hmac_hex(original),
-            "created_at": item.created_at,
-            "consumed": item.consumed,
-            "expires_at": item.expires_at,
-            "max_uses": item.max_uses,
-            "uses": item.uses,
-        })
+        return _key_response(item)
+
+    @app.post("/api/v1/keys/batch")
+    def create_keys_batch():
+        # ETSI GS QKD 014-style enc_keys: many keys in one response and one store commit
+        _pin_material()
+        data = request.get_json(force=True, silent=True) or {}
+        client_id = data.get("client_id", "client")
+        peer_id = data.get("peer_id", "peer")
+        try:
+            number = int(data.get("number", 1))
+            size = int(data.get("size", data.get("length", 4096)))
+        except Exception:
+            return jsonify({"error": "invalid params"}), 400
+        if number <= 0 or number > MAX_BATCH_KEYS or size <= 0:
+            return jsonify({"error": f"number must be 1..{MAX_BATCH_KEYS} and size > 0"}), 400
+        expires_in = data.get("expires_in")
+        max_uses = data.get("max_uses")
+        expires_at = None
+        if isinstance(expires_in, (int, float)) and expires_in > 0:
+            import time as _t
+            expires_at = _t.time() + float(expires_in)
+        requested = number
+        number, limited = _admit(client_id, peer_id, size, number)
+        if limited is not None:
+            return limited
+        emu_link = links.link(client_id, peer_id)
+        if emu_link is not None:
+            # Partial availability: issue what the link buffer holds, 503 only when empty
+            try:
+                number, wait = emu_link.take_up_to(size, number)
+            except ValueError as e:
+                _refund(0)
+                return jsonify({"error": str(e)}), 400
+            # Only the keys actually issued stay charged
+            _refund(number)
+            if not number:
+                return _link_unavailable(wait, emu_link)
+        items = store.create_keys(client_id, peer_id, number, size, expires_at=expires_at, max_uses=int(max_uses) if max_uses is not None else None)
+        return jsonify({"keys": [_key_json(it) for it in items], "requested": requested, "partial": number < requested})
 
     @app.get("/api/v1/keys/<key_id>")
     def get_key(key_id: str):
         item = store.get_key(key_id)
         if not item:
             return jsonify({"error": "not found"}), 404
-        return jsonify({
-            "key_id": item.key_id,
-            "client_id": item.client_id,
-            "peer_id": item.peer_id,
-            "length": len(item.key_bytes),
-            "created_at": item.created_at,
-            "consumed": item.consumed,
-            "expires_at": item.expires_at,
-            "max_uses": item.max_uses,
-            "uses": item.uses,
-        })
+        return jsonify(_key_meta(item))
 
     @app.post("/api/v1/consume/<key_id>")
     @app.post("/api/v1/consume/<key_id>/")
@@ -141,8 +429,11 @@ def create_app() -> Flask:
         nbytes = int(data.get("bytes", 0))
         if nbytes <= 0:
             return jsonify({"error": "invalid bytes"}), 400
+        _pin_material()
         try:
             offset, slice_bytes = store.consume(key_id, nbytes)
+            if _wants_binary():
+                return _binary_response(slice_bytes, key_id, offset)
             original = slice_bytes
             resp_bytes = _maybe_tamper(original)
             return jsonify({
@@ -158,8 +449,8 @@ def create_app() -> Flask:
 
     @app.get("/api/v1/material/<key_id>")
     def material(key_id: str):
+        _pin_material()
         try:
-            from .storage import store
             item = store.get_key(key_id)
             if not item:
                 return jsonify({"error": "not found"}), 404
@@ -169,9 +460,15 @@ def create_app() -> Flask:
                 nbytes = int(request.args.get('bytes', '0'))
             except Exception:
                 return jsonify({"error": "invalid params"}), 400
-            if nbytes <= 0 or offset < 0 or (offset + nbytes) > len(item.key_bytes):
+            if nbytes <= 0 or offset < 0 or (offset + nbytes) > item.length:
                 return jsonify({"error": "range out of bounds"}), 400
-            sl = item.key_bytes[offset:offset+nbytes]
+            try:
+                sl = item.window(offset, offset + nbytes)
+            except ValueError as e:
+                # Consumed and released; gone for good
+                return jsonify({"error": str(e)}), 410
+            if _wants_binary():
+                return _binary_response(sl, key_id, offset)
             resp_bytes = _maybe_tamper(sl)
             return jsonify({
                 "offset": offset,
@@ -182,6 +479,41 @@ def create_app() -> Flask:
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
+    @app.post(replication.REPLICATE_PATH)
+    def replicate():
+        # Batches from the paired node, signed with the shared KM_INTEGRITY_SECRET
+        if inbox is None:
+            return jsonify({"error": "replication not supported by this store"}), 501
+        body = request.get_data()
+        if not inbox.verify(body, request.headers.get(replication.SIGNATURE_HEADER)):
+            return jsonify({"error": "bad signature"}), 403
+        try:
+            batch = json.loads(body)
+        except ValueError:
+            return jsonify({"error": "invalid json"}), 400
+        inbox.receive(batch)
+        return jsonify({"ok": True, "seq": batch.get("seq")})
+
+    @app.post("/api/v1/admin/reap")
+    def reap_now():
+        return jsonify({"reclaimed": store.reap(), "store": store.stats()})
+
+    @app.get("/api/v1/admin/links")
+    def get_links():
+        return jsonify({"default_rate_bps": links.default_rate_bps, "links": links.stats()})
+
+    @app.post("/api/v1/admin/links")
+    def set_link():
+        # {"client_id", "peer_id", "rate_bps", "buffer_bytes"}; rate_bps 0 removes the limit
+        data = request.get_json(force=True, silent=True) or {}
+        try:
+            rate = float(data.get("rate_bps", 0))
+            buffer_bytes = int(data["buffer_bytes"]) if data.get("buffer_bytes") else None
+            emu_link = links.set_rate(data.get("client_id", "client"), data.get("peer_id", "peer"), rate, buffer_bytes)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"link": emu_link.snapshot() if emu_link else None})
+
     # Admin toggle endpoints
     @app.get("/api/v1/admin/intrusion")
     def get_intrusion():
@@ -216,3 +548,24 @@ def create_app() -> Flask:
         return redirect("/admin")
 
     return app
+
+
+def close_app(app: Flask) -> None:
+    """Stop the background threads (reaper, replication, entropy pool) of an app from ``create_app``."""
+    store = app.extensions.pop("km_store", None)
+    if store is not None:
+        store.close()
+
+
+def serve_in_thread(host: str = "127.0.0.1", port: int = 0, app: Flask | None = None):
+    """Run the simulator on a background thread; returns (server, base_url).
+
+    ``port=0`` picks a free port. Call ``server.shutdown()`` and then
+    ``close_app(server.app)`` when done.
+    """
+    import threading
+    from werkzeug.serving import make_server
+
+    server = make_server(host, port, app or create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name="km-simulator", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
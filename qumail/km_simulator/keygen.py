@@ -0,0 +1,181 @@
+import hashlib
+import os
+import threading
+from abc import ABC, abstractmethod
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# Generators selectable with KM_KEYGEN: "os" calls os.urandom per key, "pool"
+# serves keys from a ring buffer refilled by a background thread, "seeded" is
+# a fast deterministic keystream for reproducible benchmarks and tests (never for real keys)
+KEYGENS = ("os", "pool", "seeded")
+# Default size of the entropy pool's ring buffer
+ENTROPY_POOL_BYTES = 4 << 20
+
+
+class KeyGenerator(ABC):
+    """Source of key material. Subclasses implement :meth:`read_into`."""
+
+    name = "base"
+
+    @abstractmethod
+    def read_into(self, view: memoryview) -> None:
+        """Fill ``view`` with fresh key material."""
+
+    def read(self, length: int) -> bytearray:
+        # bytearray so retired keys can be zeroized in place
+        buf = bytearray(length)
+        if length:
+            self.read_into(memoryview(buf))
+        return buf
+
+    def stats(self) -> dict:
+        return {"generator": self.name}
+
+    def close(self) -> None:
+        """Stop any background work; reads keep working afterwards."""
+
+
+class OsRandomGenerator(KeyGenerator):
+    name = "os"
+
+    def read_into(self, view: memoryview) -> None:
+        view[:] = os.urandom(len(view))
+
+
+class SeededGenerator(KeyGenerator):
+    """Deterministic material: an AES-256-CTR keystream keyed by SHA-256 of ``seed``.
+
+    The same seed and call order give the same keys. Much faster than
+    ``os.urandom`` or ``random.randbytes`` for large keys.
+    """
+
+    name = "seeded"
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        key = hashlib.sha256(str(seed).encode()).digest()
+        self._stream = Cipher(algorithms.AES(key), modes.CTR(bytes(16))).encryptor()
+        self._zeros = bytes(0)
+        self._lock = threading.Lock()
+
+    def read_into(self, view: memoryview) -> None:
+        n = len(view)
+        with self._lock:
+            if len(self._zeros) < n:
+                self._zeros = bytes(n)
+            view[:] = self._stream.update(memoryview(self._zeros)[:n])
+
+    def stats(self) -> dict:
+        return {"generator": self.name, "seed": self.seed}
+
+
+class EntropyPool(KeyGenerator):
+    """Ring buffer of OS randomness kept topped up by a background thread.
+
+    ``read_into`` is a copy out of the ring under a short lock, so key creation
+    never waits on the kernel RNG. Reads larger than half the ring, or made
+    while the ring is drained, go straight to ``source`` and count as misses.
+    Served bytes are never handed out twice: the refill overwrites them.
+    """
+
+    name = "pool"
+
+    def __init__(self, capacity: int = ENTROPY_POOL_BYTES, source: KeyGenerator | None = None,
+                 refill_chunk: int | None = None):
+        self.capacity = int(capacity)
+        self.source = source or OsRandomGenerator()
+        self.refill_chunk = int(refill_chunk or max(4096, self.capacity // 8))
+        self._ring = bytearray(self.capacity)
+        self._view = memoryview(self._ring)
+        self._head = 0  # next byte to serve
+        self._avail = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self._thread = threading.Thread(target=self._fill, name="km-entropy", daemon=True)
+        self._thread.start()
+
+    def _fill(self) -> None:
+        chunk = bytearray(self.refill_chunk)
+        chunk_view = memoryview(chunk)
+        while True:
+            with self._cond:
+                while self.capacity - self._avail < self.refill_chunk and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # Generate outside the lock; readers keep draining meanwhile
+            self.source.read_into(chunk_view)
+            with self._cond:
+                self._copy_in(chunk_view, (self._head + self._avail) % self.capacity)
+                self._avail += self.refill_chunk
+                self._cond.notify_all()
+
+    def _copy_in(self, src: memoryview, pos: int) -> None:
+        first = min(len(src), self.capacity - pos)
+        self._view[pos:pos + first] = src[:first]
+        if first < len(src):
+            self._view[:len(src) - first] = src[first:]
+
+    def read_into(self, view: memoryview) -> None:
+        n = len(view)
+        with self._cond:
+            if n <= self.capacity // 2 and self._avail >= n:
+                head = self._head
+                first = min(n, self.capacity - head)
+                view[:first] = self._view[head:head + first]
+                if first < n:
+                    view[first:] = self._view[:n - first]
+                self._head = (head + n) % self.capacity
+                self._avail -= n
+                self.hits += 1
+                self._cond.notify_all()
+                return
+            self.misses += 1
+            self._cond.notify_all()
+        self.source.read_into(view)
+
+    def wait_full(self, timeout: float | None = None) -> bool:
+        """Block until the ring is (nearly) full; handy before a benchmark run."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.capacity - self._avail < self.refill_chunk, timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "generator": self.name,
+                "capacity": self.capacity,
+                "available": self._avail,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def close(self) -> None:
+        """Stop the refill thread and wait for it; later reads go straight to ``source``."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout=5.0)
+
+
+def create_generator(kind: str = "os", seed: int | None = None, pool_bytes: int = ENTROPY_POOL_BYTES) -> KeyGenerator:
+    if kind == "os":
+        return OsRandomGenerator()
+    if kind == "pool":
+        return EntropyPool(pool_bytes)
+    if kind == "seeded":
+        return SeededGenerator(0 if seed is None else seed)
+    raise ValueError(f"Unknown KM key generator: {kind} (expected one of {KEYGENS})")
+
+
+def generator_from_env() -> KeyGenerator:
+    """Generator configured by KM_KEYGEN, KM_KEYGEN_SEED and KM_ENTROPY_POOL_BYTES."""
+    seed = os.getenv("KM_KEYGEN_SEED")
+    return create_generator(
+        os.getenv("KM_KEYGEN", "pool"),
+        seed=int(seed) if seed else None,
+        pool_bytes=int(os.getenv("KM_ENTROPY_POOL_BYTES", str(ENTROPY_POOL_BYTES))),
+    )
@@ -0,0 +1,143 @@
+import math
+import os
+import threading
+import time
+
+# Key buffer per link when KM_LINK_BUFFER_BYTES is not set
+LINK_BUFFER_BYTES = 1 << 20
+
+
+class KeyLink:
+    """One emulated QKD link: secret key accrues at ``rate_bps`` into a bounded buffer.
+
+    Issuing a key draws its length from the buffer. Key generated while the
+    buffer is full is lost, as on a real link whose KM does not pick it up.
+    """
+
+    def __init__(self, rate_bps: float, capacity: int = LINK_BUFFER_BYTES, fill: float = 1.0):
+        if rate_bps <= 0 or capacity <= 0:
+            raise ValueError("rate_bps and capacity must be positive")
+        self.rate_bps = float(rate_bps)
+        self.capacity = int(capacity)
+        self._level = self.capacity * min(max(fill, 0.0), 1.0)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.throttled = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._stamp) * self.rate_bps / 8)
+        self._stamp = now
+
+    def _wait_for(self, nbytes: int) -> float:
+        return (nbytes - self._level) * 8 / self.rate_bps
+
+    def take(self, nbytes: int) -> float:
+        """Draw ``nbytes``; returns 0.0 on success or the seconds until they will be available."""
+        if nbytes > self.capacity:
+            raise ValueError(f"key length {nbytes} exceeds the link buffer ({self.capacity} bytes)")
+        with self._lock:
+            self._refill()
+            if self._level < nbytes:
+                self.throttled += 1
+                return self._wait_for(nbytes)
+            self._level -= nbytes
+            self.issued += nbytes
+            return 0.0
+
+    def take_up_to(self, nbytes: int, count: int) -> tuple[int, float]:
+        """Draw as many ``nbytes`` keys as the buffer holds, up to ``count``.
+
+        Returns (granted, seconds until the next key would be available when
+        none were granted, else 0.0).
+        """
+        if nbytes > self.capacity:
+            raise ValueError(f"key length {nbytes} exceeds the link buffer ({self.capacity} bytes)")
+        with self._lock:
+            self._refill()
+            granted = min(count, int(self._level // nbytes))
+            if not granted:
+                self.throttled += 1
+                return 0, self._wait_for(nbytes)
+            self._level -= granted * nbytes
+            self.issued += granted * nbytes
+            return granted, 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._refill()
+            return {
+                "rate_bps": self.rate_bps,
+                "buffer_bytes": self.capacity,
+                "available_bytes": int(self._level),
+                "fill": round(self._level / self.capacity, 4),
+                "issued_bytes": self.issued,
+                "throttled": self.throttled,
+            }
+
+
+class LinkEmulator:
+    """Per client/peer-pair :class:`KeyLink` registry.
+
+    A pair shares one link in both directions. Pairs without an explicit rate
+    use ``default_rate_bps``; a rate of 0 means unlimited (no emulation).
+    """
+
+    def __init__(self, default_rate_bps: float = 0.0, buffer_bytes: int = LINK_BUFFER_BYTES,
+                 rates: dict[tuple[str, str], float] | None = None):
+        self.default_rate_bps = float(default_rate_bps)
+        self.buffer_bytes = int(buffer_bytes)
+        self._links: dict[tuple[str, str], KeyLink | None] = {}
+        self._lock = threading.Lock()
+        for (a, b), rate in (rates or {}).items():
+            self.set_rate(a, b, rate)
+
+    @staticmethod
+    def _pair(client_id: str, peer_id: str) -> tuple[str, str]:
+        return tuple(sorted((client_id, peer_id)))
+
+    def link(self, client_id: str, peer_id: str) -> KeyLink | None:
+        """The link for this pair, or None when its key supply is unlimited."""
+        pair = self._pair(client_id, peer_id)
+        with self._lock:
+            if pair not in self._links:
+                self._links[pair] = KeyLink(self.default_rate_bps, self.buffer_bytes) if self.default_rate_bps > 0 else None
+            return self._links[pair]
+
+    def set_rate(self, client_id: str, peer_id: str, rate_bps: float, buffer_bytes: int | None = None) -> KeyLink | None:
+        """Set (or with ``rate_bps`` 0, remove) the rate for a pair; the new buffer starts full."""
+        pair = self._pair(client_id, peer_id)
+        link = KeyLink(rate_bps, buffer_bytes or self.buffer_bytes) if rate_bps > 0 else None
+        with self._lock:
+            self._links[pair] = link
+        return link
+
+    def stats(self) -> dict:
+        with self._lock:
+            links = dict(self._links)
+        return {f"{a}~{b}": link.snapshot() for (a, b), link in sorted(links.items()) if link is not None}
+
+
+def retry_after_header(seconds: float) -> str:
+    # Retry-After takes whole seconds; round up so clients never retry too early
+    return str(max(1, math.ceil(seconds)))
+
+
+def links_from_env() -> LinkEmulator:
+    """Emulator configured by KM_LINK_RATE_BPS, KM_LINK_BUFFER_BYTES and KM_LINK_RATES.
+
+    KM_LINK_RATES lists per-pair overrides as ``Alice:Bob=100000,Carol:Dave=5e6``.
+    """
+    rates = {}
+    for entry in os.getenv("KM_LINK_RATES", "").split(","):
+        if "=" not in entry:
+            continue
+        pair, rate = entry.split("=", 1)
+        a, _, b = pair.strip().partition(":")
+        rates[(a, b)] = float(rate)
+    return LinkEmulator(
+        float(os.getenv("KM_LINK_RATE_BPS", "0")),
+        int(os.getenv("KM_LINK_BUFFER_BYTES", str(LINK_BUFFER_BYTES))),
+        rates,
+    )
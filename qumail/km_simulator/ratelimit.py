@@ -0,0 +1,237 @@
+import os
+import threading
+import time
+from collections import deque
+
+# Burst allowances when KM_RATE_REQUEST_BURST / KM_RATE_BYTE_BURST are not set
+REQUEST_BURST = 20
+BYTE_BURST = 4 << 20
+
+
+class TokenBucket:
+    """``rate`` tokens per second accrue up to ``burst``. Callers hold the lock."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_for(self, n: float) -> float:
+        return (n - self.tokens) / self.rate
+
+
+class ClientLimits:
+    """Request and key-byte buckets for one client_id/peer_id pair; either may be None (unlimited)."""
+
+    def __init__(self, request_rate: float, request_burst: float, byte_rate: float, byte_burst: float):
+        now = time.monotonic()
+        self.requests = TokenBucket(request_rate, max(1.0, request_burst), now) if request_rate > 0 else None
+        self.bytes = TokenBucket(byte_rate, byte_burst, now) if byte_rate > 0 else None
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, size: int, count: int = 1) -> tuple[int, float, str | None]:
+        """Spend one request token and up to ``count`` keys of ``size`` bytes.
+
+        Returns (granted, seconds until a retry could pass, limiting bucket);
+        granted is 0 when over either limit, else the wait is 0.0.
+        """
+        if self.bytes is not None and size > self.bytes.burst:
+            raise ValueError(f"key length {size} exceeds the per-client byte burst ({int(self.bytes.burst)} bytes)")
+        with self._lock:
+            now = time.monotonic()
+            if self.requests is not None:
+                self.requests.refill(now)
+                if self.requests.tokens < 1:
+                    self.limited += 1
+                    return 0, self.requests.wait_for(1), "requests"
+            granted = count
+            if self.bytes is not None:
+                self.bytes.refill(now)
+                granted = min(count, int(self.bytes.tokens // size)) if size else count
+                if not granted:
+                    self.limited += 1
+                    return 0, self.bytes.wait_for(size), "bytes"
+                self.bytes.tokens -= granted * size
+            if self.requests is not None:
+                self.requests.tokens -= 1
+            self.allowed += 1
+            return granted, 0.0, None
+
+    def refund(self, size: int, count: int, request: bool = False) -> None:
+        """Give back ``count`` keys of ``size`` bytes from a :meth:`take` that could not be served.
+
+        ``request`` also returns the request token, for a request that issued
+        nothing; it then no longer counts as allowed.
+        """
+        with self._lock:
+            if self.bytes is not None:
+                self.bytes.tokens = min(self.bytes.burst, self.bytes.tokens + count * size)
+            if request:
+                if self.requests is not None:
+                    self.requests.tokens = min(self.requests.burst, self.requests.tokens + 1)
+                self.allowed -= 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            out = {"allowed": self.allowed, "limited": self.limited}
+            for name, bucket in (("requests", self.requests), ("bytes", self.bytes)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    out[name] = {"rate": bucket.rate, "burst": bucket.burst, "available": int(bucket.tokens)}
+            return out
+
+
+class RateLimiter:
+    """Per client_id/peer_id token buckets for key issuance.
+
+    Each pair may make ``request_rate`` key requests per second and draw
+    ``byte_rate`` bytes of key material per second, with bursts of
+    ``request_burst`` requests and ``byte_burst`` bytes. A rate of 0 disables
+    that limit. Unlike :class:`~.link.LinkEmulator` the pair is directional:
+    Alice->Bob and Bob->Alice have separate budgets.
+    """
+
+    def __init__(self, request_rate: float = 0.0, request_burst: float = REQUEST_BURST,
+                 byte_rate: float = 0.0, byte_burst: float = BYTE_BURST):
+        self.request_rate = float(request_rate)
+        self.request_burst = float(request_burst)
+        self.byte_rate = float(byte_rate)
+        self.byte_burst = float(byte_burst)
+        self._clients: dict[tuple[str, str], ClientLimits] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.request_rate > 0 or self.byte_rate > 0
+
+    def limits(self, client_id: str, peer_id: str) -> ClientLimits | None:
+        """The pair's buckets, or None when rate limiting is off."""
+        if not self.enabled:
+            return None
+        pair = (client_id, peer_id)
+        limits = self._clients.get(pair)
+        if limits is None:
+            with self._lock:
+                limits = self._clients.setdefault(pair, ClientLimits(
+                    self.request_rate, self.request_burst, self.byte_rate, self.byte_burst))
+        return limits
+
+    def stats(self) -> dict:
+        with self._lock:
+            clients = dict(self._clients)
+        return {f"{a}>{b}": limits.snapshot() for (a, b), limits in sorted(clients.items())}
+
+
+class _Ticket:
+    __slots__ = ("granted",)
+
+    def __init__(self) -> None:
+        self.granted = False
+
+
+class FairScheduler:
+    """Round-robin admission of key-issuing requests across clients.
+
+    At most ``slots`` requests are served at once. Further requests wait in a
+    per-client queue (at most ``queue_depth`` each, for at most ``max_wait``
+    seconds), and a freed slot goes to the next client in turn rather than to
+    whichever thread wakes first, so a client with many connections gets the
+    same share as a client with one.
+    """
+
+    def __init__(self, slots: int, queue_depth: int = 16, max_wait: float = 2.0):
+        if slots <= 0:
+            raise ValueError("slots must be positive")
+        self.slots = int(slots)
+        self.queue_depth = int(queue_depth)
+        self.max_wait = float(max_wait)
+        self._cond = threading.Condition()
+        self._active = 0
+        # client -> waiting tickets; dict order is the round-robin order
+        self._queues: dict[str, deque[_Ticket]] = {}
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def acquire(self, client: str) -> float:
+        """Wait for a slot; returns 0.0 once admitted, else seconds the client should back off."""
+        with self._cond:
+            if self._active < self.slots and not self._queues:
+                self._active += 1
+                self.admitted += 1
+                return 0.0
+            queue = self._queues.get(client)
+            if queue is not None and len(queue) >= self.queue_depth:
+                self.rejected += 1
+                return self.max_wait
+            if queue is None:
+                queue = self._queues[client] = deque()
+            ticket = _Ticket()
+            queue.append(ticket)
+            self.queued += 1
+            if self._cond.wait_for(lambda: ticket.granted, self.max_wait):
+                return 0.0
+            # Timed out: still queued, since granting happens under this lock
+            queue.remove(ticket)
+            if not queue and self._queues.get(client) is queue:
+                del self._queues[client]
+            self.rejected += 1
+            return self.max_wait
+
+    def release(self) -> None:
+        with self._cond:
+            if not self._queues:
+                self._active -= 1
+                return
+            # Hand the slot straight to the head of the next client's queue
+            client, queue = next(iter(self._queues.items()))
+            queue.popleft().granted = True
+            del self._queues[client]
+            if queue:
+                self._queues[client] = queue
+            self.admitted += 1
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "active": self._active,
+                "waiting": sum(len(q) for q in self._queues.values()),
+                "waiting_clients": len(self._queues),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+            }
+
+
+def limiter_from_env() -> RateLimiter:
+    """Limiter configured by KM_RATE_REQUESTS, KM_RATE_BYTES and their *_BURST settings."""
+    return RateLimiter(
+        float(os.getenv("KM_RATE_REQUESTS", "0")),
+        float(os.getenv("KM_RATE_REQUEST_BURST", str(REQUEST_BURST))),
+        float(os.getenv("KM_RATE_BYTES", "0")),
+        float(os.getenv("KM_RATE_BYTE_BURST", str(BYTE_BURST))),
+    )
+
+
+def scheduler_from_env() -> FairScheduler | None:
+    """Scheduler configured by KM_RATE_SLOTS, KM_RATE_QUEUE_DEPTH and KM_RATE_QUEUE_WAIT; None when slots is 0."""
+    slots = int(os.getenv("KM_RATE_SLOTS", "0"))
+    if slots <= 0:
+        return None
+    return FairScheduler(
+        slots,
+        int(os.getenv("KM_RATE_QUEUE_DEPTH", "16")),
+        float(os.getenv("KM_RATE_QUEUE_WAIT", "2")),
+    )
@@ -0,0 +1,235 @@
+"""Key-store replication between the two KM nodes of a QKD link.
+
+Each node runs a :class:`Replicator` that streams its own key creations and
+consume offsets to the paired node, and a :class:`ReplicaInbox` that merges
+what the peer sends. Merging is order-independent: a creation is ignored when
+the key already exists and offsets merge as the max of both sides, so batches
+can be pipelined (several in flight) and retried without sequencing. A consume
+offset that arrives before its key is parked until the creation shows up.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPLICATE_PATH = "/api/v1/replicate"
+SIGNATURE_HEADER = "X-Replication-HMAC"
+# Parked consume offsets whose key never arrived are dropped after this long
+ORPHAN_TTL = 60.0
+
+
+def sign(secret: bytes, body: bytes) -> str:
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def _wire(rec: dict) -> dict:
+    if "material" not in rec:
+        return rec
+    out = dict(rec)
+    out["key_b64"] = base64.b64encode(out.pop("material")).decode()
+    return out
+
+
+class Replicator:
+    """Batches local store changes and ships them to the paired node.
+
+    ``enqueue`` is called under the store's locks and never blocks. A sender
+    thread collects up to ``batch_size`` records (waiting ``linger`` seconds
+    for more), and up to ``max_inflight`` batches are posted concurrently;
+    failed batches are retried with backoff until acknowledged. Lag is bounded:
+    ``backpressure()`` (called after the store releases its locks) blocks
+    writers for up to ``block_timeout`` while more than ``max_pending`` records
+    are unacknowledged.
+    """
+
+    def __init__(self, peer_url: str, node_id: str, secret: bytes, batch_size: int = 256,
+                 max_inflight: int = 4, max_pending: int = 10000, linger: float = 0.005,
+                 block_timeout: float = 2.0, timeout: float = 5.0):
+        self.peer_url = peer_url.rstrip("/")
+        self.node_id = node_id
+        self.secret = secret
+        self.batch_size = int(batch_size)
+        self.max_inflight = int(max_inflight)
+        self.max_pending = int(max_pending)
+        self.linger = linger
+        self.block_timeout = block_timeout
+        self.timeout = timeout
+        self.epoch = uuid.uuid4().hex[:12]
+        self._queue: deque[tuple[float, dict]] = deque()
+        self._cond = threading.Condition()
+        self._inflight: dict[int, tuple[float, int]] = {}  # batch seq -> (oldest enqueue time, records)
+        self._seq = 0
+        self._stop = False
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=self.max_inflight, thread_name_prefix="km-replica")
+        self._thread: threading.Thread | None = None
+        self.batches_sent = 0
+        self.batches_failed = 0
+        self.records_sent = 0
+        self.throttled = 0
+        self.last_ack: float | None = None
+
+    def start(self, initial: list[dict] | None = None) -> None:
+        """Start shipping; ``initial`` (the store's current state) is sent first to catch the peer up."""
+        if initial:
+            self.enqueue(initial)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="km-replicator", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def enqueue(self, records: list[dict]) -> None:
+        now = time.monotonic()
+        with self._cond:
+            self._queue.extend((now, rec) for rec in records)
+            self._cond.notify_all()
+
+    def _pending(self) -> int:
+        return len(self._queue) + sum(n for _, n in self._inflight.values())
+
+    def backpressure(self) -> None:
+        """Block while too many records are unacknowledged (bounded by ``block_timeout``)."""
+        with self._cond:
+            if self._pending() <= self.max_pending:
+                return
+            self.throttled += 1
+            self._cond.wait_for(lambda: self._stop or self._pending() <= self.max_pending, self.block_timeout)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stop or (self._queue and len(self._inflight) < self.max_inflight))
+                if self._stop:
+                    return
+            if self.linger > 0 and len(self._queue) < self.batch_size:
+                # Let a burst of changes fill the batch
+                time.sleep(self.linger)
+            with self._cond:
+                n = min(self.batch_size, len(self._queue))
+                if not n:
+                    continue
+                batch = [self._queue.popleft() for _ in range(n)]
+                self._seq += 1
+                seq = self._seq
+                self._inflight[seq] = (batch[0][0], n)
+            self._pool.submit(self._ship, seq, [rec for _, rec in batch])
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    def _ship(self, seq: int, records: list[dict]) -> None:
+        body = json.dumps({
+            "node": self.node_id, "epoch": self.epoch, "seq": seq,
+            "records": [_wire(r) for r in records],
+        }, separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json", SIGNATURE_HEADER: sign(self.secret, body)}
+        delay = 0.1
+        while not self._stop:
+            try:
+                r = self._session().post(self.peer_url + REPLICATE_PATH, data=body, headers=headers, timeout=self.timeout)
+                if r.status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            with self._cond:
+                self.batches_failed += 1
+                self._cond.wait_for(lambda: self._stop, delay)
+            delay = min(delay * 2, 5.0)
+        with self._cond:
+            self._inflight.pop(seq, None)
+            self.batches_sent += 1
+            self.records_sent += len(records)
+            self.last_ack = time.time()
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            oldest = [t for t, _ in self._inflight.values()]
+            if self._queue:
+                oldest.append(self._queue[0][0])
+            return {
+                "peer": self.peer_url,
+                "node": self.node_id,
+                "lag_records": self._pending(),
+                "lag_seconds": round(now - min(oldest), 4) if oldest else 0.0,
+                "inflight_batches": len(self._inflight),
+                "batches_sent": self.batches_sent,
+                "batches_failed": self.batches_failed,
+                "records_sent": self.records_sent,
+                "throttled": self.throttled,
+                "last_ack": self.last_ack,
+            }
+
+
+class ReplicaInbox:
+    """Merges batches from the paired node into the local store (``store.merge_remote``)."""
+
+    def __init__(self, store, secret: bytes):
+        self.store = store
+        self.secret = secret
+        self._lock = threading.Lock()
+        # key_id -> (parked at, max 'u' record seen) for offsets that beat their key here
+        self._orphans: dict[str, tuple[float, dict]] = {}
+        self._pruned = 0.0
+        self.batches = 0
+        self.records = 0
+        self.peers: dict[str, dict] = {}
+
+    def verify(self, body: bytes, signature: str | None) -> bool:
+        return bool(signature) and hmac.compare_digest(sign(self.secret, body), signature)
+
+    def receive(self, batch: dict) -> None:
+        records = batch.get("records", [])
+        now = time.monotonic()
+        # One batch at a time, so a creation and its parked offset cannot race
+        with self._lock:
+            for rec in self.store.merge_remote(records):
+                parked = self._orphans.get(rec["id"])
+                if parked is None or int(rec["n"]) > int(parked[1]["n"]):
+                    self._orphans[rec["id"]] = (now, rec)
+            retry = [self._orphans.pop(r["id"])[1] for r in records if r.get("op") == "c" and r["id"] in self._orphans]
+            if retry:
+                self.store.merge_remote(retry)
+            if self._orphans and now - self._pruned > 1.0:
+                self._pruned = now
+                self._orphans = {k: v for k, v in self._orphans.items() if now - v[0] < ORPHAN_TTL}
+            self.batches += 1
+            self.records += len(records)
+            self.peers[batch.get("node", "?")] = {"epoch": batch.get("epoch"), "seq": batch.get("seq"), "at": time.time()}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"batches": self.batches, "records": self.records,
+                    "orphans": len(self._orphans), "peers": dict(self.peers)}
+
+
+def replicator_from_env(secret: bytes) -> Replicator | None:
+    """Replicator configured by KM_PEER_URL, KM_NODE_ID and KM_REPLICATION_*; None when there is no peer."""
+    peer = os.getenv("KM_PEER_URL", "").strip()
+    if not peer:
+        return None
+    return Replicator(
+        peer,
+        os.getenv("KM_NODE_ID", "km"),
+        secret,
+        batch_size=int(os.getenv("KM_REPLICATION_BATCH", "256")),
+        max_inflight=int(os.getenv("KM_REPLICATION_INFLIGHT", "4")),
+        max_pending=int(os.getenv("KM_REPLICATION_MAX_PENDING", "10000")),
+    )
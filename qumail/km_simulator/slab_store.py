@@ -0,0 +1,257 @@
+import bisect
+import errno
+import mmap
+import os
+import threading
+
+from .keygen import KeyGenerator
+from .storage import RELEASE_BYTES, InMemoryStore, KeyItem
+
+# Size of each preallocated slab file; a key larger than this gets its own segment
+SLAB_SEGMENT_BYTES = 64 << 20
+
+
+class _Segment:
+    """One fixed-size slab, file-backed (or anonymous when the store has no path).
+
+    Space is handed out from ``free`` (sorted, coalesced (offset, length)
+    holes left by wiped material) first, then from the untouched tail at ``used``.
+    """
+
+    def __init__(self, path: str | None, size: int, create: bool = True):
+        if path is None:
+            self.mm = mmap.mmap(-1, size)
+        else:
+            exists = os.path.exists(path)
+            if not exists and not create:
+                raise FileNotFoundError(errno.ENOENT, "slab segment missing", path)
+            with open(path, 'r+b' if exists else 'w+b') as f:
+                if not exists:
+                    f.truncate(size)  # sparse preallocation
+                size = os.fstat(f.fileno()).st_size
+                self.mm = mmap.mmap(f.fileno(), size)
+        self.size = size
+        self.view = memoryview(self.mm)
+        self.used = 0
+        self.free: list[tuple[int, int]] = []
+        self.dirty: tuple[int, int] | None = None
+
+    def take(self, length: int) -> int | None:
+        """Offset of ``length`` bytes (first fit), or None if this segment has no room."""
+        for i, (off, n) in enumerate(self.free):
+            if n >= length:
+                if n == length:
+                    del self.free[i]
+                else:
+                    self.free[i] = (off + length, n - length)
+                return off
+        if self.size - self.used >= length:
+            off = self.used
+            self.used += length
+            return off
+        return None
+
+    def give(self, off: int, length: int) -> None:
+        """Return a wiped range, merging it with neighbouring holes and the tail."""
+        if length <= 0:
+            return
+        i = bisect.bisect(self.free, (off, length))
+        if i < len(self.free) and off + length == self.free[i][0]:
+            length += self.free.pop(i)[1]
+        if i and sum(self.free[i - 1]) == off:
+            i -= 1
+            off, length = self.free[i][0], self.free.pop(i)[1] + length
+        if off + length == self.used:
+            self.used = off
+        else:
+            self.free.insert(i, (off, length))
+
+    def rebuild(self, live: list[tuple[int, int]]) -> None:
+        """Derive ``free`` and ``used`` from the sorted (offset, length) ranges still in use."""
+        self.free = []
+        end = 0
+        for off, n in live:
+            if off > end:
+                self.free.append((end, off - end))
+            end = max(end, off + n)
+        self.used = end
+
+    def dead(self, lo: int, hi: int) -> list[tuple[int, int]]:
+        """The parts of [lo, hi) that no key holds."""
+        out = []
+        for off, n in self.free[max(0, bisect.bisect(self.free, (lo, 0)) - 1):]:
+            if off >= hi:
+                break
+            if off + n > lo:
+                out.append((max(lo, off), min(hi, off + n)))
+        if hi > self.used:
+            out.append((max(lo, self.used), hi))
+        return out
+
+    def mark_dirty(self, lo: int, hi: int) -> None:
+        if self.dirty is None:
+            self.dirty = (lo, hi)
+        else:
+            self.dirty = (min(lo, self.dirty[0]), max(hi, self.dirty[1]))
+
+    def sync(self) -> None:
+        if self.dirty is None:
+            return
+        lo, hi = self.dirty
+        lo -= lo % mmap.ALLOCATIONGRANULARITY  # flush offsets must be page aligned
+        self.mm.flush(lo, hi - lo)
+        self.dirty = None
+
+
+class SlabStore(InMemoryStore):
+    """Key store whose material lives in mmap'd slab files instead of Python bytes.
+
+    Only the index (key_id, segment, offset and length of the held range,
+    consumed and policy fields) is kept in the snapshot and write-ahead log, so startup reads the
+    index and maps the slabs without touching key bytes. ``KeyItem.key_bytes``
+    is a memoryview into the mapping and consume/material slices are
+    zero-copy views of it. Slabs are never resized, so views stay valid.
+    Space from released prefixes and evicted keys goes back to its segment's
+    free list once it has been wiped (that is, once no pinned reader can see
+    it) and is reused by later keys; load rebuilds the free lists from the
+    index. A segment file the index refers to must exist: load raises rather
+    than map zeros in its place.
+    """
+
+    def __init__(self, segment_bytes: int = SLAB_SEGMENT_BYTES, keygen: KeyGenerator | None = None,
+                 release_bytes: int = RELEASE_BYTES):
+        super().__init__(keygen, release_bytes)
+        self.segment_bytes = int(segment_bytes)
+        self._segments: list[_Segment] = []
+        self._loc: dict[str, tuple[int, int, int]] = {}
+        self._migrated = False
+        # While loading, log replay may name ranges a later key now holds, so
+        # wipes are collected here and applied to dead space once load is done
+        self._loading = False
+        self._stale: list[tuple[int, int, int]] = []
+        # Guards segment allocation, free lists and dirty ranges; material is written outside it
+        self._alloc_lock = threading.Lock()
+
+    def _slab_path(self, index: int) -> str | None:
+        if not self._path:
+            return None
+        return os.path.join(self._path + '.slab', f"seg-{index:05d}.bin")
+
+    def _segment(self, index: int, size: int | None = None, create: bool = True) -> _Segment:
+        while len(self._segments) <= index:
+            i = len(self._segments)
+            path = self._slab_path(i)
+            if path is not None and create:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._segments.append(_Segment(path, size if i == index and size else self.segment_bytes, create))
+        return self._segments[index]
+
+    def _allocate(self, length: int) -> tuple[int, int]:
+        for index, seg in enumerate(self._segments):
+            off = seg.take(length)
+            if off is not None:
+                return index, off
+        index = len(self._segments)
+        seg = self._segment(index, max(self.segment_bytes, length))
+        seg.used = length
+        return index, 0
+
+    def _new_material(self, key_id: str, length: int) -> memoryview:
+        with self._alloc_lock:
+            index, off = self._allocate(length)
+            seg = self._segments[index]
+            self._loc[key_id] = (index, off, length)
+        view = seg.view[off:off + length]
+        self.keygen.read_into(view)
+        self._mark(index, off, length)
+        return view
+
+    def _mark(self, index: int, off: int, length: int) -> None:
+        with self._alloc_lock:
+            self._segments[index].mark_dirty(off, off + length)
+
+    def _sync_material(self) -> None:
+        with self._alloc_lock:
+            for seg in self._segments:
+                seg.sync()
+
+    def _material_ref(self, item: KeyItem):
+        return self._loc[item.key_id]
+
+    def _material_fields(self, ref) -> dict:
+        index, off, length = ref
+        return {'seg': index, 'off': off, 'len': length}
+
+    def _material_from(self, key_id: str, obj: dict) -> memoryview:
+        if 'key_b64' in obj:
+            # Entry from a plain JSON store: copy its bytes into the slab once
+            self._migrated = True
+            data = super()._material_from(key_id, obj)
+            view = self._new_material(key_id, len(data))
+            view[:] = data
+            return view
+        index, off, length = int(obj['seg']), int(obj['off']), int(obj['len'])
+        with self._alloc_lock:
+            # Existing keys never get a fresh (zeroed) segment
+            seg = self._segment(index, create=False)
+            seg.used = max(seg.used, off + length)
+        self._loc[key_id] = (index, off, length)
+        return seg.view[off:off + length]
+
+    def _split_material(self, item: KeyItem, cut: int) -> tuple:
+        # The slab range stays mapped; the released prefix is zeroed in place later
+        index, off, length = self._loc[item.key_id]
+        self._loc[item.key_id] = (index, off + cut, length - cut)
+        return item.key_bytes[cut:], item.key_bytes[:cut], (index, off, cut)
+
+    def _wipe(self, buf, mark: tuple | None) -> None:
+        if self._loading:
+            self._stale.append(mark)
+            return
+        super()._wipe(buf, mark)
+        if mark is not None:
+            index, off, length = mark
+            with self._alloc_lock:
+                seg = self._segments[index]
+                seg.mark_dirty(off, off + length)
+                seg.give(off, length)
+
+    def _drop(self, key_id: str) -> KeyItem | None:
+        loc = self._loc.pop(key_id, None)
+        if self._loading and loc is not None:
+            # Replayed eviction; the reaper may not have wiped it before the restart
+            self._stale.append(loc)
+        return super()._drop(key_id)
+
+    def _settle_space(self) -> None:
+        """Rebuild free lists from the index, then wipe what replay left dead."""
+        live: list[list[tuple[int, int]]] = [[] for _ in self._segments]
+        for index, off, length in self._loc.values():
+            live[index].append((off, length))
+        with self._alloc_lock:
+            for seg, ranges in zip(self._segments, live):
+                seg.rebuild(sorted(ranges))
+            for index, off, length in self._stale:
+                seg = self._segments[index]
+                for lo, hi in seg.dead(off, off + length):
+                    seg.view[lo:hi] = bytes(hi - lo)
+                    seg.mark_dirty(lo, hi)
+        self._stale = []
+
+    def _evicted_material(self, item: KeyItem) -> tuple:
+        # Flush the zeroed range too, so evicted material is also wiped on disk
+        return item.key_bytes, self._loc[item.key_id]
+
+    def load(self):
+        with self._lock:
+            self._loading = True
+            try:
+                super().load()
+            finally:
+                self._loading = False
+            self._settle_space()
+            self._sync_material()
+            if self._migrated and self._path:
+                self._migrated = False
+                self._sync_material()
+                self._write_snapshot(self._snapshot_rows(), self._wal.seq if self._wal else 0)
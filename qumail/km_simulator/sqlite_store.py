@@ -0,0 +1,250 @@
+import base64
+import os
+import sqlite3
+import threading
+import time
+
+from .keygen import KeyGenerator, OsRandomGenerator
+from .storage import (KEY_BYTES_CONSUMED, KEY_BYTES_CREATED, KEYS_CREATED, RELEASE_BYTES, STORE_OP_SECONDS,
+                      KeyItem, ReaperMixin)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    key_id     TEXT PRIMARY KEY,
+    client_id  TEXT NOT NULL,
+    peer_id    TEXT NOT NULL,
+    key_bytes  BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    consumed   INTEGER NOT NULL DEFAULT 0,
+    expires_at REAL,
+    max_uses   INTEGER,
+    uses       INTEGER NOT NULL DEFAULT 0,
+    retain     INTEGER NOT NULL DEFAULT 0,
+    base       INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS keys_expires_at ON keys(expires_at) WHERE expires_at IS NOT NULL;
+"""
+
+_COLUMNS = "key_id, client_id, peer_id, key_bytes, created_at, consumed, expires_at, max_uses, uses, retain, base"
+# Columns added after the first release, for databases created without them
+_ADDED_COLUMNS = {
+    "retain": "retain INTEGER NOT NULL DEFAULT 0",
+    "base": "base INTEGER NOT NULL DEFAULT 0",
+}
+
+# Keys the reaper removes, by reason (evaluated at the same ``now``)
+_REAP_WHERE = {
+    "expired": "expires_at IS NOT NULL AND expires_at < :now",
+    "exhausted": "NOT retain AND max_uses IS NOT NULL AND uses >= max_uses"
+                 " AND NOT (expires_at IS NOT NULL AND expires_at < :now)",
+    "consumed": "NOT retain AND consumed >= base + length(key_bytes) AND NOT (max_uses IS NOT NULL AND uses >= max_uses)"
+                " AND NOT (expires_at IS NOT NULL AND expires_at < :now)",
+}
+
+
+def _item(row) -> KeyItem:
+    return KeyItem(
+        key_id=row[0], client_id=row[1], peer_id=row[2], held=(row[10], bytes(row[3])),
+        created_at=row[4], consumed=row[5], expires_at=row[6], max_uses=row[7], uses=row[8], retain=bool(row[9]),
+    )
+
+
+class SqliteStore(ReaperMixin):
+    """Key store in a SQLite database, shared by every worker process.
+
+    Same interface as :class:`~.storage.InMemoryStore`. The database runs in
+    WAL journal mode so readers never block the writer, each thread has its
+    own connection, and ``consume`` advances the offset with one conditional
+    ``UPDATE ... RETURNING``, so two processes can never hand out the same
+    bytes. Consumed prefixes are released on the same policy as the other
+    backends (``key_bytes`` then holds the bytes from absolute offset ``base``
+    on). ``secure_delete`` makes SQLite overwrite reaped and released material.
+    """
+
+    def __init__(self, keygen: KeyGenerator | None = None, release_bytes: int = RELEASE_BYTES) -> None:
+        self.keygen = keygen or OsRandomGenerator()
+        self.release_bytes = int(release_bytes)
+        self._path = "file:km-store?mode=memory&cache=shared"
+        self._uri = True
+        self._local = threading.local()
+        self._anchor: sqlite3.Connection | None = None
+        self._stats_lock = threading.Lock()
+        self.reaped = {"expired": 0, "exhausted": 0, "consumed": 0, "bytes": 0, "released": 0}
+
+    def set_path(self, path: str, mode: str | None = None, **_ignored):
+        """Use ``path`` as the database file (a ``.json`` store path becomes ``.sqlite3``).
+
+        Missing parent directories are created. ``mode`` is accepted for
+        interface compatibility; SQLite does its own journaling.
+        """
+        root, ext = os.path.splitext(path)
+        self._path = root + ".sqlite3" if ext == ".json" else path
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        self._uri = False
+        self._local = threading.local()
+
+    @property
+    def db_path(self) -> str:
+        return self._path
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, uri=self._uri, timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 30000")
+            conn.execute("PRAGMA secure_delete = ON")
+            if not self._uri:
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self):
+        conn = self._conn()
+        if self._uri and self._anchor is None:
+            # Keeps the shared in-memory database alive while threads come and go
+            self._anchor = conn
+        conn.executescript(SCHEMA)
+        have = {row[1] for row in conn.execute("PRAGMA table_info(keys)")}
+        for name, ddl in _ADDED_COLUMNS.items():
+            if name not in have:
+                conn.execute(f"ALTER TABLE keys ADD COLUMN {ddl}")
+
+    def close(self) -> None:
+        """Stop the reaper and entropy refills and close this thread's connection.
+
+        Connections other worker threads opened are closed when those threads exit.
+        """
+        self.stop_reaper()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+        if self._anchor is not None and self._anchor is not conn:
+            self._anchor.close()
+        self._anchor = None
+        self.keygen.close()
+
+    def save(self):
+        """Everything is committed per call; this only checkpoints the WAL into the database."""
+        self._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def compact(self):
+        self.save()
+
+    def create_key(self, client_id: str, peer_id: str, length: int, expires_at: float | None = None,
+                   max_uses: int | None = None, retain: bool = False) -> KeyItem:
+        return self.create_keys(client_id, peer_id, 1, length, expires_at=expires_at, max_uses=max_uses, retain=retain)[0]
+
+    def create_keys(self, client_id: str, peer_id: str, number: int, length: int, expires_at: float | None = None,
+                    max_uses: int | None = None, retain: bool = False) -> list[KeyItem]:
+        """Insert ``number`` keys in one transaction."""
+        t0 = time.perf_counter()
+        now = time.time()
+        items = [
+            KeyItem(
+                key_id=base64.urlsafe_b64encode(os.urandom(12)).decode().rstrip('='),
+                client_id=client_id, peer_id=peer_id, held=(0, self.keygen.read(length)),
+                created_at=now, expires_at=expires_at, max_uses=max_uses, retain=retain,
+            )
+            for _ in range(number)
+        ]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                f"INSERT INTO keys ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, 0, ?, ?, 0, ?, 0)",
+                [(it.key_id, it.client_id, it.peer_id, it.key_bytes, it.created_at, it.expires_at, it.max_uses, int(retain))
+                 for it in items],
+            )
+        KEYS_CREATED.inc(number)
+        KEY_BYTES_CREATED.inc(number * length)
+        STORE_OP_SECONDS.labels("create").observe(time.perf_counter() - t0)
+        return items
+
+    def pin(self) -> int:
+        # Reads return copies of the rows, so there are no views to protect
+        return 0
+
+    def unpin(self, epoch: int) -> None:
+        pass
+
+    def get_key(self, key_id: str) -> KeyItem | None:
+        row = self._conn().execute(f"SELECT {_COLUMNS} FROM keys WHERE key_id = ?", (key_id,)).fetchone()
+        return _item(row) if row else None
+
+    def consume(self, key_id: str, nbytes: int) -> tuple[int, bytes]:
+        t0 = time.perf_counter()
+        now = time.time()
+        params = {"id": key_id, "n": int(nbytes), "now": now, "release": self.release_bytes}
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                """
+                UPDATE keys SET consumed = consumed + :n, uses = uses + 1
+                 WHERE key_id = :id
+                   AND (expires_at IS NULL OR expires_at >= :now)
+                   AND (max_uses IS NULL OR uses < max_uses)
+                   AND consumed + :n <= base + length(key_bytes)
+                RETURNING consumed - :n, substr(key_bytes, consumed - :n - base + 1, :n), base
+                """,
+                params,
+            ).fetchone()
+            released = 0
+            if row is not None and self.release_bytes > 0:
+                # Same rule as InMemoryStore._should_release
+                cut = conn.execute(
+                    """
+                    UPDATE keys SET key_bytes = substr(key_bytes, consumed - base + 1), base = consumed
+                     WHERE key_id = :id AND NOT retain
+                       AND consumed - base >= :release AND (consumed - base) * 2 >= length(key_bytes)
+                    RETURNING base
+                    """,
+                    params,
+                ).fetchone()
+                if cut is not None:
+                    released = int(cut[0]) - int(row[2])
+        if released:
+            with self._stats_lock:
+                self.reaped["released"] += released
+        if row is not None:
+            KEY_BYTES_CONSUMED.inc(nbytes)
+            STORE_OP_SECONDS.labels("consume").observe(time.perf_counter() - t0)
+            return int(row[0]), bytes(row[1])
+        # Nothing matched: report why, with the same errors as the in-memory store
+        item = self.get_key(key_id)
+        if item is None:
+            raise KeyError("key not found")
+        if item.expires_at and now > item.expires_at:
+            raise ValueError("key expired")
+        if item.max_uses is not None and item.uses >= item.max_uses:
+            raise ValueError("key usage exceeded")
+        raise ValueError("insufficient key material")
+
+    def reap(self, now: float | None = None) -> dict:
+        """Delete expired, exhausted and fully consumed keys; returns counts for this pass."""
+        t0 = time.perf_counter()
+        params = {"now": time.time() if now is None else now}
+        counts = {"expired": 0, "exhausted": 0, "consumed": 0, "bytes": 0}
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for reason, where in _REAP_WHERE.items():
+                n, nbytes = conn.execute(
+                    f"SELECT count(*), coalesce(sum(length(key_bytes)), 0) FROM keys WHERE {where}", params
+                ).fetchone()
+                if n:
+                    conn.execute(f"DELETE FROM keys WHERE {where}", params)
+                counts[reason] = n
+                counts["bytes"] += nbytes
+        with self._stats_lock:
+            for k, v in counts.items():
+                self.reaped[k] += v
+        STORE_OP_SECONDS.labels("reap").observe(time.perf_counter() - t0)
+        return counts
+
+    def stats(self) -> dict:
+        (n,) = self._conn().execute("SELECT count(*) FROM keys").fetchone()
+        with self._stats_lock:
+            return {"keys": n, "reaped": dict(self.reaped)}
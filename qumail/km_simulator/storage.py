@@ -1,46 +1,270 @@
 import base64
+import heapq
 import os
+import sys
 import time
 import threading
 import json
+from contextlib import contextmanager
 from dataclasses import dataclass, field, asdict
 from typing import Dict
 
+from . import metrics
+from .keygen import KeyGenerator, OsRandomGenerator
+from .wal import WriteAheadLog, read_records
 
-@dataclass
+# Persistence modes: "snapshot" rewrites the whole JSON file on every change,
+# "wal" appends one record per change and compacts into the snapshot later
+PERSIST_MODES = ("snapshot", "wal")
+# Compact the write-ahead log into a fresh snapshot once it grows past this
+WAL_COMPACT_BYTES = 8 << 20
+# Retired (exhausted / fully consumed) keys stay visible this long before the
+# reaper evicts them, so a status lookup right after the last consume still
+# finds the key. Wiping evicted material waits for readers (see pin), not this.
+REAP_GRACE_SECONDS = 2.0
+# Number of per-key lock stripes guarding consume
+LOCK_STRIPES = 64
+# A key's consumed prefix is released once it is at least this many bytes and
+# at least half of the material still held (so each byte is copied O(1) times)
+RELEASE_BYTES = 64 << 10
+
+# Store metrics, shared by every backend (see metrics.py); successful consumes
+# are counted by km_store_op_seconds_count{op="consume"}
+KEYS_CREATED = metrics.Counter("km_keys_created_total", "Keys created")
+KEY_BYTES_CREATED = metrics.Counter("km_key_bytes_created_total", "Bytes of key material created")
+KEY_BYTES_CONSUMED = metrics.Counter("km_key_bytes_consumed_total", "Bytes of key material handed out by consume")
+STORE_OP_SECONDS = metrics.Histogram("km_store_op_seconds", "Store operation time, persistence included", ("op",))
+LOCK_WAIT_SECONDS = metrics.Histogram("km_store_lock_wait_seconds", "Time spent waiting to acquire store locks",
+                                      ("op",), buckets=metrics.LOCK_WAIT_BUCKETS)
+# Label lookups resolved once; these sit on the consume/create hot path
+_CREATE_SECONDS = STORE_OP_SECONDS.labels("create")
+_CONSUME_SECONDS = STORE_OP_SECONDS.labels("consume")
+_REAP_SECONDS = STORE_OP_SECONDS.labels("reap")
+_CREATE_LOCK_WAIT = LOCK_WAIT_SECONDS.labels("create")
+_CONSUME_LOCK_WAIT = LOCK_WAIT_SECONDS.labels("consume")
+_KEYS_CREATED = KEYS_CREATED.labels()
+_KEY_BYTES_CREATED = KEY_BYTES_CREATED.labels()
+_KEY_BYTES_CONSUMED = KEY_BYTES_CONSUMED.labels()
+
+
+@dataclass(slots=True)
 class KeyItem:
+    """One key; ``held`` is (base, material): its bytes from absolute offset ``base`` on.
+
+    Bytes before ``base`` were consumed and have been released. A release
+    swaps the whole tuple in one assignment, so lock-free readers always see
+    a matching base and buffer. A ``retain`` key keeps its consumed bytes
+    readable (no release, no eviction when spent) until it expires, for
+    receivers that read ranges the sender consumed.
+    """
     key_id: str
     client_id: str
     peer_id: str
-    key_bytes: bytes
+    held: tuple[int, bytes]
     created_at: float = field(default_factory=lambda: time.time())
     consumed: int = 0  # number of bytes consumed
     expires_at: float | None = None
     max_uses: int | None = None
     uses: int = 0
+    retain: bool = False
+
+    @property
+    def key_bytes(self) -> bytes:
+        return self.held[1]
+
+    @property
+    def base(self) -> int:
+        return self.held[0]
+
+    @property
+    def length(self) -> int:
+        """Full key length, including any released prefix."""
+        base, buf = self.held
+        return base + len(buf)
+
+    def window(self, start: int, end: int) -> memoryview:
+        """Zero-copy view of the absolute range [start, end)."""
+        base, buf = self.held
+        if start < base:
+            raise ValueError("key material released")
+        return memoryview(buf)[start - base:end - base]
+
+
+class ReaperMixin:
+    """Background thread calling ``self.reap()``; used by every store backend."""
+
+    _reaper: threading.Thread | None = None
+
+    def start_reaper(self, interval: float = 5.0) -> None:
+        """Run :meth:`reap` every ``interval`` seconds on a daemon thread."""
+        if self._reaper is not None:
+            return
+        stop = self._reaper_stop = threading.Event()
 
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.reap()
+                except Exception:
+                    pass
 
-class InMemoryStore:
-    def __init__(self) -> None:
+        self._reaper = threading.Thread(target=run, name="km-reaper", daemon=True)
+        self._reaper.start()
+
+    def stop_reaper(self) -> None:
+        if self._reaper is not None:
+            self._reaper_stop.set()
+            self._reaper.join(timeout=5.0)
+            self._reaper = None
+
+
+class InMemoryStore(ReaperMixin):
+    """Thread-safe key store.
+
+    Locking: ``_lock`` guards the key dict's structure (insert / drop) and the
+    expiry index; per-key counters are guarded by one of ``LOCK_STRIPES``
+    striped locks, so consumes on different keys do not contend. Reads are
+    lock-free: the dict lookup is atomic, ``held`` is swapped as a whole and
+    everything else but consumed/uses is immutable after creation. Lock order
+    is stripe before ``_lock``. Persistence (fsync or snapshot write) always
+    happens after locks are released.
+
+    Material views handed out (consume, material, snapshot capture) stay valid
+    while the caller holds a :meth:`pin`: released prefixes and evicted keys go
+    to a graveyard and are zeroized only once every reader pinned before they
+    were buried has unpinned.
+    """
+
+    def __init__(self, keygen: KeyGenerator | None = None, release_bytes: int = RELEASE_BYTES) -> None:
+        self.keygen = keygen or OsRandomGenerator()
+        self.release_bytes = int(release_bytes)
         self._keys: Dict[str, KeyItem] = {}
-        self._lock = threading.Lock()
+        # Re-entrant so load()/compact() can call helpers that take it again
+        self._lock = threading.RLock()
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._save_lock = threading.Lock()
+        self._dirty = False
         self._path: str | None = None
+        self._mode = "snapshot"
+        self._wal: WriteAheadLog | None = None
+        self._compact_bytes = WAL_COMPACT_BYTES
+        self._compact_lock = threading.Lock()
+        self._compacting = False
+        # Expiry index: min-heap of (expires_at, key_id); stale entries are skipped
+        self._expiry: list[tuple[float, str]] = []
+        # Exhausted or fully consumed keys -> time they were retired
+        self._retired: Dict[str, float] = {}
+        # Material awaiting its wipe: (burial epoch, released bytes or 0 if evicted, buffer, slab range or None)
+        self._graveyard: list[tuple[int, int, object, tuple | None]] = []
+        # Reader epochs: epoch -> readers pinned in it; burials advance the epoch
+        self._epoch = 0
+        self._pins: Dict[int, int] = {}
+        self._pin_lock = threading.Lock()
+        self.reaped = {"expired": 0, "exhausted": 0, "consumed": 0, "bytes": 0, "released": 0}
+        # Ships local creations and consume offsets to the paired node (see replication.py)
+        self.replicator = None
 
-    def create_key(self, client_id: str, peer_id: str, length: int, expires_at: float | None = None, max_uses: int | None = None) -> KeyItem:
-        with self._lock:
+    def create_key(self, client_id: str, peer_id: str, length: int, expires_at: float | None = None,
+                   max_uses: int | None = None, retain: bool = False) -> KeyItem:
+        return self.create_keys(client_id, peer_id, 1, length, expires_at=expires_at, max_uses=max_uses, retain=retain)[0]
+
+    def create_keys(self, client_id: str, peer_id: str, number: int, length: int, expires_at: float | None = None,
+                    max_uses: int | None = None, retain: bool = False) -> list[KeyItem]:
+        """Create ``number`` keys with one short lock acquisition and a single save.
+
+        Material is taken from ``keygen`` before the lock is taken; only the
+        insert and the log append happen inside it.
+        """
+        t0 = time.perf_counter()
+        # Interned so millions of keys share one copy of each id string
+        client_id, peer_id = sys.intern(client_id), sys.intern(peer_id)
+        items = []
+        for _ in range(number):
             key_id = base64.urlsafe_b64encode(os.urandom(12)).decode().rstrip('=')
-            key_bytes = os.urandom(length)
-            item = KeyItem(key_id=key_id, client_id=client_id, peer_id=peer_id, key_bytes=key_bytes, expires_at=expires_at, max_uses=max_uses)
-            self._keys[key_id] = item
-            self._autosave()
-            return item
+            key_bytes = self._new_material(key_id, length)
+            items.append(KeyItem(key_id=key_id, client_id=client_id, peer_id=peer_id, held=(0, key_bytes), expires_at=expires_at, max_uses=max_uses, retain=retain))
+        self._sync_material()
+        records = [self._create_record(it) for it in items]
+        rep = self.replicator
+        replica = [self._replica_record(it) for it in items] if rep is not None else None
+        t_lock = time.perf_counter()
+        with self._lock:
+            waited = time.perf_counter() - t_lock
+            for item in items:
+                self._keys[item.key_id] = item
+                self._track(item)
+            seq = self._persist(records)
+            if rep is not None:
+                rep.enqueue(replica)
+        self._commit(seq)
+        if rep is not None:
+            rep.backpressure()
+        # Observed after the locks are released so metrics never lengthen a critical section
+        _CREATE_LOCK_WAIT.observe(waited)
+        _KEYS_CREATED.inc(number)
+        _KEY_BYTES_CREATED.inc(number * length)
+        _CREATE_SECONDS.observe(time.perf_counter() - t0)
+        return items
 
     def get_key(self, key_id: str) -> KeyItem | None:
-        with self._lock:
-            return self._keys.get(key_id)
+        # Lock-free: dict lookups are atomic and key metadata is immutable
+        return self._keys.get(key_id)
 
-    def consume(self, key_id: str, nbytes: int) -> tuple[int, bytes]:
-        with self._lock:
+    def pin(self) -> int:
+        """Keep material views taken from now on valid until :meth:`unpin` with the returned token."""
+        with self._pin_lock:
+            epoch = self._epoch
+            self._pins[epoch] = self._pins.get(epoch, 0) + 1
+            return epoch
+
+    def unpin(self, epoch: int) -> None:
+        with self._pin_lock:
+            left = self._pins[epoch] - 1
+            if left:
+                self._pins[epoch] = left
+            else:
+                del self._pins[epoch]
+
+    @contextmanager
+    def pinned(self):
+        epoch = self.pin()
+        try:
+            yield
+        finally:
+            self.unpin(epoch)
+
+    def _bury(self, released: int, buf, mark: tuple | None) -> None:
+        """Queue material for wiping once current readers unpin; call under ``_lock``."""
+        with self._pin_lock:
+            epoch = self._epoch
+            self._epoch += 1
+        self._graveyard.append((epoch, released, buf, mark))
+
+    def _stripe(self, key_id: str) -> threading.Lock:
+        return self._stripes[hash(key_id) % len(self._stripes)]
+
+    @contextmanager
+    def _exclusive(self):
+        """Hold every stripe and the main lock: no key is mid-update inside."""
+        for s in self._stripes:
+            s.acquire()
+        try:
+            with self._lock:
+                yield
+        finally:
+            for s in reversed(self._stripes):
+                s.release()
+
+    def consume(self, key_id: str, nbytes: int) -> tuple[int, memoryview]:
+        """Advance ``key_id`` by ``nbytes``; returns (start offset, view of the bytes handed out).
+
+        The view points into the store's material, which is zeroized once it
+        is released or evicted. Call this under :meth:`pin` and copy the bytes
+        (``bytes(view)``) before unpinning if they are needed after that.
+        """
+        t0 = time.perf_counter()
+        with self._stripe(key_id):
+            waited = time.perf_counter() - t0
             item = self._keys.get(key_id)
             if not item:
                 raise KeyError("key not found")
@@ -51,68 +275,391 @@ class InMemoryStore:
                 raise ValueError("key usage exceeded")
             start = item.consumed
             end = start + nbytes
-            if end > len(item.key_bytes):
+            if end > item.length:
                 raise ValueError("insufficient key material")
-            slice_bytes = item.key_bytes[start:end]
+            # A view, not a copy: callers pin the store while they use it
+            slice_bytes = item.window(start, end)
             item.consumed = end
             item.uses += 1
-            self._autosave()
-            return start, slice_bytes
+            rep = self.replicator
+            if rep is not None:
+                rep.enqueue([{"op": "u", "id": key_id, "n": item.consumed, "u": item.uses}])
+            seq = self._persist([self._advanced(item, now)])
+        self._commit(seq)
+        if rep is not None:
+            rep.backpressure()
+        _CONSUME_LOCK_WAIT.observe(waited)
+        _KEY_BYTES_CONSUMED.inc(nbytes)
+        _CONSUME_SECONDS.observe(time.perf_counter() - t0)
+        return start, slice_bytes
+
+    def _advanced(self, item: KeyItem, now: float) -> dict:
+        """Retire or release ``item`` after its offset moved; returns the log record. Call under its stripe."""
+        rec = {"op": "u", "id": item.key_id, "n": item.consumed, "u": item.uses}
+        if self._spent(item):
+            self._retired[item.key_id] = now
+        elif self._should_release(item):
+            self._release(item, item.consumed, now)
+            rec["b"] = item.base
+        return rec
+
+    # Replication
+    def _replica_record(self, item: KeyItem) -> dict:
+        return {
+            "op": "c",
+            "id": item.key_id,
+            "client_id": item.client_id,
+            "peer_id": item.peer_id,
+            "material": bytes(item.key_bytes),
+            "base": item.base,
+            "created_at": item.created_at,
+            "expires_at": item.expires_at,
+            "max_uses": item.max_uses,
+            "consumed": item.consumed,
+            "uses": item.uses,
+            "retain": item.retain,
+        }
+
+    def replica_records(self) -> list[dict]:
+        """The whole store as replication records, to catch a paired node up."""
+        with self._exclusive():
+            return [self._replica_record(v) for v in self._keys.values()]
+
+    def merge_remote(self, records: list[dict]) -> list[dict]:
+        """Apply key creations and consume offsets replicated from the paired node.
+
+        A creation is skipped when the key already exists; offsets and use
+        counts merge as the max of both sides. Nothing merged here is sent
+        back. Returns the offset records whose key is not (yet) in this store.
+        """
+        now = time.time()
+        created = [self._item_from_obj(rec["id"], rec) for rec in records
+                   if rec.get("op") == "c" and rec["id"] not in self._keys]
+        seq = 0
+        if created:
+            self._sync_material()
+            log = [self._create_record(it) for it in created]
+            with self._lock:
+                for item in created:
+                    if item.key_id not in self._keys:
+                        self._keys[item.key_id] = item
+                        self._track(item)
+                        if self._spent(item):
+                            self._retired[item.key_id] = now
+                seq = self._persist(log)
+        unmatched = []
+        for rec in records:
+            if rec.get("op") != "u":
+                continue
+            key_id = rec["id"]
+            with self._stripe(key_id):
+                item = self._keys.get(key_id)
+                if item is None:
+                    unmatched.append(rec)
+                    continue
+                n, uses = min(int(rec["n"]), item.length), int(rec["u"])
+                if n <= item.consumed and uses <= item.uses:
+                    continue
+                item.consumed = max(item.consumed, n)
+                item.uses = max(item.uses, uses)
+                seq = self._persist([self._advanced(item, now)]) or seq
+        self._commit(seq)
+        return unmatched
+
+    def _should_release(self, item: KeyItem) -> bool:
+        if item.retain:
+            return False
+        done = item.consumed - item.base
+        return 0 < self.release_bytes <= done and done * 2 >= len(item.key_bytes)
+
+    def _release(self, item: KeyItem, upto: int, now: float | None) -> None:
+        """Drop ``item``'s material before absolute offset ``upto``; call under its stripe.
+
+        The old bytes are wiped by the reaper once no pinned reader can still
+        hold a view of them, or at once when ``now`` is None (log replay).
+        """
+        cut = upto - item.base
+        tail, wipe, mark = self._split_material(item, cut)
+        item.held = (upto, tail)
+        if now is None:
+            self._wipe(wipe, mark)
+        else:
+            with self._lock:
+                self._bury(cut, wipe, mark)
+
+    def close(self) -> None:
+        """Stop the reaper, replication and entropy refills and close the log.
+
+        Call once the store is no longer served (see ``app.close_app``).
+        """
+        self.stop_reaper()
+        if self.replicator is not None:
+            self.replicator.stop()
+        with self._compact_lock:
+            if self._wal is not None:
+                self._wal.close()
+        self._sync_material()
+        self.keygen.close()
 
     # Persistence API
-    def set_path(self, path: str):
+    def set_path(self, path: str, mode: str = "snapshot", compact_bytes: int = WAL_COMPACT_BYTES):
+        """Set the snapshot file and persistence mode; ``load()`` opens the log in "wal" mode.
+
+        The log lives next to the snapshot as ``<path>.wal``.
+        """
+        if mode not in PERSIST_MODES:
+            raise ValueError(f"Unknown persistence mode: {mode}")
         with self._lock:
             self._path = path
+            self._mode = mode
+            self._compact_bytes = int(compact_bytes)
+
+    def _wal_paths(self) -> tuple[str, str]:
+        return self._path + '.wal', self._path + '.wal.old'
 
     def load(self):
         with self._lock:
-            if not self._path or not os.path.exists(self._path):
+            if not self._path:
                 return
-            try:
+            seq = 0
+            if os.path.exists(self._path):
+                # Any failure here (unreadable or corrupt snapshot, missing slab
+                # file) propagates: starting empty would let the next compaction
+                # overwrite the snapshot and drop the log, losing every key
                 with open(self._path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                    try:
+                        data = json.load(f)
+                    except ValueError as e:
+                        raise ValueError(f"Corrupt KM store snapshot {self._path}: {e}") from e
+                keys = {key_id: self._item_from_obj(key_id, obj) for key_id, obj in data.get('keys', {}).items()}
                 self._keys.clear()
-                for key_id, obj in data.get('keys', {}).items():
-                    kb = base64.b64decode(obj['key_b64'])
-                    item = KeyItem(
-                        key_id=key_id,
-                        client_id=obj['client_id'],
-                        peer_id=obj['peer_id'],
-                        key_bytes=kb,
-                        created_at=float(obj.get('created_at', time.time())),
-                        consumed=int(obj.get('consumed', 0)),
-                        expires_at=obj.get('expires_at'),
-                        max_uses=obj.get('max_uses'),
-                        uses=int(obj.get('uses', 0)),
-                    )
-                    self._keys[key_id] = item
-            except Exception:
-                # best-effort load
-                pass
+                self._keys.update(keys)
+                seq = int(data.get('wal_seq', 0))
+            if self._mode == "wal":
+                self._open_log(seq)
+            self._reindex()
 
-    def save(self):
+    def _open_log(self, seq: int) -> None:
+        if self._wal is not None:
+            self._wal.close()
+        # Replay what the snapshot does not cover: a segment left by an
+        # interrupted compaction first, then the live log
+        last = seq
+        replayed = False
+        for path in reversed(self._wal_paths()):
+            for rec_seq, rec in read_records(path):
+                if rec_seq > seq:
+                    self._apply(rec)
+                    replayed = True
+                last = max(last, rec_seq)
+        if replayed:
+            self._sync_material()
+            self._write_snapshot(self._snapshot_rows(), last)
+        for path in self._wal_paths():
+            if os.path.exists(path):
+                os.remove(path)
+        self._wal = WriteAheadLog(self._wal_paths()[0])
+        self._wal.open(start_seq=last)
+
+    def _apply(self, rec: dict) -> None:
+        op, key_id = rec.get('op'), rec.get('id')
+        if op == 'c':
+            self._keys[key_id] = self._item_from_obj(key_id, rec)
+        elif op == 'u':
+            item = self._keys.get(key_id)
+            if item:
+                item.consumed = int(rec['n'])
+                item.uses = int(rec['u'])
+                if int(rec.get('b', 0)) > item.base:
+                    self._release(item, int(rec['b']), None)
+        elif op == 'x':
+            self._drop(key_id)
+
+    def _drop(self, key_id: str) -> KeyItem | None:
+        return self._keys.pop(key_id, None)
+
+    # Expiry / reaping
+    @staticmethod
+    def _spent(item: KeyItem) -> bool:
+        if item.retain:
+            # Receivers still read its consumed ranges; only expiry evicts it
+            return False
+        if item.max_uses is not None and item.uses >= item.max_uses:
+            return True
+        return item.consumed >= item.length
+
+    def _track(self, item: KeyItem) -> None:
+        if item.expires_at:
+            heapq.heappush(self._expiry, (float(item.expires_at), item.key_id))
+
+    def _reindex(self) -> None:
+        self._expiry = [(float(v.expires_at), k) for k, v in self._keys.items() if v.expires_at]
+        heapq.heapify(self._expiry)
+        self._retired = {k: 0.0 for k, v in self._keys.items() if self._spent(v)}
+
+    def reap(self, now: float | None = None) -> dict:
+        """Evict expired, exhausted and fully consumed keys and zeroize their material.
+
+        Returns the counts reclaimed by this pass; running totals are in ``reaped``.
+        """
+        t0 = time.perf_counter()
+        now = time.time() if now is None else now
+        counts = {"expired": 0, "exhausted": 0, "consumed": 0, "bytes": 0, "released": 0}
+        victims: list[tuple[str, str]] = []
         with self._lock:
-            if not self._path:
-                return
-            try:
-                out = {
-                    'keys': {
-                        k: {
-                            'client_id': v.client_id,
-                            'peer_id': v.peer_id,
-                            'key_b64': base64.b64encode(v.key_bytes).decode(),
-                            'created_at': v.created_at,
-                            'consumed': v.consumed,
-                            'expires_at': v.expires_at,
-                            'max_uses': v.max_uses,
-                            'uses': v.uses,
-                        }
-                        for k, v in self._keys.items()
-                    }
+            while self._expiry and self._expiry[0][0] < now:
+                exp, key_id = heapq.heappop(self._expiry)
+                item = self._keys.get(key_id)
+                if item is not None and item.expires_at is not None and float(item.expires_at) == exp:
+                    victims.append((key_id, "expired"))
+            for key_id, retired_at in list(self._retired.items()):
+                if now - retired_at >= REAP_GRACE_SECONDS:
+                    item = self._keys.get(key_id)
+                    if item is not None:
+                        exhausted = item.max_uses is not None and item.uses >= item.max_uses
+                        victims.append((key_id, "exhausted" if exhausted else "consumed"))
+                    else:
+                        self._retired.pop(key_id, None)
+        seq = 0
+        for key_id, reason in victims:
+            # Stripe first so no consume is halfway through this key
+            with self._stripe(key_id), self._lock:
+                self._retired.pop(key_id, None)
+                item = self._keys.get(key_id)
+                if item is None:
+                    continue
+                counts[reason] += 1
+                counts["bytes"] += len(item.key_bytes)
+                self._bury(0, *self._evicted_material(item))
+                self._drop(key_id)
+                seq = self._persist([{"op": "x", "id": key_id}]) or seq
+        with self._lock:
+            with self._pin_lock:
+                oldest = min(self._pins, default=None)
+            # Buried before the oldest pinned reader arrived: nobody can see it any more
+            wipes = [g for g in self._graveyard if oldest is None or g[0] < oldest]
+            if wipes:
+                self._graveyard = [g for g in self._graveyard if oldest is not None and g[0] >= oldest]
+        for _, cut, buf, mark in wipes:
+            counts["released"] += cut
+            self._wipe(buf, mark)
+        if victims or wipes:
+            self._sync_material()
+        with self._lock:
+            for k, v in counts.items():
+                self.reaped[k] += v
+        self._commit(seq)
+        _REAP_SECONDS.observe(time.perf_counter() - t0)
+        return counts
+
+    def _evicted_material(self, item: KeyItem) -> tuple:
+        """(buffer, slab range or None) to wipe once an evicted key's readers are gone."""
+        return item.key_bytes, None
+
+    def _wipe(self, buf, mark: tuple | None) -> None:
+        view = memoryview(buf)
+        if not view.readonly:
+            view[:] = bytes(len(view))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"keys": len(self._keys), "reaped": dict(self.reaped)}
+
+    def _persist(self, records: list[dict]) -> int:
+        """Record a mutation; call under the lock guarding it. Returns a log seq for ``_commit``."""
+        if self._wal is None:
+            self._dirty = True
+            return 0
+        seq = 0
+        for rec in records:
+            seq = self._wal.append(rec)
+        return seq
+
+    def _commit(self, seq: int) -> None:
+        """Make the mutation durable; call after releasing every store lock.
+
+        Waits for the group fsync covering ``seq`` in wal mode, or writes the
+        snapshot (if nobody already has since the change) in snapshot mode.
+        """
+        if self._wal is None:
+            if self._dirty:
+                self._autosave()
+            return
+        if not seq:
+            return
+        self._wal.wait(seq)
+        if self._wal.size() >= self._compact_bytes and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self._compact_in_background, name="km-compact", daemon=True).start()
+
+    def _compact_in_background(self) -> None:
+        try:
+            self.compact()
+        except Exception:
+            pass
+        finally:
+            self._compacting = False
+
+    def compact(self) -> None:
+        """Fold the write-ahead log into a new snapshot and drop the covered records."""
+        if self._wal is None:
+            self.save()
+            return
+        # Pinned so the captured material is not wiped before it is encoded
+        with self._compact_lock, self.pinned():
+            with self._exclusive():
+                live, old = self._wal_paths()
+                rows = self._snapshot_rows()
+                seq = self._wal.rotate(old)
+            # Encoding and writing the snapshot happens outside the store lock
+            self._write_snapshot(rows, seq)
+            os.remove(old)
+
+    def _snapshot_rows(self) -> list[tuple]:
+        # Cheap capture under the lock: only consumed/uses change after creation,
+        # material is encoded later from its reference
+        return [(v, v.consumed, v.uses, v.base, self._material_ref(v)) for v in self._keys.values()]
+
+    def _write_snapshot(self, rows: list[tuple], seq: int = 0) -> None:
+        out = {
+            'keys': {
+                v.key_id: {
+                    'client_id': v.client_id,
+                    'peer_id': v.peer_id,
+                    **self._material_fields(ref),
+                    'created_at': v.created_at,
+                    'consumed': consumed,
+                    'expires_at': v.expires_at,
+                    'max_uses': v.max_uses,
+                    'uses': uses,
+                    'base': base,
+                    **({'retain': True} if v.retain else {}),
                 }
-                os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
-                with open(self._path, 'w', encoding='utf-8') as f:
-                    json.dump(out, f)
+                for v, consumed, uses, base, ref in rows
+            },
+            'wal_seq': seq,
+        }
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(out, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+
+    def save(self):
+        if self._wal is not None:
+            self.compact()
+            return
+        if not self._path:
+            return
+        with self._save_lock, self.pinned():
+            # Exclusive so counters, base and material are captured consistently
+            with self._exclusive():
+                self._dirty = False
+                rows = self._snapshot_rows()
+            try:
+                self._write_snapshot(rows)
             except Exception:
                 # best-effort save
                 pass
@@ -123,4 +670,86 @@ class InMemoryStore:
         except Exception:
             pass
 
+    # Key material hooks; SlabStore keeps the bytes in a mapped file instead
+    def _new_material(self, key_id: str, length: int) -> bytes:
+        return self.keygen.read(length)
+
+    def _sync_material(self) -> None:
+        """Make newly written material durable before it is logged."""
+
+    def _material_ref(self, item: KeyItem):
+        """Cheap handle to an item's material, captured under the lock for ``_material_fields``."""
+        return item.key_bytes
+
+    def _material_fields(self, ref) -> dict:
+        return {'key_b64': base64.b64encode(ref).decode()}
+
+    def _material_from(self, key_id: str, obj: dict) -> bytes:
+        return bytearray(base64.b64decode(obj['key_b64']))
+
+    def _split_material(self, item: KeyItem, cut: int) -> tuple:
+        """(bytes kept, bytes to wipe later, slab range to flush) for a release of ``cut`` bytes."""
+        return bytearray(memoryview(item.key_bytes)[cut:]), item.key_bytes, None
+
+    def _create_record(self, item: KeyItem) -> dict:
+        rec = {
+            "op": "c",
+            "id": item.key_id,
+            "client_id": item.client_id,
+            "peer_id": item.peer_id,
+            **self._material_fields(self._material_ref(item)),
+            "created_at": item.created_at,
+            "expires_at": item.expires_at,
+            "max_uses": item.max_uses,
+        }
+        # Only keys merged from the paired node arrive already partly used
+        if item.consumed or item.uses or item.base:
+            rec.update(consumed=item.consumed, uses=item.uses, base=item.base)
+        if item.retain:
+            rec["retain"] = True
+        return rec
+
+    def _item_from_obj(self, key_id: str, obj: dict) -> KeyItem:
+        return KeyItem(
+            key_id=key_id,
+            client_id=sys.intern(obj['client_id']),
+            peer_id=sys.intern(obj['peer_id']),
+            held=(int(obj.get('base', 0)), self._material_from(key_id, obj)),
+            created_at=float(obj.get('created_at', time.time())),
+            consumed=int(obj.get('consumed', 0)),
+            expires_at=obj.get('expires_at'),
+            max_uses=obj.get('max_uses'),
+            uses=int(obj.get('uses', 0)),
+            retain=bool(obj.get('retain', False)),
+        )
+
+# Storage backends: "memory" keeps key bytes in Python objects, "mmap" in slab
+# files, "sqlite" in a database file that several worker processes can share
+STORE_BACKENDS = ("memory", "mmap", "sqlite")
+
 store = InMemoryStore()
+
+
+def get_store():
+    """The store configured for this process (see :func:`configure_store`)."""
+    return store
+
+
+def configure_store(backend: str = "memory", keygen: KeyGenerator | None = None):
+    """Replace the module-level ``store`` with a fresh instance of ``backend``.
+
+    ``keygen`` supplies key material (see :mod:`.keygen`); defaults to ``os.urandom``.
+    """
+    global store
+    release_bytes = int(os.getenv("KM_RELEASE_BYTES", str(RELEASE_BYTES)))
+    if backend == "memory":
+        store = InMemoryStore(keygen, release_bytes)
+    elif backend == "mmap":
+        from .slab_store import SlabStore
+        store = SlabStore(int(os.getenv("KM_SLAB_SEGMENT_BYTES", str(64 << 20))), keygen, release_bytes)
+    elif backend == "sqlite":
+        from .sqlite_store import SqliteStore
+        store = SqliteStore(keygen, release_bytes)
+    else:
+        raise ValueError(f"Unknown KM storage backend: {backend} (expected one of {STORE_BACKENDS})")
+    return store
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+from typing import Iterator, List, Tuple
+
+
+class WriteAheadLog:
+    """Append-only JSON-lines log with group commit.
+
+    ``append`` only queues a record and returns its sequence number; a writer
+    thread flushes whatever has queued up with a single write + fsync, and
+    ``wait(seq)`` blocks until that record is durable. Callers append while
+    holding their own lock (so log order matches memory order) and wait after
+    releasing it, so concurrent writers share fsyncs instead of queueing on them.
+    """
+
+    def __init__(self, path: str, sync_interval: float = 0.002, fsync: bool = True):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.fsync = fsync
+        self._cond = threading.Condition()
+        # Serialises file I/O; never held together with a caller's lock during fsync
+        self._io_lock = threading.Lock()
+        self._pending: List[str] = []
+        self._seq = 0
+        self._durable = 0
+        self._size = 0
+        self._error: Exception | None = None
+        self._file = None
+        self._closed = False
+        self._thread: threading.Thread | None = None
+
+    @property
+    def seq(self) -> int:
+        with self._cond:
+            return self._seq
+
+    def size(self) -> int:
+        """Bytes written to the current segment (including queued records)."""
+        with self._cond:
+            return self._size
+
+    def open(self, start_seq: int = 0) -> None:
+        with self._io_lock, self._cond:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'ab')
+            self._size = self._file.tell()
+            self._seq = self._durable = max(self._seq, start_seq)
+            self._closed = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="km-wal", daemon=True)
+                self._thread.start()
+
+    def append(self, record: dict) -> int:
+        with self._cond:
+            if self._file is None:
+                raise RuntimeError("write-ahead log is not open")
+            self._seq += 1
+            record["s"] = self._seq
+            line = json.dumps(record, separators=(',', ':')) + "\n"
+            self._pending.append(line)
+            self._size += len(line)
+            self._cond.notify_all()
+            return self._seq
+
+    def wait(self, seq: int) -> None:
+        with self._cond:
+            while self._durable < seq and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    self._thread = None
+                    return
+            # Let concurrent writers pile on so one fsync covers the group
+            if self.sync_interval > 0:
+                threading.Event().wait(self.sync_interval)
+            self._flush()
+
+    def _flush(self) -> int:
+        """Write and fsync everything queued so far; returns the durable seq."""
+        with self._io_lock:
+            with self._cond:
+                lines, self._pending = self._pending, []
+                upto = self._seq
+                f = self._file
+            if lines and f is not None:
+                try:
+                    f.write("".join(lines).encode())
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+                except Exception as e:
+                    with self._cond:
+                        self._error = e
+            with self._cond:
+                self._durable = max(self._durable, upto)
+                self._cond.notify_all()
+            return upto
+
+    def rotate(self, old_path: str) -> int:
+        """Flush, move the current segment to ``old_path`` and start a new one.
+
+        Call with appends quiesced (e.g. under the store lock). Returns the
+        last sequence number contained in the rotated segment.
+        """
+        upto = self._flush()
+        with self._io_lock, self._cond:
+            self._file.close()
+            os.replace(self.path, old_path)
+            self._file = open(self.path, 'ab')
+            self._size = 0
+        return upto
+
+    def close(self) -> None:
+        self._flush()
+        with self._io_lock, self._cond:
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._cond.notify_all()
+
+
+def read_records(path: str) -> Iterator[Tuple[int, dict]]:
+    """Yield (seq, record) from a log segment, stopping at a torn final line."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        for raw in f:
+            try:
+                rec = json.loads(raw)
+            except ValueError:
+                # Partial write from a crash: everything after it is unreliable
+                return
+            yield int(rec.get("s", 0)), rec
@@ -1,13 +1,15 @@
 import base64
 import os
+import tempfile
 from dataclasses import dataclass
-from typing import Optional, List, Tuple
+from typing import BinaryIO, Optional, List, Tuple
 
 from flask import Flask, render_template, render_template_string, request, redirect, url_for, session, flash
 
-from ..app.services.config import KMConfig, SMTPConfig, IMAPConfig
+from ..app.services.config import IMAPConfig, SMTPConfig, load_config
 from ..app.services.km_client import KMClient
-from ..app.services.email_service import EmailService
+from ..app.services.key_slab import OTPSlabRegistry
+from ..app.services.email_service import EmailService, read_headers
 from ..app.services import crypto_service
 
 
@@ -20,15 +22,19 @@ class UserContext:
 def create_app() -> Flask:
     app = Flask(__name__)
     app.secret_key = os.getenv("WEB_APP_SECRET", "change-this-secret")
-
-    # Global KM client (can still be changed via settings if needed)
-    km = KMClient(KMConfig(
-        base_url=os.getenv("KM_BASE_URL", "http://127.0.0.1:5001"),
-        client_id=os.getenv("KM_CLIENT_ID", "Alice"),
-        peer_id=os.getenv("KM_PEER_ID", "Bob"),
-        default_key_length=int(os.getenv("KM_DEFAULT_KEY_LENGTH", "4096")),
-        integrity_secret=os.getenv("KM_INTEGRITY_SECRET", "change_this_demo_secret"),
-    ))
+    # Pick the fastest AEAD for Level 3 on this host
+    crypto_service.select_level3_cipher()
+
+    # Global KM client, configured like the desktop app (see config.load_config)
+    km = KMClient(load_config().km)
+    # Background status checks; compose and /diag read the cached result
+    health = km.start_health_monitor()
+    # Keep verified 64-byte AES seeds ready so compose does not wait on the KM
+    if km.cfg.pool_depth > 0:
+        km.start_pool()
+    # Level 1 pads are carved from slabs, one per sender and recipient set,
+    # instead of one key per message
+    otp_slabs = OTPSlabRegistry(km)
 
     def get_ctx() -> Optional[UserContext]:
         if "smtp" in session and "imap" in session:
@@ -157,32 +163,29 @@ def create_app() -> Flask:
         if not ctx:
             return redirect(url_for("login"))
         if request.method == "POST":
-            # KM preflight: check status (hard requirement) and quick keys/new (soft check)
-            try:
-                ok = km.status()
-            except Exception as e:
-                ok = False
-            if not ok:
-                flash(f"KM not reachable at {km.cfg.base_url}. Please ensure KM is running and KM_BASE_URL matches.", "danger")
-                return render_template("compose.html")
-            # quick GET test to avoid POST stalls (soft check)
-            try:
-                _r = km.session.get(f"{km.cfg.base_url}/api/v1/keys/new", params={"length": 8}, timeout=5.0)
-                _r.raise_for_status()
-            except Exception as e:
-                # Warn but proceed; the actual key request will still try with fallback
-                flash(f"KM quick test warning at {km.cfg.base_url}/api/v1/keys/new: {e}", "warning")
             sender = (request.form.get("from", "").strip() or ctx.smtp.username).strip()
             to_raw = request.form.get("to", "").strip()
             subject = request.form.get("subject", "").strip()
             level = int(request.form.get("level", "2"))
             body = request.form.get("body", "").encode("utf-8")
             files = request.files.getlist("attachments")
-            attachments: List[Tuple[str, bytes]] = []
+            # Uploads are passed as files; large ones are spooled and streamed, never read whole
+            attachments: List[Tuple[str, BinaryIO]] = []
             for f in files:
                 if not f or not f.filename:
                     continue
-                attachments.append((f.filename, f.read()))
+                attachments.append((f.filename, f.stream))
+
+            # KM preflight from the cached health check (no extra round trip).
+            # Skipped when a pooled key can serve the send without touching the KM.
+            pooled = level in (2, 3) and km.pool is not None and km.pool.depth(64) > 0
+            if level != 4 and not pooled and not health.snapshot().ok:
+                flash(f"KM not reachable at {km.cfg.base_url}. Please ensure KM is running and KM_BASE_URL matches.", "danger")
+                return render_template("compose.html")
+
+            # Compress up front so a Level 1 key only has to cover the compressed bytes
+            es = EmailService(ctx.smtp, ctx.imap)
+            prepared = es.prepare_parts(body, attachments)
 
             # Prepare key material
             qkd_bytes = None
@@ -190,14 +193,21 @@ def create_app() -> Flask:
             tampered: Optional[bool] = None
             key_offset: Optional[int] = 0
             key_bytes: Optional[int] = None
+            part_key_offsets: Optional[List[int]] = None
+
+            # Allow single or multiple recipients; split only if commas exist
+            recipients = [to_raw.strip()] if "," not in to_raw else [x.strip() for x in to_raw.split(',') if x.strip()]
 
             try:
                 if level == 1:
-                    total_len = len(body) + sum(len(d) for _, d in attachments)
-                    key_id, qkd_bytes, tampered = km.request_key_with_verify(length=max(total_len, km.cfg.default_key_length))
-                    key_bytes = total_len
+                    # Carve a disjoint range per part out of this pair's OTP slab
+                    alloc = otp_slabs.allocate(sender, recipients, [len(p.data) for p in prepared])
+                    key_id, qkd_bytes, tampered = alloc.key_id, alloc.material, alloc.tampered
+                    key_offset = alloc.offset
+                    key_bytes = len(alloc.material)
+                    part_key_offsets = alloc.part_offsets
                 elif level in (2, 3):
-                    key_id, qkd_bytes, tampered = km.request_key_with_verify(length=64)
+                    key_id, qkd_bytes, tampered = km.acquire_key(64)
                     key_bytes = 64
             except Exception as e:
                 if level != 4:
@@ -205,9 +215,6 @@ def create_app() -> Flask:
                     return render_template("compose.html")
 
             try:
-                es = EmailService(ctx.smtp, ctx.imap)
-                # Allow single or multiple recipients; split only if commas exist
-                recipients = [to_raw.strip()] if "," not in to_raw else [x.strip() for x in to_raw.split(',') if x.strip()]
                 es.send_email(
                     sender=sender,
                     recipients=recipients,
@@ -220,6 +227,8 @@ def create_app() -> Flask:
                     key_offset=key_offset,
                     key_bytes=key_bytes,
                     tampered=tampered,
+                    prepared=prepared,
+                    part_key_offsets=part_key_offsets,
                 )
                 if tampered:
                     flash("Warning: KM integrity mismatch detected (intrusion simulation).", "warning")
@@ -237,10 +246,12 @@ def create_app() -> Flask:
         if not ctx:
             return redirect(url_for("login"))
         es = EmailService(ctx.smtp, ctx.imap)
-        msg = es.fetch_message(uid)
-        if not msg:
+        # Downloaded to a temporary file and opened part by part, so big attachments stay out of memory
+        fp = es.fetch_message_file(uid)
+        if not fp:
             flash("Message not found.", "warning")
             return redirect(url_for("inbox"))
+        msg = read_headers(fp)
 
         level_str = msg.get('X-QuMail-Level', '4')
         try:
@@ -252,13 +263,19 @@ def create_app() -> Flask:
         tampered_detected = False
         key_id = msg.get('X-QuMail-KeyId')
         key_bytes_hdr = msg.get('X-QuMail-KeyBytes')
+        key_offset_hdr = msg.get('X-QuMail-KeyOffset')
         km_tampered_hdr = msg.get('X-QuMail-KMTampered')
         if km_tampered_hdr == 'true':
             tampered_detected = True
 
         try:
             if level == 1:
-                if key_id and key_bytes_hdr:
+                if key_id and key_bytes_hdr and key_offset_hdr:
+                    # Read the message's slab range without consuming it, so it can be reopened
+                    offset, slice_b, t = km.material_with_verify(key_id, int(key_bytes_hdr), offset=int(key_offset_hdr))
+                    qkd_bytes = slice_b
+                    tampered_detected = tampered_detected or t
+                elif key_id and key_bytes_hdr:
                     need = int(key_bytes_hdr)
                     offset, slice_b, t = km.consume_with_verify(key_id, need)
                     qkd_bytes = slice_b
@@ -281,7 +298,9 @@ def create_app() -> Flask:
             flash(f"KM error: {e}", "danger")
             return redirect(url_for("inbox"))
 
-        body, attachments = es.decrypt_message(msg, qkd_bytes)
+        # Attachments are only listed, so they are decrypted into a directory dropped afterwards
+        with fp, tempfile.TemporaryDirectory() as out_dir:
+            body, attachments = es.decrypt_message_file(fp, qkd_bytes, out_dir)
         if tampered_detected:
             flash("Possible Intrusion Detected: Key integrity mismatch", "danger")
         return render_template("message.html", msg=msg, body=body, attachments=attachments)
@@ -289,20 +308,11 @@ def create_app() -> Flask:
     @app.route("/diag")
     def diag():
         info = {"km_base_url": km.cfg.base_url}
-        # Ping status
-        try:
-            r = km.session.get(f"{km.cfg.base_url}/api/v1/status", timeout=5.0)
-            info["status_ok"] = (r.status_code == 200)
-            info["status_json"] = r.json()
-        except Exception as e:
-            info["status_error"] = str(e)
-        # Test keys/new
-        try:
-            r2 = km.session.get(f"{km.cfg.base_url}/api/v1/keys/new", params={"length": 8}, timeout=5.0)
-            info["keys_new_ok"] = (r2.status_code == 200)
-            info["keys_new_keys"] = list((r2.json() or {}).keys())
-        except Exception as e:
-            info["keys_new_error"] = str(e)
+        # Cached KM health; ?refresh=1 probes now, including a keys/new test
+        if request.args.get("refresh"):
+            info["km_health"] = health.check(probe_keys=True).as_dict()
+        else:
+            info["km_health"] = health.snapshot().as_dict()
         # Proxy env snapshot (server-side)
         import os as _os
         info["env_NO_PROXY"] = _os.getenv("NO_PROXY")
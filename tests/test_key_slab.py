@@ -0,0 +1,49 @@
+import pytest
+import requests
+
+from qumail.app.services.config import KMConfig
+from qumail.app.services.key_slab import OTPSlabAllocator
+from qumail.app.services.km_client import KMClient
+from qumail.km_simulator.app import close_app, serve_in_thread
+
+
+@pytest.fixture
+def km(monkeypatch):
+    for name, value in {"KM_STORE_PATH": "", "KM_REAP_INTERVAL": "0", "KM_KEYGEN": "os"}.items():
+        monkeypatch.setenv(name, value)
+    server, url = serve_in_thread()
+    yield KMClient(KMConfig(url, "A", "B", 4096, "change_this_demo_secret", otp_slab_length=10000))
+    server.shutdown()
+    close_app(server.app)
+
+
+def test_slab_is_created_without_downloading_material(km):
+    data = km.request_key(length=5000, expires_in=60, retain=True, material=False)
+    assert "key_b64" not in data
+    assert data["length"] == 5000 and data["consumed"] == 0
+
+
+def test_failed_consume_gives_the_reservation_back(km, monkeypatch):
+    slab = OTPSlabAllocator(km)
+    slab.allocate([100, 200])
+    assert slab.remaining() == 9700
+
+    def down(key_id, nbytes):
+        raise requests.ConnectionError("KM unreachable")
+
+    with monkeypatch.context() as m:
+        m.setattr(km, "consume_with_verify", down)
+        with pytest.raises(requests.ConnectionError):
+            slab.allocate([500])
+    assert slab.remaining() == 9700
+    assert slab.allocate([500]).offset == 300
+
+
+def test_refused_slab_is_replaced(km):
+    slab = OTPSlabAllocator(km)
+    first = slab.allocate([100])
+    km.consume_with_verify(first.key_id, 9900)  # used up behind the allocator's back
+    with pytest.raises(requests.HTTPError):
+        slab.allocate([10])
+    second = slab.allocate([10])
+    assert second.key_id != first.key_id and second.offset == 0
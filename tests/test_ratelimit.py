@@ -0,0 +1,59 @@
+import pytest
+
+from qumail.km_simulator import ratelimit
+from qumail.km_simulator.app import close_app, create_app
+
+
+@pytest.fixture
+def km(monkeypatch):
+    """Simulator with a near-static rate budget and one scheduler slot we can hold."""
+    for name, value in {
+        "KM_STORE_PATH": "", "KM_REAP_INTERVAL": "0", "KM_KEYGEN": "os",
+        "KM_RATE_REQUESTS": "0.001", "KM_RATE_REQUEST_BURST": "10",
+        "KM_RATE_BYTES": "1", "KM_RATE_BYTE_BURST": "100000",
+    }.items():
+        monkeypatch.setenv(name, value)
+    scheduler = ratelimit.FairScheduler(1, queue_depth=16, max_wait=0.05)
+    monkeypatch.setattr(ratelimit, "scheduler_from_env", lambda: scheduler)
+    app = create_app()
+    yield app.test_client(), scheduler
+    close_app(app)
+
+
+def _limits(client):
+    return client.get("/api/v1/status").get_json()["ratelimit"]["limits"]["A>B"]
+
+
+def test_queue_rejection_refunds_rate_tokens(km):
+    client, scheduler = km
+    body = {"client_id": "A", "peer_id": "B", "length": 1000}
+    assert client.post("/api/v1/keys", json=body).status_code == 200
+    before = _limits(client)
+
+    assert scheduler.acquire("other") == 0.0  # hold the only slot
+    try:
+        for _ in range(5):
+            r = client.post("/api/v1/keys", json=body)
+            assert r.status_code == 429
+            assert r.get_json()["reason"] == "queue"
+    finally:
+        scheduler.release()
+
+    after = _limits(client)
+    assert after["requests"]["available"] == before["requests"]["available"]
+    assert after["bytes"]["available"] == before["bytes"]["available"]
+    assert after["allowed"] == before["allowed"] == 1
+    assert client.post("/api/v1/keys", json=body).status_code == 200
+
+
+def test_batch_queue_rejection_refunds_every_key(km):
+    client, scheduler = km
+    body = {"client_id": "A", "peer_id": "B", "number": 5, "size": 2000}
+    assert scheduler.acquire("other") == 0.0
+    try:
+        assert client.post("/api/v1/keys/batch", json=body).status_code == 429
+    finally:
+        scheduler.release()
+    limits = _limits(client)
+    assert limits["bytes"]["available"] == 100000
+    assert limits["requests"]["available"] == 10
@@ -0,0 +1,80 @@
+import email
+import hashlib
+import io
+import os
+import tracemalloc
+from email import policy
+
+import pytest
+
+from qumail.app.services.config import IMAPConfig, SMTPConfig
+from qumail.app.services.email_service import EmailService
+
+ATTACHMENT_BYTES = 48 << 20
+
+
+@pytest.fixture
+def es():
+    return EmailService(SMTPConfig("localhost", 25, "u", "p", False), IMAPConfig("localhost", 143, "u", "p", False))
+
+
+def _digest(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@pytest.mark.parametrize("level", [2, 4])
+def test_large_attachment_memory_stays_flat(es, tmp_path, level):
+    src = tmp_path / "big.bin"
+    with open(src, "wb") as f:
+        for _ in range(ATTACHMENT_BYTES >> 20):
+            f.write(os.urandom(1 << 20))
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    key = os.urandom(64)
+
+    tracemalloc.start()
+    try:
+        with open(src, "rb") as f, open(tmp_path / "wire.eml", "w+b") as wire:
+            attachments = [("big.bin", f)]
+            prepared = es.prepare_parts(b"hello", attachments)
+            es.write_message(wire, "a@example.org", ["b@example.org"], "big", b"hello", attachments,
+                             level, key, key_id="k", prepared=prepared)
+            send_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            body, files = es.decrypt_message_file(wire, key, str(out_dir))
+            open_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert body == "hello"
+    assert [name for name, _ in files] == ["big.bin"]
+    assert _digest(files[0][1]) == _digest(src)
+    assert send_peak < ATTACHMENT_BYTES // 4
+    assert open_peak < ATTACHMENT_BYTES // 4
+
+
+@pytest.mark.parametrize("level", [1, 2, 3, 4])
+def test_streamed_message_matches_in_memory_api(es, tmp_path, level):
+    big = os.urandom(5 << 20)
+    text = b".leading dot\r\n" * 400000
+    attachments = [("big.bin", io.BytesIO(big)), ("notes.txt", io.BytesIO(text)), ("small.bin", b"tiny")]
+    prepared = es.prepare_parts(b"hello", attachments)
+    key = os.urandom(sum(len(p.data) for p in prepared) if level == 1 else 64)
+    offsets = [sum(len(p.data) for p in prepared[:i]) for i in range(len(prepared))]
+    extra = {"key_offset": 0, "part_key_offsets": offsets} if level == 1 else {}
+
+    wire = io.BytesIO()
+    es.write_message(wire, "a@example.org", ["b@example.org"], "s", b"hello", attachments,
+                     level, key, key_id="k%d" % level, prepared=prepared, **extra)
+    expected = [("big.bin", big), ("notes.txt", text), ("small.bin", b"tiny")]
+
+    msg = email.message_from_bytes(wire.getvalue(), policy=policy.default)
+    assert es.decrypt_message(msg, key) == ("hello", expected)
+
+    body, files = es.decrypt_message_file(wire, key, str(tmp_path))
+    assert body == "hello"
+    assert [(name, open(path, "rb").read()) for name, path in files] == expected